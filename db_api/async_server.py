@@ -0,0 +1,462 @@
+'''
+Event loop server for the RESTful API.
+
+A single thread runs an asyncore loop that accepts the connections, reads
+the requests and writes the responses without blocking, so slow clients and
+idle keep-alive connections do not hold a thread. Complete requests are
+handed to a bounded executor: a fixed number of threads that call the WSGI
+application (and so the ProjectDatabase methods) and pass the response
+back to the loop. While the executor is full the loop stops reading new
+requests and they wait in the socket buffers.
+
+The requests whose path starts with one of long_paths (the change feed:
+Server-Sent Events and long polls, which wait for changes for up to
+minutes) are not run by the executor, which they would fill, but each on a
+thread of its own, so they never delay the other requests. The application
+limits how many of them run at the same time (ChangeNotifier.max_watchers,
+see feed.py).
+
+The responses are produced by the same Flask application as the threaded
+server, so the Collection+JSON and HAL documents are identical.
+
+From the command line (root directory):
+
+python -m db_api.async_server [--host HOST] [--port PORT] [--threads N]
+
+project.py --production --event-loop serves the API and the admin client
+with this server in every worker process.
+'''
+import argparse, asynchat, asyncore, collections, socket, sys, threading
+import traceback
+from io import BytesIO
+try:
+    import Queue as queue
+    from urllib import unquote
+except ImportError:
+    import queue
+    from urllib.parse import unquote
+
+DEFAULT_THREADS = 8
+#Requests handed to the executor per thread before the loop stops reading
+PENDING_PER_THREAD = 2
+#Largest accepted request head, bigger ones are answered with 431
+MAX_HEAD_SIZE = 65536
+
+STATUS_400 = b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n' \
+             b'Connection: close\r\n\r\n'
+STATUS_431 = b'HTTP/1.1 431 Request Header Fields Too Large\r\n' \
+             b'Content-Length: 0\r\nConnection: close\r\n\r\n'
+STATUS_500 = b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n' \
+             b'Connection: close\r\n\r\n'
+
+
+def parse_head(data):
+    '''
+    Parse the request line and the headers of a request.
+    Returns (method, target, version, headers), headers a dict with lower
+    case names, or None if the head is malformed.
+    '''
+    lines = data.lstrip(b'\r\n').split(b'\r\n')
+    try:
+        method, target, version = lines[0].split()
+    except ValueError:
+        return None
+    if not version.startswith(b'HTTP/'):
+        return None
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if not sep:
+            return None
+        name = name.strip().lower()
+        value = value.strip()
+        if name in headers:
+            headers[name] += b', ' + value
+        else:
+            headers[name] = value
+    return method, target, version, headers
+
+def split_target(target):
+    '''
+    Path and query string of a request target, also in absolute form
+    '''
+    path, _, query = target.partition(b'?')
+    if path.startswith(b'http://') or path.startswith(b'https://'):
+        path = b'/' + path.split(b'/', 3)[-1]
+    return path, query
+
+def keep_alive(version, headers):
+    '''
+    True if the connection stays open after the response
+    '''
+    connection = headers.get(b'connection', b'').lower()
+    if version == b'HTTP/1.0':
+        return connection == b'keep-alive'
+    return connection != b'close'
+
+
+class Executor(object):
+    '''
+    Fixed number of threads running the jobs submitted to a queue. The
+    threads are started by start(), after fork() when the server is
+    pre-forked.
+    '''
+
+    def __init__(self, threads):
+        super(Executor, self).__init__()
+        self.threads = threads
+        self._jobs = queue.Queue()
+        self._workers = []
+
+    def start(self):
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, function, *args):
+        self._jobs.put((function, args))
+
+    def stop(self):
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            function, args = job
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+
+
+class Trigger(asyncore.dispatcher):
+    '''
+    Wakes up the loop to run the callbacks queued by other threads
+    (asyncore is not thread safe, only the loop touches the channels).
+    '''
+
+    def __init__(self, map):
+        if hasattr(socket, 'socketpair'):
+            self._reader, self._writer = socket.socketpair()
+        else:
+            #Windows: a loopback connection
+            listener = socket.socket()
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            self._writer = socket.create_connection(listener.getsockname())
+            self._reader = listener.accept()[0]
+            listener.close()
+        asyncore.dispatcher.__init__(self, self._reader, map=map)
+        self._callbacks = collections.deque()
+
+    def call_soon(self, callback, *args):
+        self._callbacks.append((callback, args))
+        try:
+            self._writer.send(b'x')
+        except socket.error:
+            #The buffer is full, the loop already has wake ups pending
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        while self._callbacks:
+            callback, args = self._callbacks.popleft()
+            callback(*args)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._writer.close()
+
+
+class HTTPChannel(asynchat.async_chat):
+    '''
+    One client connection. Requests are handled one at a time, in order;
+    the next request of a keep-alive connection is handed to the executor
+    after the response of the previous one has been queued.
+    '''
+
+    def __init__(self, server, sock, address):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.address = address
+        self.busy = False
+        self._buffer = []
+        self._buffered = 0
+        self._head = None
+        self._requests = collections.deque()
+        self.set_terminator(b'\r\n\r\n')
+
+    def readable(self):
+        return not self.busy and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._head is None and self._buffered > MAX_HEAD_SIZE:
+            self._reject(STATUS_431)
+
+    def found_terminator(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self._head is None:
+            head = parse_head(data)
+            if head is None:
+                return self._reject(STATUS_400)
+            try:
+                length = int(head[3].get(b'content-length', 0))
+            except ValueError:
+                return self._reject(STATUS_400)
+            if length > 0:
+                self._head = head
+                self.set_terminator(length)
+                return
+            body = b''
+        else:
+            head, body = self._head, data
+            self._head = None
+            self.set_terminator(b'\r\n\r\n')
+        #Pipelined requests already in the input buffer wait their turn
+        self._requests.append((head, body))
+        if not self.busy:
+            self._next()
+
+    def finish(self, close):
+        '''
+        Called by the loop when the whole response has been queued
+        '''
+        self.busy = False
+        if close:
+            self._requests.clear()
+            self.busy = True
+            self.close_when_done()
+        elif self._requests:
+            self._next()
+
+    def _next(self):
+        self.busy = True
+        head, body = self._requests.popleft()
+        self.server.submit(self, head, body)
+
+    def _reject(self, response):
+        self.busy = True
+        self.push(response)
+        self.close_when_done()
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.close()
+
+
+class AsyncWSGIServer(asyncore.dispatcher):
+    '''
+    Event loop WSGI server. The socket is bound and listening after
+    __init__; the executor and the trigger are created by serve_forever so
+    the server can be created before fork().
+    '''
+    multithread = True
+    multiprocess = True
+    request_queue_size = 128
+
+    def __init__(self, host, port, app, threads=DEFAULT_THREADS,
+                 long_paths=()):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(self.request_queue_size)
+        self.host, self.port = self.socket.getsockname()[:2]
+        self.app = app
+        self.threads = threads
+        self.max_pending = threads * PENDING_PER_THREAD
+        self.pending = 0
+        self.long_paths = tuple(long_paths)
+        self.long_requests = 0
+        self.executor = None
+        self.trigger = None
+        self._stopped = threading.Event()
+
+    def readable(self):
+        return self.pending < self.max_pending
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            #Another worker process took the connection
+            return
+        sock, address = pair
+        HTTPChannel(self, sock, address)
+
+    def serve_forever(self):
+        self.trigger = Trigger(self.map)
+        self.executor = Executor(self.threads)
+        self.executor.start()
+        try:
+            while not self._stopped.is_set():
+                asyncore.loop(timeout=1.0, map=self.map, count=1)
+        finally:
+            for dispatcher in list(self.map.values()):
+                dispatcher.close()
+            self.executor.stop()
+
+    def shutdown(self):
+        '''
+        Stop serve_forever. Can be called from any thread.
+        '''
+        self._stopped.set()
+        if self.trigger is not None:
+            self.trigger.call_soon(lambda: None)
+
+    def submit(self, channel, head, body):
+        if self.long_paths and \
+           split_target(head[1])[0].startswith(self.long_paths):
+            #Waits for changes: a thread of its own, the executor stays free
+            self.long_requests += 1
+            thread = threading.Thread(target=self.handle_request,
+                                      args=(channel, head, body, False))
+            thread.daemon = True
+            thread.start()
+            return
+        self.pending += 1
+        self.executor.submit(self.handle_request, channel, head, body)
+
+    def _done(self, channel, close, pooled):
+        if pooled:
+            self.pending -= 1
+        else:
+            self.long_requests -= 1
+        if channel.connected:
+            channel.finish(close)
+
+    def _send(self, channel, data):
+        if channel.connected:
+            channel.push(data)
+
+    def make_environ(self, channel, head, body):
+        method, target, version, headers = head
+        path, query = split_target(target)
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': channel.address[0] if channel.address else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': self.multithread,
+            'wsgi.multiprocess': self.multiprocess,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            if name == b'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name == b'content-length':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                environ['HTTP_' + name.upper().replace(b'-', b'_')] = value
+        return environ
+
+    def handle_request(self, channel, head, body, pooled=True):
+        '''
+        Runs in the executor (in a thread of its own if not pooled): call
+        the application and queue the response in the loop, chunk by chunk.
+        '''
+        version, headers = head[2], head[3]
+        close = not keep_alive(version, headers)
+        state = {}
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info is not None and state.get('sent'):
+                raise exc_info[1]
+            state['status'] = status
+            state['headers'] = response_headers
+            return send
+        def send(data):
+            if not state.get('sent'):
+                names = set(name.lower() for name, _ in state['headers'])
+                lines = ['HTTP/1.1 ' + state['status']]
+                lines.extend('%s: %s' % header for header in state['headers'])
+                if 'content-length' not in names:
+                    #No framing without chunked encoding: end with the close
+                    state['close'] = True
+                if close or state.get('close'):
+                    lines.append('Connection: close')
+                state['sent'] = True
+                data = '\r\n'.join(lines) + '\r\n\r\n' + data
+            if data:
+                self.trigger.call_soon(self._send, channel, data)
+
+        try:
+            result = self.app(self.make_environ(channel, head, body),
+                              start_response)
+            try:
+                for data in result:
+                    if data:
+                        send(data)
+                if not state.get('sent'):
+                    send(b'')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            traceback.print_exc()
+            if not state.get('sent'):
+                self.trigger.call_soon(self._send, channel, STATUS_500)
+            state['close'] = True
+        self.trigger.call_soon(self._done, channel,
+                               close or state.get('close', False), pooled)
+
+
+def main(argv=None):
+    import database, resources
+    parser = argparse.ArgumentParser(
+        description='Serve the RESTful API with the event loop server.')
+    parser.add_argument('--host', default='localhost',
+                        help='address to bind (default %(default)s)')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='port to bind (default %(default)s)')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help='executor threads (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    app = resources.app
+    app.debug = False
+    db = app.config['DATABASE']
+    db.migrate()
+    db.close()
+    app.config['DATABASE'] = database.ProjectDatabase(db.db_path,
+                                                      pool_size=args.threads)
+    server = AsyncWSGIServer(args.host, args.port, app, args.threads,
+                             resources.LONG_REQUEST_PATHS)
+    print(' * Serving on http://%s:%d/ with %d executor threads'
+          % (server.host, server.port, args.threads))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
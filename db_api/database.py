@@ -1,19 +1,952 @@
 from datetime import datetime
-import time, sqlite3, sys, re, os
+from contextlib import contextmanager
+from collections import OrderedDict
+import time, sqlite3, sys, re, os, threading, functools
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+#datetime.strptime imports _strptime on the first call, which is not thread
+#safe in Python 2 (AttributeError: _strptime) when threads serve requests
+import _strptime
+
+import profiling
+import replica
  
 DEFAULT_DB_PATH = 'db/project.db'
 DEFAULT_SCHEMA = 'db/project_schema_dump.sql'
 DEFAULT_DATA_DUMP = 'db/project_data_dump.sql'
- 
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_CACHE_SIZE = 1024
+#Seconds between two reads of PRAGMA data_version by the lookup cache
+DEFAULT_VERSION_CHECK_INTERVAL = 1.0
+
+#Values accepted by the CHECK constraints of the TASKS table
+TASK_CATEGORIES = ["frontend", "backend", "UX", "bug"]
+TASK_LEVELS = [1, 2, 3, 4]
+
+#Recount TASK_STATS and ASSIGNEE_STATS from scratch (migration 7 and
+#rebuild_task_stats). Every possible row of TASK_STATS is created, so its
+#triggers only have to update them.
+TASK_STATS_REBUILD = '''
+    DELETE FROM TASK_STATS;
+    INSERT INTO TASK_STATS(dimension, value) VALUES %s;
+    UPDATE TASK_STATS SET count = (SELECT count(*) FROM TASKS)
+        WHERE dimension = 'total';
+    UPDATE TASK_STATS SET count = (SELECT count(*) FROM TASKS
+                                   WHERE status = TASK_STATS.value)
+        WHERE dimension = 'status';
+    UPDATE TASK_STATS SET count = (SELECT count(*) FROM TASKS
+                                   WHERE category = TASK_STATS.value)
+        WHERE dimension = 'category';
+    UPDATE TASK_STATS SET count = (SELECT count(*) FROM TASKS
+                                   WHERE priority = TASK_STATS.value)
+        WHERE dimension = 'priority';
+    DELETE FROM ASSIGNEE_STATS;
+    INSERT INTO ASSIGNEE_STATS(user_id, status, count)
+        SELECT user_id, status, count(*) FROM ASSIGNED_TO
+            JOIN TASKS ON TASKS.id = ASSIGNED_TO.task_id
+            WHERE user_id IS NOT NULL AND status IS NOT NULL
+            GROUP BY user_id, status;
+    ''' % ', '.join(["('total', '')"] +
+                    ["('%s', '%s')" % (dimension, value)
+                     for dimension, values in [('status', TASK_LEVELS),
+                                               ('category', TASK_CATEGORIES),
+                                               ('priority', TASK_LEVELS)]
+                     for value in values])
+#Count an assignment in (or out of) ASSIGNEE_STATS, by status of its task
+ASSIGNEE_STATS_ADD = '''
+        INSERT OR IGNORE INTO ASSIGNEE_STATS(user_id, status, count)
+            SELECT new.user_id, status, 0 FROM TASKS
+                WHERE id = new.task_id AND new.user_id IS NOT NULL
+                  AND status IS NOT NULL;
+        UPDATE ASSIGNEE_STATS SET count = count + 1
+            WHERE user_id = new.user_id
+              AND status = (SELECT status FROM TASKS WHERE id = new.task_id);'''
+ASSIGNEE_STATS_REMOVE = '''
+        UPDATE ASSIGNEE_STATS SET count = count - 1
+            WHERE user_id = old.user_id
+              AND status = (SELECT status FROM TASKS WHERE id = old.task_id);
+        DELETE FROM ASSIGNEE_STATS WHERE user_id = old.user_id AND count = 0;'''
+
+#Fill USER_TREE from the boss column of USERS (migration 8 and
+#rebuild_user_tree): every user with itself at depth 0 and with each of
+#its bosses, walking up from the user whatever the order of the rows.
+USER_TREE_FILL = '''
+    INSERT OR IGNORE INTO USER_TREE(ancestor, descendant, depth)
+        WITH RECURSIVE tree(ancestor, descendant, depth) AS (
+            SELECT id, id, 0 FROM USERS
+            UNION ALL
+            SELECT tree.ancestor, USERS.id, tree.depth + 1
+                FROM tree JOIN USERS ON USERS.boss = tree.descendant
+                WHERE tree.depth < (SELECT count(*) FROM USERS))
+        SELECT ancestor, descendant, min(depth) FROM tree
+            GROUP BY ancestor, descendant'''
+
+#Schema migrations. MIGRATIONS[n] upgrades a database from version n to
+#version n+1; the version is stored in PRAGMA user_version. Never edit a
+#step that has been released, append a new one instead.
+MIGRATIONS = [
+    #1: Indexes for the foreign key lookups (get_comments, get_assigned_users,
+    #remove_assignee, get_team and the ON DELETE CASCADE actions)
+    '''
+    CREATE INDEX IF NOT EXISTS comments_task_id ON COMMENTS(task_id);
+    CREATE INDEX IF NOT EXISTS assigned_to_task_user ON ASSIGNED_TO(task_id, user_id);
+    CREATE INDEX IF NOT EXISTS assigned_to_user ON ASSIGNED_TO(user_id);
+    CREATE INDEX IF NOT EXISTS users_boss ON USERS(boss);
+    ''',
+    #2: Change version and modification time of every table, bumped by
+    #triggers on each write. Used for the ETag and Last-Modified headers.
+    '''
+    CREATE TABLE IF NOT EXISTS CHANGES(
+        table_name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0,
+        modified DATETIME DEFAULT CURRENT_TIMESTAMP);
+    INSERT OR IGNORE INTO CHANGES(table_name) VALUES ('USERS');
+    INSERT OR IGNORE INTO CHANGES(table_name) VALUES ('TASKS');
+    INSERT OR IGNORE INTO CHANGES(table_name) VALUES ('ASSIGNED_TO');
+    INSERT OR IGNORE INTO CHANGES(table_name) VALUES ('COMMENTS');
+    ''' + ''.join('''
+    CREATE TRIGGER IF NOT EXISTS %(table)s_changes_%(event)s AFTER %(event)s ON %(table)s
+    BEGIN
+        UPDATE CHANGES SET version = version + 1, modified = CURRENT_TIMESTAMP
+            WHERE table_name = '%(table)s';
+    END;
+    ''' % dict(table=table, event=event)
+        for table in ['USERS', 'TASKS', 'ASSIGNED_TO', 'COMMENTS']
+        for event in ['INSERT', 'UPDATE', 'DELETE']),
+    #3: Full-text index of the tasks (see search_tasks). One document per
+    #task, with the task id as rowid; the comments column holds all the
+    #comments of the task. Kept in sync by triggers on TASKS and COMMENTS.
+    #Needs SQLite compiled with FTS5.
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS TASKS_SEARCH
+        USING fts5(title, description, comments);
+    DELETE FROM TASKS_SEARCH;
+    INSERT INTO TASKS_SEARCH(rowid, title, description, comments)
+        SELECT id, title, description,
+               (SELECT group_concat(comment, ' ') FROM COMMENTS
+                    WHERE task_id = TASKS.id)
+        FROM TASKS;
+    CREATE TRIGGER IF NOT EXISTS TASKS_search_INSERT AFTER INSERT ON TASKS
+    BEGIN
+        INSERT INTO TASKS_SEARCH(rowid, title, description, comments)
+            VALUES (new.id, new.title, new.description, NULL);
+    END;
+    CREATE TRIGGER IF NOT EXISTS TASKS_search_UPDATE
+        AFTER UPDATE OF title, description ON TASKS
+    BEGIN
+        UPDATE TASKS_SEARCH SET title = new.title,
+                                description = new.description
+            WHERE rowid = new.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS TASKS_search_DELETE AFTER DELETE ON TASKS
+    BEGIN
+        DELETE FROM TASKS_SEARCH WHERE rowid = old.id;
+    END;
+    ''' + ''.join('''
+    CREATE TRIGGER IF NOT EXISTS COMMENTS_search_%(event)s AFTER %(event)s ON COMMENTS
+    BEGIN
+        UPDATE TASKS_SEARCH SET comments =
+            (SELECT group_concat(comment, ' ') FROM COMMENTS
+                WHERE task_id = %(row)s.task_id)
+            WHERE rowid = %(row)s.task_id;%(also)s
+    END;
+    ''' % dict(event=event, row=row, also=also)
+        for event, row, also in [
+            ('INSERT', 'new', ''),
+            ('DELETE', 'old', ''),
+            #A comment moved to another task changes both documents
+            ('UPDATE', 'new', '''
+        UPDATE TASKS_SEARCH SET comments =
+            (SELECT group_concat(comment, ' ') FROM COMMENTS
+                WHERE task_id = old.task_id)
+            WHERE rowid = old.task_id AND old.task_id != new.task_id;''')]),
+    #4: Indexes for the filters and sort keys of get_tasks. Every index ends
+    #with the rowid, so with equality filters on the leading columns the
+    #rows come out in (sort key, id) order and keyset pages need no sort.
+    '''
+    CREATE INDEX IF NOT EXISTS tasks_category_status_priority
+        ON TASKS(category, status, priority);
+    CREATE INDEX IF NOT EXISTS tasks_status_priority ON TASKS(status, priority);
+    CREATE INDEX IF NOT EXISTS tasks_priority ON TASKS(priority);
+    CREATE INDEX IF NOT EXISTS tasks_created_date ON TASKS(created_date);
+    ''',
+    #5: Log of the changes to tasks, comments and assignments, written by
+    #triggers (see get_changes). kind is task, comment or assignment and
+    #action created, updated or deleted; item_id is the comment id or the
+    #assigned user id.
+    '''
+    CREATE TABLE IF NOT EXISTS CHANGE_LOG(
+        event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        action TEXT NOT NULL,
+        task_id INTEGER NOT NULL,
+        item_id INTEGER,
+        changed_date DATETIME DEFAULT CURRENT_TIMESTAMP);
+    ''' + ''.join('''
+    CREATE TRIGGER IF NOT EXISTS %(table)s_log_%(event)s AFTER %(event)s ON %(table)s
+    BEGIN
+        INSERT INTO CHANGE_LOG(kind, action, task_id, item_id)
+            VALUES ('%(kind)s', '%(action)s', %(row)s.%(task)s, %(item)s);%(also)s
+    END;
+    ''' % dict(table=table, event=event, kind=kind, task=task,
+               action=action, row=row, item=item % dict(row=row), also=also)
+        for table, kind, task, item in [
+            ('TASKS', 'task', 'id', 'NULL'),
+            ('COMMENTS', 'comment', 'task_id', '%(row)s.comment_id'),
+            ('ASSIGNED_TO', 'assignment', 'task_id', '%(row)s.user_id')]
+        for event, action, row, also in [
+            ('INSERT', 'created', 'new', ''),
+            ('DELETE', 'deleted', 'old', ''),
+            ('UPDATE', 'updated', 'new', '')
+                if table != 'ASSIGNED_TO' else
+            #An assignment has no other columns: an update moves it
+            ('UPDATE', 'deleted', 'old', '''
+        INSERT INTO CHANGE_LOG(kind, action, task_id, item_id)
+            VALUES ('assignment', 'created', new.task_id, new.user_id);''')]),
+    #6: Modification sequence for delta sync (see get_tasks_since). One row
+    #per row of TASKS, USERS, COMMENTS and ASSIGNED_TO, identified by
+    #(table_name, parent_id, row_id); every write replaces it, so it gets
+    #the next seq, and deleted rows are kept as tombstones. parent_id is
+    #the task of comments and assignments (0 for tasks and users), row_id
+    #the id of the row (the user id for assignments) and name the nickname
+    #of users. Kept out of the tables so that setting the seq does not fire
+    #their UPDATE triggers.
+    '''
+    CREATE TABLE IF NOT EXISTS SYNC_ROWS(
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        parent_id INTEGER NOT NULL,
+        row_id INTEGER NOT NULL,
+        name TEXT,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        UNIQUE(table_name, parent_id, row_id));
+    CREATE INDEX IF NOT EXISTS sync_rows_since ON SYNC_ROWS(table_name, parent_id, seq);
+    INSERT OR REPLACE INTO SYNC_ROWS(table_name, parent_id, row_id, name)
+        SELECT 'TASKS', 0, id, NULL FROM TASKS;
+    INSERT OR REPLACE INTO SYNC_ROWS(table_name, parent_id, row_id, name)
+        SELECT 'USERS', 0, id, nickname FROM USERS;
+    INSERT OR REPLACE INTO SYNC_ROWS(table_name, parent_id, row_id, name)
+        SELECT 'COMMENTS', task_id, comment_id, NULL FROM COMMENTS;
+    INSERT OR REPLACE INTO SYNC_ROWS(table_name, parent_id, row_id, name)
+        SELECT 'ASSIGNED_TO', task_id, user_id, NULL FROM ASSIGNED_TO;
+    ''' + ''.join('''
+    CREATE TRIGGER IF NOT EXISTS %(table)s_sync_%(event)s AFTER %(event)s ON %(table)s
+    BEGIN%(moved)s
+        INSERT OR REPLACE INTO SYNC_ROWS(table_name, parent_id, row_id, name, deleted)
+            VALUES ('%(table)s', %(parent)s, %(row)s.%(key)s, %(name)s, %(deleted)d);
+    END;
+    ''' % dict(table=table, event=event, key=key, row=row, deleted=deleted,
+               parent=parent % dict(row=row), name=name % dict(row=row),
+               moved=('''
+        INSERT OR REPLACE INTO SYNC_ROWS(table_name, parent_id, row_id, deleted)
+            SELECT '%s', old.task_id, old.%s, 1
+            WHERE old.task_id != new.task_id;''' % (table, key))
+                   if event == 'UPDATE' and parent != '0' else '')
+        for table, key, parent, name in [
+            ('TASKS', 'id', '0', 'NULL'),
+            ('USERS', 'id', '0', '%(row)s.nickname'),
+            #A comment or an assignment moved to another task leaves a
+            #tombstone in the old one
+            ('COMMENTS', 'comment_id', '%(row)s.task_id', 'NULL'),
+            ('ASSIGNED_TO', 'user_id', '%(row)s.task_id', 'NULL')]
+        for event, row, deleted in [('INSERT', 'new', 0), ('UPDATE', 'new', 0),
+                                    ('DELETE', 'old', 1)]),
+    #7: Task counts for get_task_stats, kept up to date by triggers so that
+    #reading them does not scan TASKS and ASSIGNED_TO. TASK_STATS has one
+    #row per (dimension, value): the total and every status, category and
+    #priority; ASSIGNEE_STATS the number of assignments of each user by
+    #status of the task. Rows of ASSIGNEE_STATS are removed at 0.
+    '''
+    CREATE TABLE IF NOT EXISTS TASK_STATS(
+        dimension TEXT NOT NULL,
+        value TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(dimension, value));
+    CREATE TABLE IF NOT EXISTS ASSIGNEE_STATS(
+        user_id INTEGER NOT NULL,
+        status INTEGER NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(user_id, status));
+    ''' + TASK_STATS_REBUILD + ''.join('''
+    CREATE TRIGGER IF NOT EXISTS TASKS_stats_%(event)s %(when)s %(event)s ON TASKS
+    BEGIN
+        UPDATE TASK_STATS SET count = count %(sign)s 1
+            WHERE (dimension = 'total' AND value = '')
+               OR (dimension = 'status' AND value = %(row)s.status)
+               OR (dimension = 'category' AND value = %(row)s.category)
+               OR (dimension = 'priority' AND value = %(row)s.priority);%(assignees)s
+    END;
+    ''' % dict(event=event, when=when, sign=sign, row=row, assignees=assignees)
+        for event, when, sign, row, assignees in [
+            ('INSERT', 'AFTER', '+', 'new', ''),
+            #The assignments removed by ON DELETE CASCADE no longer see the
+            #task, so its assignees are counted out before it goes
+            ('DELETE', 'BEFORE', '-', 'old', '''
+        UPDATE ASSIGNEE_STATS SET count = count -
+                (SELECT count(*) FROM ASSIGNED_TO
+                    WHERE task_id = old.id AND user_id = ASSIGNEE_STATS.user_id)
+            WHERE status = old.status AND user_id IN
+                (SELECT user_id FROM ASSIGNED_TO WHERE task_id = old.id);
+        DELETE FROM ASSIGNEE_STATS WHERE count = 0 AND status = old.status;''')]) +
+    '''
+    CREATE TRIGGER IF NOT EXISTS TASKS_stats_UPDATE
+        AFTER UPDATE OF status, category, priority ON TASKS
+    BEGIN
+        UPDATE TASK_STATS SET count = count - 1
+            WHERE (dimension = 'status' AND value = old.status)
+               OR (dimension = 'category' AND value = old.category)
+               OR (dimension = 'priority' AND value = old.priority);
+        UPDATE TASK_STATS SET count = count + 1
+            WHERE (dimension = 'status' AND value = new.status)
+               OR (dimension = 'category' AND value = new.category)
+               OR (dimension = 'priority' AND value = new.priority);
+    END;
+    CREATE TRIGGER IF NOT EXISTS TASKS_stats_status AFTER UPDATE OF status ON TASKS
+        WHEN old.status IS NOT new.status
+    BEGIN
+        INSERT OR IGNORE INTO ASSIGNEE_STATS(user_id, status, count)
+            SELECT DISTINCT user_id, new.status, 0 FROM ASSIGNED_TO
+                WHERE task_id = new.id AND user_id IS NOT NULL AND new.status IS NOT NULL;
+        UPDATE ASSIGNEE_STATS SET count = count +
+                (SELECT count(*) FROM ASSIGNED_TO
+                    WHERE task_id = new.id AND user_id = ASSIGNEE_STATS.user_id)
+            WHERE status = new.status AND user_id IN
+                (SELECT user_id FROM ASSIGNED_TO WHERE task_id = new.id);
+        UPDATE ASSIGNEE_STATS SET count = count -
+                (SELECT count(*) FROM ASSIGNED_TO
+                    WHERE task_id = new.id AND user_id = ASSIGNEE_STATS.user_id)
+            WHERE status = old.status AND user_id IN
+                (SELECT user_id FROM ASSIGNED_TO WHERE task_id = new.id);
+        DELETE FROM ASSIGNEE_STATS WHERE count = 0 AND status = old.status;
+    END;
+    ''' + ''.join('''
+    CREATE TRIGGER IF NOT EXISTS ASSIGNED_TO_stats_%(event)s AFTER %(event)s ON ASSIGNED_TO
+    BEGIN%(body)s
+    END;
+    ''' % dict(event=event, body=''.join(body)) for event, body in [
+            ('INSERT', [ASSIGNEE_STATS_ADD]),
+            ('DELETE', [ASSIGNEE_STATS_REMOVE]),
+            ('UPDATE', [ASSIGNEE_STATS_REMOVE, ASSIGNEE_STATS_ADD])]),
+    #8: Closure table of the team hierarchy (see get_hierarchy and
+    #get_chain_of_command): one row per user and each of its bosses, direct
+    #or not, with the number of levels between them, and a row of depth 0
+    #per user. Kept by triggers on the boss column; a boss inside the team
+    #of the user would make a cycle and is refused.
+    '''
+    CREATE TABLE IF NOT EXISTS USER_TREE(
+        ancestor INTEGER NOT NULL,
+        descendant INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY(ancestor, descendant));
+    CREATE INDEX IF NOT EXISTS user_tree_descendant ON USER_TREE(descendant, depth);
+    ''' + USER_TREE_FILL + ''';
+    CREATE TRIGGER IF NOT EXISTS USERS_tree_INSERT AFTER INSERT ON USERS
+    BEGIN
+        INSERT INTO USER_TREE(ancestor, descendant, depth)
+            VALUES (new.id, new.id, 0);
+        INSERT INTO USER_TREE(ancestor, descendant, depth)
+            SELECT ancestor, new.id, depth + 1 FROM USER_TREE
+                WHERE descendant = new.boss;
+    END;
+    CREATE TRIGGER IF NOT EXISTS USERS_tree_cycle BEFORE UPDATE OF boss ON USERS
+        WHEN new.boss IS NOT NULL
+    BEGIN
+        SELECT RAISE(ABORT, 'boss is a member of the team of the user')
+            WHERE EXISTS (SELECT 1 FROM USER_TREE
+                          WHERE ancestor = new.id AND descendant = new.boss);
+    END;
+    CREATE TRIGGER IF NOT EXISTS USERS_tree_UPDATE AFTER UPDATE OF boss ON USERS
+        WHEN old.boss IS NOT new.boss
+    BEGIN
+        DELETE FROM USER_TREE
+            WHERE descendant IN (SELECT descendant FROM USER_TREE
+                                 WHERE ancestor = new.id)
+              AND ancestor IN (SELECT ancestor FROM USER_TREE
+                               WHERE descendant = new.id AND depth > 0);
+        INSERT INTO USER_TREE(ancestor, descendant, depth)
+            SELECT boss.ancestor, team.descendant, boss.depth + team.depth + 1
+                FROM USER_TREE AS boss, USER_TREE AS team
+                WHERE boss.descendant = new.boss AND team.ancestor = new.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS USERS_tree_DELETE AFTER DELETE ON USERS
+    BEGIN
+        DELETE FROM USER_TREE WHERE descendant = old.id OR ancestor = old.id;
+    END;
+    ''',
+    #9: The document of a new task gets the comments already stored for it
+    #(imported before the task with deferred foreign keys: the comment
+    #trigger found no document to update). The documents indexed without
+    #their comments are repaired.
+    '''
+    DROP TRIGGER IF EXISTS TASKS_search_INSERT;
+    CREATE TRIGGER TASKS_search_INSERT AFTER INSERT ON TASKS
+    BEGIN
+        INSERT INTO TASKS_SEARCH(rowid, title, description, comments)
+            VALUES (new.id, new.title, new.description,
+                    (SELECT group_concat(comment, ' ') FROM COMMENTS
+                        WHERE task_id = new.id));
+    END;
+    UPDATE TASKS_SEARCH SET comments =
+        (SELECT group_concat(comment, ' ') FROM COMMENTS
+            WHERE task_id = TASKS_SEARCH.rowid)
+        WHERE comments IS NULL
+          AND rowid IN (SELECT task_id FROM COMMENTS);
+    ''',
+]
+
+#Sort keys of get_tasks and iter_tasks (prefixed with - for descending
+#order) and the TASKS column of each one. Ties are broken by id.
+TASK_SORT_KEYS = {'id': 'id', 'priority': 'priority', 'status': 'status',
+                  'category': 'category', 'date': 'created_date'}
+#Formats accepted by the created_after and created_before filters
+TASK_DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']
+
+#Weights of the title, description and comments columns in the bm25 rank
+#of search_tasks
+SEARCH_WEIGHTS = (10.0, 5.0, 1.0)
+#Markers of the matched terms in the snippets, and words per snippet
+SEARCH_SNIPPET_MARKERS = ('<b>', '</b>', '...')
+SEARCH_SNIPPET_WORDS = 12
+DEFAULT_SEARCH_LIMIT = 20
+
+#PRAGMAs executed once when a new connection is opened by the pool
+CONNECTION_PRAGMAS = ['PRAGMA foreign_keys = ON']
+
+
+class ConnectionPool(object):
+    '''
+    Pool of SQLite connections to the same database file.
+
+    Connections are checked out with acquire() and given back with release().
+    At most size connections are opened; when all of them are in use
+    acquire() blocks until another thread releases one or timeout seconds
+    have passed. A connection is only used by one thread at a time, so the
+    pool can be shared by all the threads of the server.
+
+    With a profiler (profiling.QueryProfiler) the connections are opened as
+    profiling.TracingConnection and report every statement to it.
+    '''
+    #ProjectDatabase.connection() commits each call (see SingleConnectionPool)
+    savepoints = False
+
+    def __init__(self, db_path, size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_POOL_TIMEOUT, profiler=None):
+        super(ConnectionPool, self).__init__()
+        if size < 1:
+            raise ValueError('Pool size must be at least 1')
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self.profiler = profiler
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._factories = (None, None)
+        self._generation = 0
+        self._generations = {}
+
+    def _connect(self):
+        '''
+        Open a new connection and run CONNECTION_PRAGMAS on it.
+        '''
+        if self.profiler is None:
+            con = sqlite3.connect(self.db_path, check_same_thread=False)
+        else:
+            con = sqlite3.connect(self.db_path, check_same_thread=False,
+                                  factory=profiling.TracingConnection)
+        for pragma in CONNECTION_PRAGMAS:
+            con.execute(pragma)
+        if self.profiler is not None:
+            #After the pragmas: they belong to no ProjectDatabase call
+            con.profiler = self.profiler
+        #Defaults restored when the connection goes back to the pool
+        self._factories = (con.row_factory, con.text_factory)
+        with self._lock:
+            self._generations[id(con)] = self._generation
+        return con
+
+    def acquire(self):
+        '''
+        Check out a connection. Reuses an idle connection if there is one,
+        otherwise opens a new one while the pool is not full.
+        '''
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    return self._connect()
+                except:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            #Wait in short steps: a stale connection closed by release()
+            #frees a slot without putting anything in the idle queue.
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise sqlite3.OperationalError('Timed out waiting for a connection')
+            try:
+                return self._idle.get(timeout=min(remaining, 0.1))
+            except queue.Empty:
+                pass
+
+    def release(self, con):
+        '''
+        Give a connection back to the pool. Any transaction left open is
+        rolled back and the factories changed by the caller are restored.
+        Connections opened before the last close() are closed instead.
+        '''
+        with self._lock:
+            stale = self._generations.pop(id(con), None) != self._generation
+            if stale:
+                self._opened -= 1
+            else:
+                self._generations[id(con)] = self._generation
+        if stale:
+            con.close()
+            return
+        con.rollback()
+        con.row_factory, con.text_factory = self._factories
+        self._idle.put_nowait(con)
+
+    def close(self):
+        '''
+        Close all the idle connections. Connections still checked out are
+        closed when they are released. The pool can still be used afterwards
+        and will open new connections on demand.
+        '''
+        with self._lock:
+            self._generation += 1
+        while True:
+            try:
+                con = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._generations.pop(id(con), None)
+                self._opened -= 1
+            con.close()
+
+
+class SingleConnectionPool(object):
+    '''
+    Stand-in for ConnectionPool around one connection given by the caller
+    (ProjectDatabase(connection=...)), for instance a connection whose
+    transaction the tests roll back.
+
+    The connection is switched to autocommit mode (isolation_level None):
+    ProjectDatabase.connection() then wraps each call in a SAVEPOINT instead
+    of committing, so the changes stay inside a transaction opened by the
+    caller with BEGIN and end with its COMMIT or ROLLBACK. Methods that run
+    executescript (migrate, load_init_values, rebuild_task_stats) commit
+    that transaction, as the sqlite3 module commits before a script.
+
+    acquire() may be nested and is serialized between threads. close() does
+    not close the connection, which belongs to the caller.
+    '''
+    savepoints = True
+
+    def __init__(self, con):
+        super(SingleConnectionPool, self).__init__()
+        con.isolation_level = None
+        self.con = con
+        self.size = 1
+        self.profiler = None
+        self._factories = (con.row_factory, con.text_factory)
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    def acquire(self):
+        self._lock.acquire()
+        self._depth += 1
+        return self.con
+
+    def release(self, con):
+        self._depth -= 1
+        if self._depth == 0:
+            con.row_factory, con.text_factory = self._factories
+        self._lock.release()
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def _savepoint(con):
+    '''
+    Run a with block in a savepoint that is released when it ends normally
+    and rolled back if it raises
+    '''
+    con.execute('SAVEPOINT project_db')
+    try:
+        yield
+    except:
+        con.execute('ROLLBACK TO project_db')
+        con.execute('RELEASE project_db')
+        raise
+    con.execute('RELEASE project_db')
+
+
+class LookupCache(object):
+    '''
+    Bounded LRU cache for the point lookups of ProjectDatabase.
+
+    Keys are (kind, key) pairs, for instance ('user_id', 'Seppo') or
+    ('task', 1). Every invalidation increases a generation number; a value
+    read from the database is only stored if no invalidation happened since
+    the read started, so a slow reader cannot put back a stale value.
+    '''
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        super(LookupCache, self).__init__()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, kind, key):
+        '''
+        Return (True, value) on a hit and (False, None) on a miss
+        '''
+        with self._lock:
+            try:
+                value = self._data.pop((kind, key))
+            except KeyError:
+                self.misses += 1
+                return False, None
+            #Move to the most recently used end
+            self._data[(kind, key)] = value
+            self.hits += 1
+            return True, value
+
+    def put(self, kind, key, value, generation):
+        '''
+        Store value if there was no invalidation since generation was read
+        '''
+        if self.size < 1:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data.pop((kind, key), None)
+            self._data[(kind, key)] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, kind, key):
+        with self._lock:
+            self.generation += 1
+            self._data.pop((kind, key), None)
+
+    def invalidate_value(self, kind, value):
+        '''
+        Drop the entries of kind whose cached value is value
+        '''
+        with self._lock:
+            self.generation += 1
+            for cache_key in [k for k, v in self._data.items()
+                              if k[0] == kind and v == value]:
+                del self._data[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        entries=len(self._data), size=self.size)
+
+
+def _task_key(task_id):
+    '''
+    Cache key of a task id. The REST API passes ids as strings, which
+    SQLite matches with the integer ids, so they share the same entry.
+    Returns None if task_id is not an integer.
+    '''
+    try:
+        return int(task_id)
+    except (TypeError, ValueError):
+        return None
+
+def _match_expression(query):
+    '''
+    FTS5 MATCH expression for the free text query of search_tasks: every
+    word quoted as a string (so that FTS5 syntax in the text cannot fail),
+    keeping a trailing * as a prefix query. None if there are no words.
+    '''
+    terms = []
+    for word in (query or '').split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append('"%s"%s' % (word.replace('"', '""'),
+                                     '*' if prefix else ''))
+    if not terms:
+        return None
+    return ' '.join(terms)
+
+def parse_task_date(value):
+    '''
+    created_date text (as stored by SQLite) of a date filter, or None if
+    value is not in one of TASK_DATE_FORMATS
+    '''
+    for format in TASK_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, format).strftime('%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def _task_query(after_id=None, before_id=None, sort=None, status=None,
+                category=None, priority=None, created_after=None,
+                created_before=None):
+    '''
+    SELECT statement (without LIMIT) and parameters of get_tasks and
+    iter_tasks, and whether the rows are read backwards and must be
+    reversed. None if the sort key or a filter value is wrong.
+    '''
+    sort = sort or 'id'
+    descending = sort.startswith('-')
+    column = TASK_SORT_KEYS.get(sort[1:] if descending else sort)
+    if column is None:
+        return None
+    terms = []
+    pvalue = []
+    for name, values, allowed in [('status', status, TASK_LEVELS),
+                                  ('category', category, TASK_CATEGORIES),
+                                  ('priority', priority, TASK_LEVELS)]:
+        if values is None:
+            continue
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        if not values or any(value not in allowed for value in values):
+            return None
+        terms.append('%s IN (%s)' % (name, ','.join('?' * len(values))))
+        pvalue.extend(values)
+    for value, operator in [(created_after, '>='), (created_before, '<')]:
+        if value is None:
+            continue
+        value = parse_task_date(value)
+        if value is None:
+            return None
+        terms.append('created_date %s ?' % operator)
+        pvalue.append(value)
+
+    #Keyset pagination: the rows following (or preceding) the cursor task
+    #in the sort order. Walking backwards reads in the opposite order.
+    backwards = before_id is not None
+    cursor = before_id if backwards else after_id
+    if cursor is not None:
+        operator = '>' if backwards == descending else '<'
+        if column == 'id':
+            terms.append('id %s ?' % operator)
+        else:
+            terms.append('(%s, id) %s (SELECT %s, id FROM tasks WHERE id = ?)'
+                         % (column, operator, column))
+        pvalue.append(cursor)
+    order = 'DESC' if backwards != descending else 'ASC'
+    stmnt = 'SELECT * FROM tasks'
+    if terms:
+        stmnt += ' WHERE ' + ' AND '.join(terms)
+    if column == 'id':
+        stmnt += ' ORDER BY id %s' % order
+    else:
+        stmnt += ' ORDER BY %s %s, id %s' % (column, order, order)
+    return stmnt, tuple(pvalue), backwards
+
+def invalidates(kind, by_value=False):
+    '''
+    Decorator for the write methods of ProjectDatabase. After the method
+    has run (and committed), the cache entry of kind for the first argument
+    is dropped; with by_value the entries whose value is the first argument
+    are dropped instead.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, arg, *args, **kwargs):
+            try:
+                return method(self, arg, *args, **kwargs)
+            finally:
+                if by_value:
+                    self.cache.invalidate_value(kind, arg)
+                elif kind == 'task':
+                    self.cache.invalidate(kind, _task_key(arg))
+                else:
+                    self.cache.invalidate(kind, arg)
+        return wrapper
+    return decorator
+
+
 class ProjectDatabase(object):
     '''API to access project DB'''
  
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, pool_size=DEFAULT_POOL_SIZE,
+                 cache_size=DEFAULT_CACHE_SIZE, check_data_version=True,
+                 profiler=None, connection=None, read_replica=False,
+                 read_your_writes=False,
+                 replica_max_lag=replica.DEFAULT_MAX_LAG,
+                 version_check_interval=DEFAULT_VERSION_CHECK_INTERVAL):
         super(ProjectDatabase, self).__init__()
         if db_path is not None:
             self.db_path = db_path
         else:
             self.db_path = DEFAULT_DB_PATH
+        if connection is not None:
+            #All the calls share the given connection (see
+            #SingleConnectionPool); db_path is then only used by clean()
+            self.pool = SingleConnectionPool(connection)
+            check_data_version = False
+        else:
+            self.pool = ConnectionPool(self.db_path, pool_size,
+                                       profiler=profiler)
+        #Cache of get_user_id and get_task. Writes made through this
+        #instance invalidate their entries; with check_data_version the
+        #whole cache is also dropped when PRAGMA data_version shows that
+        #another connection (or process) has written to the database. That
+        #is checked at most once every version_check_interval seconds.
+        self.cache = LookupCache(cache_size)
+        self.check_data_version = check_data_version
+        self.version_check_interval = version_check_interval
+        self._version_con = None
+        self._data_version = None
+        self._version_checked = None
+        self._version_lock = threading.Lock()
+        #In-memory copy of the file serving the get_* methods, see replica.py
+        #for its consistency. Not used with an injected connection.
+        self.replica = None
+        if read_replica and connection is None:
+            self.replica = replica.ReadReplica(self.db_path, replica_max_lag,
+                                               read_your_writes,
+                                               on_refresh=self.cache.clear)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Check out a connection from the pool for the duration of a with
+        block. The block runs inside a transaction that is committed when
+        it ends normally and rolled back if it raises. With an injected
+        connection the block runs in a savepoint instead.
+        '''
+        con = self.pool.acquire()
+        try:
+            if self.pool.savepoints:
+                with _savepoint(con):
+                    yield con
+            else:
+                with con:
+                    yield con
+        finally:
+            self.pool.release(con)
+
+    @contextmanager
+    def read_connection(self):
+        '''
+        Connection of the get_* methods: the in-memory replica if there is
+        one, else a pooled connection as connection()
+        '''
+        if self.replica is None:
+            with self.connection() as con:
+                yield con
+        else:
+            with self.replica.connection() as con:
+                yield con
+
+    def close(self):
+        '''
+        Close all the connections opened by this instance.
+        '''
+        self.pool.close()
+        if self.replica is not None:
+            self.replica.close()
+        with self._version_lock:
+            if self._version_con is not None:
+                self._version_con.close()
+                self._version_con = None
+        self.cache.clear()
+
+    def enable_profiling(self, profiler=None):
+        '''
+        Trace the statements run from now on with profiler (a new
+        profiling.QueryProfiler by default) and return it. The idle
+        connections of the pool are closed so that the next ones are opened
+        as tracing connections. The lookup cache is not cleared: cached
+        get_task and get_user_id calls run no statement.
+        '''
+        if profiler is None:
+            profiler = profiling.QueryProfiler(self.db_path)
+        self.pool.profiler = profiler
+        self.pool.close()
+        return profiler
+
+    def disable_profiling(self):
+        '''
+        Stop tracing statements and return the profiler that was used
+        (None if profiling was not enabled)
+        '''
+        profiler = self.pool.profiler
+        self.pool.profiler = None
+        self.pool.close()
+        if profiler is not None:
+            profiler.close()
+        return profiler
+
+    def get_cache_stats(self):
+        '''
+        Return the hits, misses, entries and size of the lookup cache
+        '''
+        return self.cache.stats()
+
+    def _cache_generation(self):
+        '''
+        Drop the cache if the database was modified by another connection
+        since the last check, and return the cache generation to be used
+        when storing a value read from the database.
+
+        The check uses a dedicated connection, so writes made through the
+        pool also clear the cache. It runs at most once every
+        version_check_interval seconds: in between, the cache hits take no
+        lock and run no statement, and the writes of other connections are
+        seen up to version_check_interval seconds late (the write methods
+        of this instance invalidate their entries at once).
+
+        With a read replica the values are read from the copy, so the cache
+        follows the copy instead: the replica is brought up to date as for
+        a read, and every refresh clears the cache. A cached value is then
+        never older than the copy would be.
+        '''
+        if self.replica is not None:
+            self.replica.update()
+        if self.check_data_version and self.cache.size > 0:
+            now = time.time()
+            if self._version_checked is not None and \
+               now - self._version_checked < self.version_check_interval:
+                return self.cache.generation
+            with self._version_lock:
+                self._version_checked = now
+                if self._version_con is None:
+                    self._version_con = sqlite3.connect(self.db_path,
+                                                        check_same_thread=False)
+                version = self._version_con.execute(
+                    'PRAGMA data_version').fetchone()[0]
+                if version != self._data_version:
+                    if self._data_version is not None:
+                        self.cache.clear()
+                    self._data_version = version
+        return self.cache.generation
 
 
     #Setting up the database. Used for the tests.
@@ -22,6 +955,7 @@ class ProjectDatabase(object):
         '''
         Purge the database removing old values.
         '''
+        self.close()
         os.remove(self.db_path)
 
     def load_init_values(self):
@@ -30,6 +964,120 @@ class ProjectDatabase(object):
         '''
         self.create_tables_from_schema()
         self.load_table_values_from_dump()
+        self.migrate()
+
+    def get_schema_version(self):
+        '''
+        Return the schema version of the database (PRAGMA user_version)
+        '''
+        with self.connection() as con:
+            return con.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self, target=None):
+        '''
+        Upgrade the database in place by applying the pending MIGRATIONS in
+        order. Every step runs in its own transaction together with the
+        update of PRAGMA user_version, so an interrupted migration can just
+        be run again. target is the version to stop at; by default all the
+        steps are applied.
+        Returns the new schema version.
+        '''
+        if target is None:
+            target = len(MIGRATIONS)
+        with self.connection() as con:
+            version = con.execute('PRAGMA user_version').fetchone()[0]
+            while version < target:
+                #executescript commits any pending transaction first, so
+                #the step opens and commits its own.
+                try:
+                    con.executescript('BEGIN; %s; PRAGMA user_version = %d; COMMIT;'
+                                      % (MIGRATIONS[version], version + 1))
+                except:
+                    #The transaction was opened by the script, not by the
+                    #sqlite3 module, so con.rollback() may not end it.
+                    try:
+                        con.execute('ROLLBACK')
+                    except sqlite3.OperationalError:
+                        pass
+                    raise
+                version += 1
+        if self.replica is not None:
+            #The schema of the copy may have changed
+            self.replica.close()
+        return version
+
+    def get_table_versions(self, tables):
+        '''
+        Return a dict with the (version, modified) pair of each of the given
+        tables (USERS, TASKS, ASSIGNED_TO, COMMENTS). version grows on every
+        write to the table; modified is the UTC time of the last write as a
+        datetime. Only the CHANGES table is read.
+        '''
+        stmnt = 'SELECT table_name, version, modified FROM CHANGES \
+                    WHERE table_name IN (%s)' % ','.join('?' * len(tables))
+        with self.read_connection() as con:
+            cur = con.cursor()
+            cur.execute(stmnt, tuple(tables))
+            versions = {}
+            for row in cur:
+                modified = datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S')
+                versions[row[0]] = (row[1], modified)
+            return versions
+
+    def get_changes(self, after_id=0, limit=None):
+        '''
+        Return the changes to tasks, comments and assignments logged after
+        the event after_id, oldest first, at most limit of them. Each change
+        is a dict with event_id, kind (task, comment or assignment), action
+        (created, updated or deleted), task_id, item_id (the comment id or
+        the user id of an assignment, else None), nickname (of the assigned
+        user, None if it has been deleted) and date.
+        '''
+        stmnt = 'SELECT event_id, kind, action, task_id, item_id, \
+                        changed_date, nickname \
+                 FROM change_log LEFT JOIN users \
+                    ON kind = \'assignment\' AND users.id = item_id \
+                 WHERE event_id > ? ORDER BY event_id'
+        pvalue = (after_id,)
+        if limit is not None:
+            stmnt += ' LIMIT ?'
+            pvalue += (limit,)
+        with self.read_connection() as con:
+            cur = con.cursor()
+            cur.execute(stmnt, pvalue)
+            return [dict(event_id=row[0], kind=row[1], action=row[2],
+                         task_id=row[3], item_id=row[4], date=row[5],
+                         nickname=row[6])
+                    for row in cur]
+
+    def get_change_bounds(self):
+        '''
+        Return (first, last): the id of the oldest change kept in the log
+        (last + 1 if the log is empty) and the id of the last change ever
+        logged (0 if there is none). Reading after an event older than
+        first - 1 has missed the changes removed by trim_changes.
+        '''
+        with self.read_connection() as con:
+            cur = con.cursor()
+            first = cur.execute('SELECT min(event_id) FROM change_log').fetchone()[0]
+            last = cur.execute("SELECT seq FROM sqlite_sequence \
+                                    WHERE name = 'CHANGE_LOG'").fetchone()
+            last = last[0] if last is not None else 0
+            if first is None:
+                first = last + 1
+            return first, last
+
+    def trim_changes(self, keep):
+        '''
+        Delete all but the last keep changes from the log.
+        Returns the number of changes deleted.
+        '''
+        stmnt = 'DELETE FROM change_log WHERE event_id <= \
+                    (SELECT max(event_id) FROM change_log) - ?'
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute(stmnt, (keep,))
+            return cur.rowcount
 
     def create_tables_from_schema(self, schema=None):
         '''
@@ -37,11 +1085,11 @@ class ProjectDatabase(object):
         schema contains the path to the .sql schema file. If it is None,
         DEFAULT_SCHEMA is used instead.
         '''
-        con = sqlite3.connect(self.db_path)
         if schema is None:
             schema = DEFAULT_SCHEMA
         with open (schema) as f:
             sql = f.read()
+        with self.connection() as con:
             cur = con.cursor()
             cur.executescript(sql)
 
@@ -51,21 +1099,19 @@ class ProjectDatabase(object):
         dump is the  path to the .sql dump file. If it is None,
         DEFAULT_DATA_DUMP is used instead.
         '''
-        con = sqlite3.connect(self.db_path)
         if dump is None:
             dump = DEFAULT_DATA_DUMP
         with open (dump) as f:
             sql = f.read()
+        with self.connection() as con:
             cur = con.cursor()
             cur.executescript(sql)
 
+    @invalidates('user_id')
     def update_username(self, old_username, new_username):
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = 'UPDATE users SET nickname=? WHERE nickname=?'
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (new_username, old_username)
             cur.execute(stmnt, pvalue)
             if cur.rowcount < 1:
@@ -74,31 +1120,31 @@ class ProjectDatabase(object):
 
  
     def get_users(self):
-        keys_on = 'PRAGMA foreign_keys = ON'
+        return list(self._iter_users(self.read_connection))
+
+    def iter_users(self):
+        '''
+        Generator variant of get_users. Rows are read lazily from the cursor;
+        the pooled connection is held until the generator is exhausted or
+        closed. The iter_* methods never use the replica, which serves one
+        reader at a time.
+        '''
+        return self._iter_users(self.connection)
+
+    def _iter_users(self, connection):
         stmnt = "SELECT nickname FROM USERS"
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             cur.execute(stmnt)
-            rows = cur.fetchall()
-            if cur.rowcount is None:
-                return False
-            users = []
-            for row in rows:
-                nickname = dict(nickname=row[0])
-                users.append(nickname)
-            return users
+            for row in cur:
+                yield dict(nickname=row[0])
 
     def get_user(self, user_id):
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = "SELECT nickname FROM USERS \
                     WHERE id = ?"
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.read_connection() as con:
             con.row_factory = sqlite3.Row
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (user_id,)
             cur.execute(stmnt, pvalue)
             row = cur.fetchone()
@@ -108,14 +1154,11 @@ class ProjectDatabase(object):
             return nickname
 
     def get_role(self, user_id):
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = "SELECT role FROM USERS \
                     WHERE id = ?"
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.read_connection() as con:
             con.row_factory = sqlite3.Row
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (user_id,)
             cur.execute(stmnt, pvalue)
             row = cur.fetchone()
@@ -125,113 +1168,185 @@ class ProjectDatabase(object):
             return role
 
     def add_user(self, nickname, email, role, boss):
-        keys_on = 'PRAGMA foreign_keys = ON'
         if role not in ['member', 'leader']:
             return False
         stmnt = "INSERT INTO USERS (nickname, email, role, boss) VALUES (?,?,?,?)"
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (nickname, email, role, boss)
             cur.execute(stmnt, pvalue)
             if cur.rowcount < 1:
                 return False
             return True
 
+    @invalidates('user_id', by_value=True)
     def delete_user(self, user_id):
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = "DELETE FROM USERS WHERE id=?"
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (user_id,)
             cur.execute(stmnt, pvalue)
             if cur.rowcount < 0:
                 return False
             return True
 
-    def get_team(self, leader_id):
-        keys_on = 'PRAGMA foreign_keys = ON'
-        stmnt = "SELECT nickname FROM USERS WHERE boss=? OR id=?"
-        con = sqlite3.connect(self.db_path)
-        with con:
+    def get_team(self, leader_id, depth=1):
+        '''
+        Nicknames of the leader and of the members of the team, down to
+        depth levels (1: the direct reports, None: everyone under the
+        leader). See get_hierarchy.
+        '''
+        team = self.get_hierarchy(leader_id, depth)
+        if team is False:
+            return False
+        return [dict(nickname=member['nickname']) for member in team]
+
+    def get_hierarchy(self, leader_id, depth=None):
+        '''
+        The leader and everyone under them down to depth levels (None for
+        all the levels), read from the USER_TREE closure table in a single
+        query. Returns a list of dicts with user_id, nickname, boss and depth
+        (0 for the leader, 1 for the direct reports...), ordered by depth
+        and user id; an empty list if the leader does not exist. Returns
+        False if depth is not None or an integer of at least 0.
+        '''
+        if depth is not None and (not isinstance(depth, (int, long)) or depth < 0):
+            return False
+        stmnt = 'SELECT id, nickname, boss, depth \
+                 FROM user_tree JOIN users ON users.id = descendant \
+                 WHERE ancestor = ?'
+        pvalue = (leader_id,)
+        if depth is not None:
+            stmnt += ' AND depth <= ?'
+            pvalue += (depth,)
+        stmnt += ' ORDER BY depth, id'
+        with self.read_connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
-            pvalue = (leader_id, leader_id)
             cur.execute(stmnt, pvalue)
-            rows = cur.fetchall()
-            if cur.rowcount is None:
-                return False
-            team = []
-            for row in rows:
-                nickname = dict(nickname=row[0])
-                team.append(nickname)
-            return team
+            return [dict(user_id=row[0], nickname=row[1], boss=row[2],
+                         depth=row[3])
+                    for row in cur]
+
+    def get_chain_of_command(self, user_id):
+        '''
+        The bosses of the user, from the direct boss up to the top of the
+        hierarchy, in a single query on the USER_TREE closure table. Returns
+        a list of dicts with user_id, nickname and depth (1 for the direct
+        boss); an empty list if the user has no boss or does not exist.
+        '''
+        stmnt = 'SELECT id, nickname, depth \
+                 FROM user_tree JOIN users ON users.id = ancestor \
+                 WHERE descendant = ? AND depth > 0 ORDER BY depth'
+        with self.read_connection() as con:
+            cur = con.cursor()
+            cur.execute(stmnt, (user_id,))
+            return [dict(user_id=row[0], nickname=row[1], depth=row[2])
+                    for row in cur]
+
+    def rebuild_user_tree(self):
+        '''
+        Fill the USER_TREE closure table again from the boss column, e.g.
+        after importing users before their bosses: the insert trigger only
+        copies the bosses of a boss already stored. Returns True.
+        '''
+        with self.connection() as con:
+            con.execute('DELETE FROM USER_TREE')
+            con.execute(USER_TREE_FILL)
+        if self.replica is not None:
+            #USER_TREE is rewritten without a new CHANGES version
+            self.replica.close()
+        return True
 
     def add_to_team(self, user_id, leader_id):
-        keys_on = 'PRAGMA foreign_keys = ON'
+        '''
+        Make leader_id the boss of user_id. Returns False if the leader is
+        the user or a member of their team (directly or not).
+        '''
         stmnt = "UPDATE USERS SET boss=? WHERE id=?"
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (leader_id, user_id)
-            cur.execute(stmnt, pvalue)
+            try:
+                cur.execute(stmnt, pvalue)
+            except sqlite3.IntegrityError:
+                #USERS_tree_cycle trigger
+                return False
             if cur.rowcount < 0:
                 return False
             return True
 
     def remove_from_team(self, user_id, leader_id):
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = "UPDATE USERS SET boss=NULL WHERE id=? AND boss=?"
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (user_id, leader_id)
             cur.execute(stmnt, pvalue)
             if cur.rowcount < 0:
                 return False
             return True
 
+    def add_to_team_by_nickname(self, nickname, leader_id):
+        '''
+        Same as add_to_team but the member is given by nickname, so no
+        get_user_id call is needed. Returns None if the nickname does not
+        exist and False if the leader is in the team of the user (the
+        USERS_tree_cycle trigger refuses the change).
+        '''
+        stmnt = "UPDATE USERS SET boss=? WHERE nickname=?"
+        with self.connection() as con:
+            cur = con.cursor()
+            pvalue = (leader_id, nickname)
+            try:
+                cur.execute(stmnt, pvalue)
+            except sqlite3.IntegrityError:
+                return False
+            if cur.rowcount < 1:
+                return None
+            return True
+
+    def remove_from_team_by_nickname(self, nickname, leader_id):
+        '''
+        Same as remove_from_team but the member is given by nickname.
+        Returns False if there is no member with that nickname in the team.
+        '''
+        stmnt = "UPDATE USERS SET boss=NULL WHERE nickname=? AND boss=?"
+        with self.connection() as con:
+            cur = con.cursor()
+            pvalue = (nickname, leader_id)
+            cur.execute(stmnt, pvalue)
+            if cur.rowcount < 1:
+                return False
+            return True
+
+    @invalidates('task')
     def update_title(self, task_id, title):
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = 'UPDATE tasks SET title=? WHERE id=?'
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (title, task_id)
             cur.execute(stmnt, pvalue)
             if cur.rowcount < 1:
                 return False
             return True
 
+    @invalidates('task')
     def update_description(self, task_id, description):
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = 'UPDATE tasks SET description=? WHERE id=?'
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (description, task_id)
             cur.execute(stmnt, pvalue)
             if cur.rowcount < 1:
                 return False
             return True
 
+    @invalidates('task')
     def update_category(self, task_id, category):
-        allowed = ["frontend", "backend", "UX", "bug"]
-        if category not in allowed:
+        if category not in TASK_CATEGORIES:
             return False
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = 'UPDATE tasks SET category=? WHERE id=?'
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (category, task_id)
             cur.execute(stmnt, pvalue)
             if cur.rowcount < 1:
@@ -240,39 +1355,69 @@ class ProjectDatabase(object):
 
 
     def get_user_id(self, username):
-        keys_on = 'PRAGMA foreign_keys = ON'
+        '''
+        Return the id of the user with nickname username, or False. Served
+        from the lookup cache when possible.
+        '''
+        generation = self._cache_generation()
+        found, userid = self.cache.get('user_id', username)
+        if found:
+            return userid
         stmnt = "SELECT id FROM users \
                     WHERE nickname = ?"
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.read_connection() as con:
             con.row_factory = sqlite3.Row
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (username,)
             cur.execute(stmnt, pvalue)
             row = cur.fetchone()
             if row is None:
                 return False
             userid = row[0]
-            return userid
+        self.cache.put('user_id', username, userid, generation)
+        return userid
  
     def remove_assignee(self, task_id, user_id):
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = "DELETE FROM assigned_to WHERE user_id=? AND task_id=?"
         pvalue = (user_id, task_id)
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             cur.execute(stmnt,pvalue)
             if cur.rowcount < 1:
                 return False
             return True
  
+    def remove_assignee_by_nickname(self, task_id, nickname):
+        '''
+        Same as remove_assignee but the user is given by nickname
+        '''
+        stmnt = "DELETE FROM assigned_to WHERE task_id=? AND \
+                    user_id=(SELECT id FROM users WHERE nickname=?)"
+        pvalue = (task_id, nickname)
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute(stmnt,pvalue)
+            if cur.rowcount < 1:
+                return False
+            return True
+
+    def assign_to_task_by_nickname(self, task_id, nickname):
+        '''
+        Same as assign_to_task but the user is given by nickname. Returns
+        False if the nickname does not exist.
+        '''
+        stmnt = "INSERT INTO assigned_to SELECT id, ? FROM users WHERE nickname=?"
+        with self.connection() as con:
+            cur = con.cursor()
+            pvalue = (task_id, nickname)
+            cur.execute(stmnt, pvalue)
+            if cur.rowcount < 1:
+                return False
+            return True
+
     def assign_to_task(self, task_id, user_id):
         '''Assign user to task'''
          
-        keys_on = 'PRAGMA foreign_keys = ON'
         check = "SELECT * FROM assigned_to WHERE user_id=? AND task_id=?"
         stmnt = "INSERT INTO assigned_to VALUES(?,?)"
  
@@ -289,39 +1434,54 @@ class ProjectDatabase(object):
         #     if cur.rowcount is not None:
         #         return False
         #     con.close()
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (user_id, task_id)
             cur.execute(stmnt, pvalue)
             return True
 
     def get_assigned_users(self, task_id):
-        keys_on = 'PRAGMA foreign_keys = ON'
+        return list(self._iter_assigned_users(self.read_connection, task_id))
+
+    def iter_assigned_users(self, task_id):
+        '''Generator variant of get_assigned_users'''
+        return self._iter_assigned_users(self.connection, task_id)
+
+    def _iter_assigned_users(self, connection, task_id):
         stmnt = "SELECT user_id FROM assigned_to WHERE task_id=?"
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (task_id,)
             cur.execute(stmnt, pvalue)
-            rows = cur.fetchall()
-            if cur.rowcount is None:
-                return False
-            users = []
-            for row in rows:
-                user = dict(user=row[0])
-                users.append(user)
-            return users
+            for row in cur:
+                yield dict(user=row[0])
+
+    def get_assignees(self, task_id):
+        '''
+        Get the users assigned to a task with their user data in one query.
+        Every item contains user (the id), nickname, email and role.
+        '''
+        return list(self._iter_assignees(self.read_connection, task_id))
+
+    def iter_assignees(self, task_id):
+        '''Generator variant of get_assignees'''
+        return self._iter_assignees(self.connection, task_id)
+
+    def _iter_assignees(self, connection, task_id):
+        stmnt = "SELECT users.id, users.nickname, users.email, users.role \
+                    FROM assigned_to JOIN users ON users.id = assigned_to.user_id \
+                    WHERE assigned_to.task_id=?"
+        with connection() as con:
+            cur = con.cursor()
+            pvalue = (task_id,)
+            cur.execute(stmnt, pvalue)
+            for row in cur:
+                yield dict(user=row[0], nickname=row[1], email=row[2], role=row[3])
 
     def add_comment(self, comment, task_id):
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = 'INSERT INTO COMMENTS(comment, task_id) VALUES(?,?)'
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (comment, task_id)
             cur.execute(stmnt, pvalue)
             if cur.rowcount < 0:
@@ -330,83 +1490,299 @@ class ProjectDatabase(object):
 
     def get_comments(self, task_id):
         '''Get all comments'''
-        keys_on = 'PRAGMA foreign_keys = ON'
+        return list(self._iter_comments(self.read_connection, task_id))
+
+    def iter_comments(self, task_id):
+        '''Generator variant of get_comments'''
+        return self._iter_comments(self.connection, task_id)
+
+    def _iter_comments(self, connection, task_id):
         stmnt = 'SELECT comment_id, comment, commented_date FROM comments WHERE task_id=?'
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (task_id,)
             cur.execute(stmnt,pvalue)
-            rows = cur.fetchall()
-            if cur.rowcount is None:
-                return False
-            comments = []
-            for row in rows:
-                comment = dict(comment_id=row[0], comment=row[1], date=row[2])
-                comments.append(comment)
-            return comments
+            for row in cur:
+                yield dict(comment_id=row[0], comment=row[1], date=row[2])
  
     def delete_comment(self, comment_id):
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = "DELETE FROM comments WHERE comment_id=?"
         pvalue = (comment_id,)
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             cur.execute(stmnt,pvalue)
             if cur.rowcount < 1:
                 return False
             return True
  
     def get_task(self, task_id):
-        '''Get task'''
-        keys_on = 'PRAGMA foreign_keys = ON'
+        '''Get task. Served from the lookup cache when possible.'''
+        key = _task_key(task_id)
+        generation = self._cache_generation()
+        if key is not None:
+            found, task = self.cache.get('task', key)
+            if found:
+                return dict(task)
         stmnt = 'SELECT * FROM tasks WHERE id=?'
 
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.read_connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (task_id,)
             cur.execute(stmnt,pvalue)
             row = cur.fetchone()
             if row is None:
                 return False
             task = dict(task_id=row[0], title=row[1], category=row[2], description=row[3], priority=row[4], status=row[5], date=row[6])
-            return task
+        if key is not None:
+            self.cache.put('task', key, dict(task), generation)
+        return task
+
+    def get_tasks(self, limit=None, after_id=None, before_id=None, sort=None,
+                  **filters):
+        '''
+        Get tasks ordered by id. Without arguments all the tasks are returned.
 
-    def get_tasks(self):
-        '''Get all tasks'''
-        keys_on = 'PRAGMA foreign_keys = ON'
-        stmnt = 'SELECT * FROM tasks'
-        con = sqlite3.connect(self.db_path)
-        con.text_factory = str #To avoid UTF-8 encoding problem
-        with con:
+        Keyset pagination: limit is the maximum number of tasks returned,
+        after_id returns the tasks following that id and before_id the tasks
+        preceding it (still in ascending order). Every page is found through
+        the primary key, so it costs the same whatever its position.
+
+        sort is one of TASK_SORT_KEYS, prefixed with - for descending order;
+        ties are broken by id. after_id and before_id then refer to the
+        position of that task in the sort order, so the task must exist.
+
+        filters, all optional: status, category and priority (a value or a
+        list of values), created_after (inclusive) and created_before
+        (exclusive) in one of TASK_DATE_FORMATS. They are served by the
+        indexes of migration 4.
+
+        Returns False if sort or a filter value is wrong.
+        '''
+        query = _task_query(after_id, before_id, sort, **filters)
+        if query is None:
+            return False
+        stmnt, pvalue, backwards = query
+        if limit is not None:
+            stmnt += ' LIMIT ?'
+            pvalue += (limit,)
+        with self.read_connection() as con:
+            con.text_factory = str #To avoid UTF-8 encoding problem
             cur = con.cursor()
-            cur.execute(keys_on)
-            cur.execute(stmnt)
+            cur.execute(stmnt, pvalue)
             rows = cur.fetchall()
             if rows is None:
                 return False
+            if backwards:
+                rows.reverse()
             tasks = []
             for row in rows:
                 task = dict(task_id=row[0], title=row[1], category=row[2], description=row[3], priority=row[4], status=row[5], date=row[6])
                 tasks.append(task)
             return tasks
 
+    def iter_tasks(self, after_id=None, sort=None, **filters):
+        '''
+        Generator variant of get_tasks. Returns an iterator over all the
+        tasks, or the tasks following after_id, in sort order while reading
+        them from the cursor. sort and filters are those of get_tasks.
+        Returns False if sort or a filter value is wrong.
+        '''
+        query = _task_query(after_id, None, sort, **filters)
+        if query is None:
+            return False
+        return self._iter_tasks(*query[:2])
+
+    def _iter_tasks(self, stmnt, pvalue):
+        with self.connection() as con:
+            con.text_factory = str #To avoid UTF-8 encoding problem
+            cur = con.cursor()
+            cur.execute(stmnt, pvalue)
+            for row in cur:
+                yield dict(task_id=row[0], title=row[1], category=row[2], description=row[3], priority=row[4], status=row[5], date=row[6])
+
+    def search_tasks(self, query, limit=DEFAULT_SEARCH_LIMIT):
+        '''
+        Full-text search of the tasks by title, description and comments.
+
+        query is free text; every word must appear in the task (in any of
+        the columns) and a word ending in * matches as a prefix. Other FTS5
+        operators are not interpreted.
+
+        Returns at most limit tasks, best match first, as the dicts of
+        get_tasks with two more keys: rank, the bm25 score (higher is
+        better, see SEARCH_WEIGHTS), and snippet, a fragment of the best
+        matching column with the matched words between
+        SEARCH_SNIPPET_MARKERS. Returns False if query has no words or limit
+        is not a positive integer.
+        '''
+        match = _match_expression(query)
+        if match is None or not isinstance(limit, int) or limit < 1:
+            return False
+        stmnt = 'SELECT tasks.*, -bm25(tasks_search, ?, ?, ?), \
+                    snippet(tasks_search, -1, ?, ?, ?, ?) \
+                 FROM tasks_search JOIN tasks ON tasks.id = tasks_search.rowid \
+                 WHERE tasks_search MATCH ? \
+                 ORDER BY bm25(tasks_search, ?, ?, ?) LIMIT ?'
+        pvalue = SEARCH_WEIGHTS + SEARCH_SNIPPET_MARKERS + \
+                 (SEARCH_SNIPPET_WORDS, match) + SEARCH_WEIGHTS + (limit,)
+        with self.connection() as con:
+            #Snippets are rendered as JSON, replace bytes that are not UTF-8
+            con.text_factory = lambda value: value.decode('utf-8', 'replace')
+            cur = con.cursor()
+            cur.execute(stmnt, pvalue)
+            return [dict(task_id=row[0], title=row[1], category=row[2], description=row[3], priority=row[4], status=row[5], date=row[6], rank=row[7], snippet=row[8])
+                    for row in cur]
+
+    def get_task_stats(self):
+        '''
+        Return the task counts maintained by the triggers of migration 7:
+        a dict with total, status, category and priority (dicts from each
+        value to the number of tasks) and assignees, a list of dicts with
+        user, nickname, tasks (the number of assignments of the user) and
+        status (by status of the task), ordered by user id. Users without
+        assignments are not listed.
+        '''
+        stats = {'total': 0, 'status': {}, 'category': {}, 'priority': {},
+                 'assignees': []}
+        with self.read_connection() as con:
+            cur = con.cursor()
+            cur.execute('SELECT dimension, value, count FROM task_stats')
+            for dimension, value, count in cur:
+                if dimension == 'total':
+                    stats['total'] = count
+                elif dimension == 'category':
+                    stats['category'][value] = count
+                else:
+                    stats[dimension][int(value)] = count
+            cur.execute('SELECT user_id, nickname, status, count \
+                         FROM assignee_stats JOIN users ON users.id = user_id \
+                         ORDER BY user_id, status')
+            for user_id, nickname, status, count in cur:
+                if not stats['assignees'] or stats['assignees'][-1]['user'] != user_id:
+                    stats['assignees'].append(dict(user=user_id, nickname=nickname,
+                                                   tasks=0, status={}))
+                assignee = stats['assignees'][-1]
+                assignee['tasks'] += count
+                assignee['status'][status] = count
+        return stats
+
+    def rebuild_task_stats(self):
+        '''
+        Recount the statistics of get_task_stats from the TASKS and
+        ASSIGNED_TO tables, e.g. after writing them with the triggers
+        disabled. Returns True.
+        '''
+        with self.connection() as con:
+            try:
+                con.executescript('BEGIN; %s COMMIT;' % TASK_STATS_REBUILD)
+            except:
+                #See migrate
+                try:
+                    con.execute('ROLLBACK')
+                except sqlite3.OperationalError:
+                    pass
+                raise
+        if self.replica is not None:
+            #TASK_STATS is rewritten without a new CHANGES version
+            self.replica.close()
+        return True
+
+    def _rows_since(self, stmnt, pvalue, limit):
+        '''
+        Run one of the SELECT statements of the get_*_since methods, whose
+        first columns are seq and deleted, adding the LIMIT.
+        '''
+        if limit is not None:
+            stmnt += ' LIMIT ?'
+            pvalue += (limit,)
+        with self.read_connection() as con:
+            con.text_factory = str #To avoid UTF-8 encoding problem
+            cur = con.cursor()
+            cur.execute(stmnt, pvalue)
+            return cur.fetchall()
+
+    def get_tasks_since(self, since, limit=None):
+        '''
+        Delta sync: tasks created, updated or deleted after the modification
+        sequence number since (0 returns all the tasks), in sequence order,
+        at most limit of them. The seq of the last one is the value of since
+        for the next call.
+
+        Returns a list of dicts with seq and deleted. The tasks that exist
+        have the keys of get_tasks; the deleted ones (tombstones) only
+        task_id.
+        '''
+        stmnt = 'SELECT sync_rows.seq, sync_rows.deleted, sync_rows.row_id, tasks.* \
+                 FROM sync_rows LEFT JOIN tasks ON tasks.id = sync_rows.row_id \
+                 WHERE table_name = \'TASKS\' AND parent_id = 0 AND seq > ? \
+                 ORDER BY seq'
+        tasks = []
+        for row in self._rows_since(stmnt, (since,), limit):
+            if row[1]:
+                tasks.append(dict(seq=row[0], deleted=True, task_id=row[2]))
+            else:
+                tasks.append(dict(seq=row[0], deleted=False, task_id=row[2], title=row[4], category=row[5], description=row[6], priority=row[7], status=row[8], date=row[9]))
+        return tasks
+
+    def get_users_since(self, since, limit=None):
+        '''
+        Delta sync of the users, see get_tasks_since. The dicts have seq,
+        deleted, user_id and nickname (the last one for deleted users). A
+        renamed user comes back with the same user_id and the new nickname.
+        '''
+        stmnt = 'SELECT seq, deleted, row_id, name FROM sync_rows \
+                 WHERE table_name = \'USERS\' AND parent_id = 0 AND seq > ? \
+                 ORDER BY seq'
+        return [dict(seq=row[0], deleted=bool(row[1]), user_id=row[2],
+                     nickname=row[3])
+                for row in self._rows_since(stmnt, (since,), limit)]
+
+    def get_comments_since(self, task_id, since, limit=None):
+        '''
+        Delta sync of the comments of a task, see get_tasks_since. The dicts
+        have seq, deleted and the keys of get_comments (only comment_id for
+        deleted comments).
+        '''
+        stmnt = 'SELECT sync_rows.seq, sync_rows.deleted, sync_rows.row_id, \
+                        comment, commented_date \
+                 FROM sync_rows LEFT JOIN comments \
+                    ON comments.comment_id = sync_rows.row_id \
+                 WHERE table_name = \'COMMENTS\' AND parent_id = ? AND seq > ? \
+                 ORDER BY seq'
+        comments = []
+        for row in self._rows_since(stmnt, (task_id, since), limit):
+            if row[1]:
+                comments.append(dict(seq=row[0], deleted=True, comment_id=row[2]))
+            else:
+                comments.append(dict(seq=row[0], deleted=False, comment_id=row[2], comment=row[3], date=row[4]))
+        return comments
+
+    def get_assignees_since(self, task_id, since, limit=None):
+        '''
+        Delta sync of the assignees of a task, see get_tasks_since. The
+        dicts have seq, deleted and the keys of get_assignees (only user for
+        removed assignees).
+        '''
+        stmnt = 'SELECT sync_rows.seq, sync_rows.deleted, sync_rows.row_id, \
+                        nickname, email, role \
+                 FROM sync_rows LEFT JOIN users ON users.id = sync_rows.row_id \
+                 WHERE table_name = \'ASSIGNED_TO\' AND parent_id = ? AND seq > ? \
+                 ORDER BY seq'
+        assignees = []
+        for row in self._rows_since(stmnt, (task_id, since), limit):
+            if row[1]:
+                assignees.append(dict(seq=row[0], deleted=True, user=row[2]))
+            else:
+                assignees.append(dict(seq=row[0], deleted=False, user=row[2], nickname=row[3], email=row[4], role=row[5]))
+        return assignees
 
-    
+    @invalidates('task')
     def update_priority(self, task_id, priority):
-        keys_on = 'PRAGMA foreign_keys = ON'
-        if priority not in [1, 2, 3, 4]:
+        if priority not in TASK_LEVELS:
             return False
         stmnt = 'UPDATE tasks SET priority=? WHERE id=?'
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (priority,task_id)
             cur.execute(stmnt,pvalue)
             if cur.rowcount < 0:
@@ -414,29 +1790,25 @@ class ProjectDatabase(object):
             return True
         
 
+    @invalidates('task')
     def remove_task(self, task_id):
         ##ON DELETE CASCADE NOT WORKING?
-        keys_on = 'PRAGMA foreign_keys = ON'
         stmnt = 'DELETE FROM tasks WHERE id=?'
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (task_id,)
             cur.execute(stmnt,pvalue)
             if cur.rowcount < 1:
                 return False
             return True
 
+    @invalidates('task')
     def update_status(self, task_id, status):
-        keys_on = 'PRAGMA foreign_keys = ON'
-        if status not in [1, 2, 3, 4]:
+        if status not in TASK_LEVELS:
             return False
         stmnt = 'UPDATE tasks SET status=? WHERE id=?'
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (status, task_id)
             cur.execute(stmnt,pvalue)
             if cur.rowcount<1:
@@ -444,26 +1816,82 @@ class ProjectDatabase(object):
             return True
 
     def add_task(self, title, category, description, priority, status):
-        keys_on = 'PRAGMA foreign_keys = ON'
-        if status not in [1, 2, 3, 4]:
+        if status not in TASK_LEVELS:
             return False
-        elif priority not in [1, 2, 3, 4]:
+        elif priority not in TASK_LEVELS:
             return False
-        elif category not in ["frontend", "backend", "UX", "bug"]:
+        elif category not in TASK_CATEGORIES:
             return False
         stmnt = 'INSERT INTO TASKS(title, category, description, priority, status) VALUES(?,?,?,?,?)'
         #TODO: Add check for integrity error
-        con = sqlite3.connect(self.db_path)
-        with con:
+        with self.connection() as con:
             cur = con.cursor()
-            cur.execute(keys_on)
             pvalue = (title, category, description, priority, status)
             cur.execute(stmnt, pvalue)
             if cur.rowcount < 1:
                 return False
             return True
 
-    # def modify_task(self, title, category, desc, assigned_to, priority, status):
-    #
-    #     pass
-    #Added update_title, update_description, update_category separetely    -Nemo
+    def add_tasks(self, rows):
+        '''
+        Insert many tasks with executemany in a single transaction. rows is
+        a list of dicts with title, category, description, priority and
+        status. Either all the tasks are inserted or none of them.
+        Returns the list of the new task ids in the same order as rows, or
+        False if any row has wrong values.
+        '''
+        pvalues = []
+        for row in rows:
+            if row['status'] not in TASK_LEVELS:
+                return False
+            elif row['priority'] not in TASK_LEVELS:
+                return False
+            elif row['category'] not in TASK_CATEGORIES:
+                return False
+            pvalues.append((row['title'], row['category'], row['description'],
+                            row['priority'], row['status']))
+        if not pvalues:
+            return []
+        stmnt = 'INSERT INTO TASKS(title, category, description, priority, status) VALUES(?,?,?,?,?)'
+        #AUTOINCREMENT ids are consecutive inside the transaction, so the
+        #ids are derived from the last one assigned.
+        last = "SELECT seq FROM sqlite_sequence WHERE name='TASKS'"
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.executemany(stmnt, pvalues)
+            if cur.rowcount < len(pvalues):
+                return False
+            last_id = cur.execute(last).fetchone()[0]
+            return list(range(last_id - len(pvalues) + 1, last_id + 1))
+
+    @invalidates('task')
+    def update_task(self, task_id, **fields):
+        '''
+        Update any of title, description, category, priority and status of a
+        task with a single UPDATE in one transaction. Either all the given
+        fields are written or none of them.
+        Returns False if a field is unknown or has a wrong value, or if the
+        task does not exist.
+        '''
+        validators = {
+            'title': lambda value: bool(value),
+            'description': lambda value: value is not None,
+            'category': lambda value: value in TASK_CATEGORIES,
+            'priority': lambda value: value in TASK_LEVELS,
+            'status': lambda value: value in TASK_LEVELS,
+        }
+        if not fields:
+            return False
+        for name, value in fields.items():
+            if name not in validators or not validators[name](value):
+                return False
+        columns = sorted(fields)
+        stmnt = 'UPDATE tasks SET %s WHERE id=?' % \
+                ', '.join('%s=?' % column for column in columns)
+        with self.connection() as con:
+            cur = con.cursor()
+            pvalue = tuple(fields[column] for column in columns) + (task_id,)
+            cur.execute(stmnt, pvalue)
+            if cur.rowcount < 1:
+                return False
+            return True
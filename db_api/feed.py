@@ -0,0 +1,114 @@
+'''
+Change notifications for the change feed resource in resources.py.
+
+The changes are logged by triggers in the CHANGE_LOG table (see
+ProjectDatabase.get_changes). Instead of every watcher polling the
+database, a single thread per process reads the id of the last change every
+POLL_INTERVAL seconds and wakes up the requests waiting for a newer one.
+Writes made by other processes (pre-forked workers, the importer) are seen
+the same way.
+
+Every waiting request (a long poll, or a Server-Sent Events stream for its
+whole life) holds a server thread: a thread of the pool with
+ThreadPoolWSGIServer, a thread of its own with the event loop server. So
+that the watchers cannot take all the threads of a pool, a process serves
+at most max_watchers of them at the same time; the change feed answers the
+next ones with 503 until one of them ends.
+'''
+import os, threading, time
+
+#Seconds between two reads of the last change id
+POLL_INTERVAL = 0.5
+#Default of the watchers served at the same time by a process
+MAX_WATCHERS = 64
+
+
+class ChangeNotifier(object):
+    '''
+    Wakes up the threads waiting for changes newer than a given event id.
+
+    get_last_id is called without arguments from the polling thread and
+    returns the id of the last logged change. The thread is started by the
+    first wait(), and again in a process forked after it was started.
+
+    A request calls acquire() before it starts waiting and release() when it
+    is done; acquire() refuses more than max_watchers at the same time.
+    '''
+
+    def __init__(self, get_last_id, interval=POLL_INTERVAL,
+                 max_watchers=MAX_WATCHERS):
+        super(ChangeNotifier, self).__init__()
+        self._get_last_id = get_last_id
+        self.interval = interval
+        self.max_watchers = max_watchers
+        self.watchers = 0
+        self.last_id = None
+        self._condition = threading.Condition()
+        self._pid = None
+        self._stopped = None
+
+    def _start(self):
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.last_id = None
+            self._stopped = threading.Event()
+        thread = threading.Thread(target=self._poll, args=(self._stopped,))
+        thread.daemon = True
+        thread.start()
+
+    def acquire(self):
+        '''
+        Count a new watcher. Returns False if max_watchers are already
+        counted.
+        '''
+        with self._condition:
+            if self.watchers >= self.max_watchers:
+                return False
+            self.watchers += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.watchers -= 1
+
+    def stop(self):
+        '''
+        Stop the polling thread; the next wait() starts it again.
+        '''
+        with self._condition:
+            if self._stopped is not None:
+                self._stopped.set()
+            self._pid = None
+
+    def _poll(self, stopped):
+        while not stopped.is_set():
+            try:
+                last_id = self._get_last_id()
+            except Exception:
+                #The database may be missing or locked for a moment
+                last_id = None
+            if last_id is not None:
+                with self._condition:
+                    if last_id != self.last_id:
+                        self.last_id = last_id
+                        self._condition.notify_all()
+            stopped.wait(self.interval)
+
+    def wait(self, after_id, timeout):
+        '''
+        Block until a change newer than after_id has been logged or timeout
+        seconds have passed. Returns the id of the last change known, None
+        if the first poll has not finished before timeout.
+        '''
+        if self._pid != os.getpid():
+            self._start()
+        deadline = time.time() + timeout
+        with self._condition:
+            while self.last_id is None or self.last_id <= after_id:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self.last_id
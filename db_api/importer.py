@@ -0,0 +1,360 @@
+'''
+Streaming bulk importer for the project database.
+
+Loads users, tasks, comments and assignments from NDJSON (one JSON object
+per line) or CSV (with a header row) files. The file is read one row at a
+time and rows are inserted with executemany in batches of batch_size rows,
+one transaction per batch (one for the whole file with --defer-foreign-keys
+or --bulk), so memory use does not depend on the size of the file.
+
+Each inserted row fires the triggers of its table, which keep CHANGES,
+CHANGE_LOG, SYNC_ROWS, the full-text index, the task statistics and the
+team hierarchy up to date: several statements per row, which cost more
+than the insert itself. With --bulk the triggers are dropped for the load
+and their work is done once at the end, for all the rows, by set-based
+statements (see import_rows). The statistics and the hierarchy are then
+recounted from the whole tables, so --bulk pays off for large files; the
+database cannot be written by others until the load ends.
+
+From Python:
+
+import db_api.database, db_api.importer
+db = db_api.database.ProjectDatabase('db/project.db')
+db_api.importer.import_file(db, 'tasks', 'tasks.ndjson')
+
+From the command line (root directory):
+
+python -m db_api.importer [--db PATH] [--batch-size N] [--defer-foreign-keys]
+                          [--defer-indexes] [--bulk] TABLE FILE
+'''
+import argparse, csv, json, sqlite3, sys, time
+
+import database
+
+DEFAULT_BATCH_SIZE = 10000
+
+#Importable tables: name used in the API -> (SQL table, allowed columns)
+TABLES = {
+    'users': ('USERS', ['id', 'nickname', 'email', 'role', 'boss']),
+    'tasks': ('TASKS', ['id', 'title', 'category', 'description', 'priority',
+                        'status', 'created_date']),
+    'comments': ('COMMENTS', ['comment_id', 'comment', 'task_id',
+                              'commented_date']),
+    'assignments': ('ASSIGNED_TO', ['user_id', 'task_id']),
+}
+
+#ProjectDatabase methods that recount the tables maintained by triggers
+#from each table. They run after a load with deferred foreign keys: the
+#triggers of a row loaded before the rows it refers to did not see them.
+REBUILDS = {
+    'users': ['rebuild_user_tree'],
+    'tasks': ['rebuild_task_stats'],
+    'assignments': ['rebuild_task_stats'],
+}
+
+#How the triggers of each table write its rows to SYNC_ROWS (parent, key
+#and name) and to CHANGE_LOG (kind, task and item; users are not logged)
+TRIGGER_COLUMNS = {
+    'users': dict(table='USERS', parent='0', key='id', name='nickname'),
+    'tasks': dict(table='TASKS', parent='0', key='id', name='NULL',
+                  kind='task', task='id', item='NULL'),
+    'comments': dict(table='COMMENTS', parent='COMMENTS.task_id',
+                     key='comment_id', name='NULL', kind='comment',
+                     task='task_id', item='comment_id'),
+    'assignments': dict(table='ASSIGNED_TO', parent='ASSIGNED_TO.task_id',
+                        key='user_id', name='NULL', kind='assignment',
+                        task='task_id', item='user_id'),
+}
+
+#Statements of a bulk load (see import_rows) doing the work of the triggers
+#of the table for all the loaded rows at once. The loaded rows are the rows
+#without a live row in SYNC_ROWS (%(new)s), so SYNC_ROWS is written last.
+BULK_CHANGES = '''
+    UPDATE CHANGES SET version = version + 1, modified = CURRENT_TIMESTAMP
+        WHERE table_name = '%(table)s' '''
+BULK_LOG = '''
+    INSERT INTO CHANGE_LOG(kind, action, task_id, item_id)
+        SELECT '%(kind)s', 'created', %(task)s, %(item)s FROM %(table)s
+            WHERE %(new)s ORDER BY rowid'''
+BULK_SYNC = '''
+    INSERT OR REPLACE INTO SYNC_ROWS(table_name, parent_id, row_id, name, deleted)
+        SELECT '%(table)s', %(parent)s, %(key)s, %(name)s, 0 FROM %(table)s
+            WHERE %(new)s ORDER BY rowid'''
+NEW_ROWS = '''NOT EXISTS (SELECT 1 FROM SYNC_ROWS
+                    WHERE table_name = '%(table)s' AND parent_id = %(parent)s
+                      AND row_id = %(table)s.%(key)s AND NOT deleted)'''
+
+def _statements(script):
+    '''
+    The statements of a SQL script, to be run one by one inside the
+    transaction of a bulk load (executescript would commit it)
+    '''
+    return [stmnt for stmnt in script.split(';') if stmnt.strip()]
+
+#The full-text index, the task statistics and the team hierarchy
+BULK_DERIVED = {
+    'users': ['DELETE FROM USER_TREE', database.USER_TREE_FILL],
+    'tasks': ['''
+    INSERT INTO TASKS_SEARCH(rowid, title, description, comments)
+        SELECT id, title, description,
+               (SELECT group_concat(comment, ' ') FROM COMMENTS
+                    WHERE task_id = TASKS.id)
+        FROM TASKS WHERE %(new)s'''] +
+        _statements(database.TASK_STATS_REBUILD),
+    'comments': ['''
+    UPDATE TASKS_SEARCH SET comments =
+        (SELECT group_concat(comment, ' ') FROM COMMENTS
+            WHERE task_id = TASKS_SEARCH.rowid)
+        WHERE rowid IN (SELECT task_id FROM COMMENTS WHERE %(new)s)'''],
+    'assignments': _statements(database.TASK_STATS_REBUILD),
+}
+
+FORMATS = ['ndjson', 'csv']
+
+class DataImportError(Exception):
+    '''Raised when the input cannot be imported'''
+
+
+def read_ndjson(f):
+    '''
+    Yield one dict per non empty line of an NDJSON file
+    '''
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            raise DataImportError('Line %d is not valid JSON' % number)
+
+def read_csv(f):
+    '''
+    Yield one dict per row of a CSV file with a header. Empty values are
+    read as NULL.
+    '''
+    for row in csv.DictReader(f):
+        yield dict((key, value if value != '' else None)
+                   for key, value in row.items())
+
+def bulk_updates(table):
+    '''
+    The statements run at the end of a bulk load of table, in this order:
+    a single new CHANGES version, the created events of CHANGE_LOG, the
+    derived tables (BULK_DERIVED) and the rows of SYNC_ROWS.
+    '''
+    values = dict(TRIGGER_COLUMNS[table])
+    values['new'] = NEW_ROWS % values
+    stmnts = [BULK_CHANGES % values]
+    if 'kind' in values:
+        stmnts.append(BULK_LOG % values)
+    #USER_TREE_FILL and TASK_STATS_REBUILD have no % to escape
+    stmnts += [stmnt % values for stmnt in BULK_DERIVED[table]]
+    stmnts.append(BULK_SYNC % values)
+    return stmnts
+
+def import_rows(db, table, rows, batch_size=DEFAULT_BATCH_SIZE,
+                defer_foreign_keys=False, defer_indexes=False, bulk=False,
+                progress=None):
+    '''
+    Insert the dicts produced by rows into table (one of TABLES).
+
+    The columns are the keys of the first row; later rows missing a column
+    insert NULL, and a later row with a key that is not a column of the
+    first row is an error. With defer_foreign_keys the foreign key checks
+    are disabled during the load, which then runs in a single transaction,
+    and PRAGMA foreign_key_check runs before it is committed; with
+    defer_indexes the secondary indexes of the table are dropped and built
+    again after the last row. progress is called with the number of rows
+    inserted so far after every batch. After a deferred load the tables
+    derived from table are rebuilt (REBUILDS).
+
+    Every inserted row fires the triggers of table, which write CHANGES,
+    CHANGE_LOG, SYNC_ROWS, the full-text index, the task statistics or the
+    team hierarchy: several statements per row. With bulk the triggers are
+    dropped, the load runs in a single transaction and the statements of
+    bulk_updates do their work for all the rows at once before they are
+    created again and it is committed. Other connections never see the
+    table without its triggers, but cannot write until the load ends.
+
+    Returns a dict with rows, seconds and rows_per_second.
+    Raises DataImportError if the table or the columns are unknown or if
+    foreign keys are violated at the end of a deferred load. On any error
+    the batch being inserted is rolled back; the batches committed before
+    it are kept, except with defer_foreign_keys or bulk, where nothing is
+    kept.
+    '''
+    if table not in TABLES:
+        raise DataImportError('Unknown table %s' % table)
+    sql_table, allowed = TABLES[table]
+    rows = iter(rows)
+    start = time.time()
+    count = 0
+    try:
+        first = next(rows)
+    except StopIteration:
+        return dict(rows=0, seconds=0.0, rows_per_second=0.0)
+    columns = [column for column in allowed if column in first]
+    unknown = set(first) - set(allowed)
+    if unknown or not columns:
+        raise DataImportError('Unknown columns for %s: %s'
+                              % (table, ', '.join(sorted(unknown))))
+    known = set(columns)
+    stmnt = 'INSERT INTO %s(%s) VALUES(%s)' % \
+            (sql_table, ', '.join(columns), ','.join('?' * len(columns)))
+
+    with db.connection() as con:
+        cur = con.cursor()
+        indexes = []
+        if defer_indexes:
+            cur.execute("SELECT name, sql FROM sqlite_master WHERE type='index' \
+                            AND tbl_name=? AND sql IS NOT NULL", (sql_table,))
+            indexes = cur.fetchall()
+            for name, sql in indexes:
+                cur.execute('DROP INDEX %s' % name)
+            con.commit()
+        if defer_foreign_keys:
+            #Only has effect outside a transaction
+            cur.execute('PRAGMA foreign_keys = OFF')
+        single = defer_foreign_keys or bulk
+        if bulk:
+            #The triggers are dropped and created again inside the
+            #transaction: without isolation_level the sqlite3 module neither
+            #begins it nor commits it before the DDL statements
+            isolation_level = con.isolation_level
+            con.isolation_level = None
+        def insert(batch):
+            cur.executemany(stmnt, batch)
+            #A single transaction is committed after the last row
+            if not single:
+                con.commit()
+            if progress is not None:
+                progress(count + len(batch))
+            return count + len(batch)
+        try:
+            if bulk:
+                cur.execute('BEGIN IMMEDIATE')
+                cur.execute("SELECT name, sql FROM sqlite_master \
+                                WHERE type='trigger' AND tbl_name=?",
+                            (sql_table,))
+                triggers = cur.fetchall()
+                for name, sql in triggers:
+                    cur.execute('DROP TRIGGER %s' % name)
+            batch = [tuple(first.get(column) for column in columns)]
+            for number, row in enumerate(rows, 2):
+                if not known.issuperset(row):
+                    raise DataImportError('Row %d of %s has columns that are not in the first row: %s'
+                                          % (number, table,
+                                             ', '.join(sorted(set(row) - known))))
+                batch.append(tuple(row.get(column) for column in columns))
+                if len(batch) >= batch_size:
+                    count = insert(batch)
+                    batch = []
+            if batch:
+                count = insert(batch)
+            if defer_foreign_keys:
+                #The pragma as a table-valued function: a SELECT, so the
+                #sqlite3 module does not commit before running it
+                violations = cur.execute('SELECT count(*) FROM pragma_foreign_key_check(?)',
+                                         (sql_table,)).fetchone()[0]
+                if violations:
+                    raise DataImportError('%d rows of %s violate foreign keys'
+                                          % (violations, table))
+            if bulk:
+                for bulk_stmnt in bulk_updates(table):
+                    cur.execute(bulk_stmnt)
+                for name, sql in triggers:
+                    cur.execute(sql)
+                cur.execute('COMMIT')
+            else:
+                con.commit()
+        except:
+            if bulk:
+                #An error may have ended the transaction already
+                try:
+                    cur.execute('ROLLBACK')
+                except sqlite3.OperationalError:
+                    pass
+            else:
+                con.rollback()
+            raise
+        finally:
+            if bulk:
+                con.isolation_level = isolation_level
+            if defer_foreign_keys:
+                cur.execute('PRAGMA foreign_keys = ON')
+            for name, sql in indexes:
+                cur.execute(sql)
+            con.commit()
+    #A bulk load has already rebuilt them
+    if defer_foreign_keys and not bulk:
+        for method in REBUILDS.get(table, []):
+            getattr(db, method)()
+
+    seconds = time.time() - start
+    return dict(rows=count, seconds=seconds,
+                rows_per_second=count / seconds if seconds else 0.0)
+
+def import_file(db, table, path, format=None, **kwargs):
+    '''
+    Import a NDJSON or CSV file into table. format is guessed from the file
+    extension (.csv is CSV, anything else NDJSON) if it is None. The other
+    arguments are passed to import_rows.
+    '''
+    if format is None:
+        format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    if format not in FORMATS:
+        raise DataImportError('Unknown format %s' % format)
+    reader = read_csv if format == 'csv' else read_ndjson
+    with open(path, 'rb' if format == 'csv' and sys.version_info[0] < 3
+                    else 'r') as f:
+        return import_rows(db, table, reader(f), **kwargs)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Stream users, tasks, comments or assignments from a '
+                    'NDJSON or CSV file into the project database.')
+    parser.add_argument('table', choices=sorted(TABLES))
+    parser.add_argument('path')
+    parser.add_argument('--db', default=database.DEFAULT_DB_PATH,
+                        help='database file (default %(default)s)')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='input format (default: from the extension)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='rows per transaction (default %(default)s)')
+    parser.add_argument('--defer-foreign-keys', action='store_true',
+                        help='check foreign keys once after the load')
+    parser.add_argument('--defer-indexes', action='store_true',
+                        help='rebuild the indexes of the table after the load')
+    parser.add_argument('--bulk', action='store_true',
+                        help='drop the triggers of the table during the load '
+                             'and update the tables they maintain once after '
+                             'it, in a single transaction')
+    args = parser.parse_args(argv)
+
+    db = database.ProjectDatabase(args.db)
+    start = time.time()
+    def progress(count):
+        elapsed = time.time() - start
+        sys.stderr.write('%d rows, %.0f rows/s\n'
+                         % (count, count / elapsed if elapsed else 0.0))
+    try:
+        db.migrate()
+        stats = import_file(db, args.table, args.path, format=args.format,
+                            batch_size=args.batch_size,
+                            defer_foreign_keys=args.defer_foreign_keys,
+                            defer_indexes=args.defer_indexes,
+                            bulk=args.bulk, progress=progress)
+    except (DataImportError, sqlite3.IntegrityError) as e:
+        #IntegrityError: a duplicate key, a broken CHECK or, without
+        #--defer-foreign-keys, a missing row
+        sys.stderr.write('Import failed: %s\n' % e)
+        return 1
+    finally:
+        db.close()
+    print('Imported %(rows)d rows in %(seconds).2f s (%(rows_per_second).0f rows/s)'
+          % stats)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,298 @@
+'''
+Request and database metrics in the Prometheus text format.
+
+resources.py times every request by endpoint name and wraps the
+ProjectDatabase of the request in an InstrumentedDatabase, which counts
+the calls, the returned rows, the errors and the time of each method. The
+SQL statements run by each method, their time and the rows they read or
+change are counted at the cursor level by StatementMetrics, the profiler
+of the connection pool (see profiling.py); the statements run on a read
+replica or outside an instrumented call are not counted. The number of
+database calls of each request (each one checks out a pooled connection)
+is recorded by endpoint. METRICS.render() returns all of it for the
+/metrics route.
+
+Every thread writes to its own ThreadStats without locking; render() adds
+up the stats of all the threads. The lock of the registry is only taken
+the first time a thread records something. The values are kept per
+process: with pre-forked workers (project.py --production) each worker
+reports its own requests.
+'''
+import bisect, threading, types
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+from timeit import default_timer as timer
+
+#Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+#Upper bounds of the histogram of database calls per request
+DB_CALLS_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#name -> (type, help, buckets of the histograms)
+SERIES = [
+    ('project_http_requests_total', 'counter',
+     'HTTP requests by endpoint, method and status', None),
+    ('project_http_request_duration_seconds', 'histogram',
+     'HTTP request latency by endpoint and method', LATENCY_BUCKETS),
+    ('project_http_request_db_calls', 'histogram',
+     'ProjectDatabase calls per HTTP request by endpoint', DB_CALLS_BUCKETS),
+    ('project_db_calls_total', 'counter',
+     'ProjectDatabase calls by method', None),
+    ('project_db_errors_total', 'counter',
+     'ProjectDatabase calls that raised an exception by method', None),
+    ('project_db_rows_total', 'counter',
+     'Items returned by ProjectDatabase methods', None),
+    ('project_db_seconds_total', 'counter',
+     'Time spent in ProjectDatabase methods', None),
+    ('project_db_statements_total', 'counter',
+     'SQL statements run by ProjectDatabase methods', None),
+    ('project_db_statement_seconds_total', 'counter',
+     'Time spent running the SQL statements of ProjectDatabase methods', None),
+    ('project_db_statement_rows_total', 'counter',
+     'Rows read or changed by the SQL statements of ProjectDatabase methods',
+     None),
+]
+BUCKETS = dict((name, buckets) for name, kind, help, buckets in SERIES)
+
+
+class ThreadStats(object):
+    '''
+    Counters and histograms written by a single thread. Keys are
+    (name, labels) with labels a tuple of (label, value) pairs; histograms
+    are [count per bucket (the last one is +Inf), sum, count].
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = [[0] * (len(BUCKETS[name]) + 1), 0, 0]
+            self.histograms[key] = histogram
+        histogram[0][bisect.bisect_left(BUCKETS[name], value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+class Metrics(object):
+    '''
+    Registry of the ThreadStats of every thread
+    '''
+
+    def __init__(self):
+        super(Metrics, self).__init__()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        #By thread ident: a new thread with the ident of a finished one
+        #keeps adding to its stats
+        self._threads = {}
+        #Labels of the ProjectDatabase method running in each thread
+        self._method = threading.local()
+        self.statements = StatementMetrics(self)
+
+    def stats(self):
+        '''
+        The ThreadStats of the calling thread
+        '''
+        try:
+            return self._local.stats
+        except AttributeError:
+            with self._lock:
+                stats = self._threads.setdefault(get_ident(), ThreadStats())
+            self._local.stats = stats
+            return stats
+
+    def method(self):
+        '''
+        Labels of the ProjectDatabase method running in the calling thread,
+        None outside an InstrumentedDatabase call
+        '''
+        return getattr(self._method, 'labels', None)
+
+    def set_method(self, labels):
+        '''
+        Set the labels returned by method() and return the previous ones
+        '''
+        previous = getattr(self._method, 'labels', None)
+        self._method.labels = labels
+        return previous
+
+    def clear(self):
+        with self._lock:
+            self._threads = {}
+            self._local = threading.local()
+
+    def collect(self):
+        '''
+        Sum of the stats of all the threads: (counters, histograms) as in
+        ThreadStats, histograms with cumulative bucket counts.
+        '''
+        with self._lock:
+            threads = list(self._threads.values())
+        counters = {}
+        histograms = {}
+        for stats in threads:
+            #items() copies the dict without letting the owner thread run
+            for key, value in stats.counters.items():
+                counters[key] = counters.get(key, 0) + value
+            for key, (buckets, total, count) in stats.histograms.items():
+                merged = histograms.setdefault(key, [[0] * len(buckets), 0, 0])
+                for n, value in enumerate(list(buckets)):
+                    merged[0][n] += value
+                merged[1] += total
+                merged[2] += count
+        for buckets, total, count in histograms.values():
+            for n in range(1, len(buckets)):
+                buckets[n] += buckets[n - 1]
+        return counters, histograms
+
+    def render(self):
+        '''
+        All the series in the Prometheus text exposition format
+        '''
+        counters, histograms = self.collect()
+        lines = []
+        for name, kind, help, bounds in SERIES:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if kind == 'counter':
+                for (key, labels), value in sorted(counters.items()):
+                    if key == name:
+                        lines.append('%s%s %s' % (name, _labels(labels),
+                                                  _number(value)))
+                continue
+            for (key, labels), (buckets, total, count) in sorted(histograms.items()):
+                if key != name:
+                    continue
+                for bound, value in zip(list(bounds) + ['+Inf'], buckets):
+                    le = bound if bound == '+Inf' else _number(bound)
+                    lines.append('%s_bucket%s %d'
+                                 % (name, _labels(labels + (('le', le),)), value))
+                lines.append('%s_sum%s %s' % (name, _labels(labels), _number(total)))
+                lines.append('%s_count%s %d' % (name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\')
+                                         .replace('"', '\\"').replace('\n', '\\n'))
+                             for label, value in labels)
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class StatementMetrics(object):
+    '''
+    Profiler (see profiling.TracingCursor) that counts the statements, their
+    time and their rows by the ProjectDatabase method that runs them
+    '''
+
+    def __init__(self, metrics):
+        super(StatementMetrics, self).__init__()
+        self._metrics = metrics
+
+    def record(self, sql, parameters, seconds, rows=0):
+        labels = self._metrics.method()
+        if labels is None:
+            return None
+        stats = self._metrics.stats()
+        stats.inc('project_db_statements_total', labels)
+        stats.inc('project_db_statement_seconds_total', labels, seconds)
+        if rows:
+            stats.inc('project_db_statement_rows_total', labels, rows)
+        #The rows read later are counted for the same method
+        return labels
+
+    def fetched(self, labels, rows):
+        self._metrics.stats().inc('project_db_statement_rows_total', labels,
+                                  rows)
+
+    def close(self):
+        pass
+
+
+class InstrumentedDatabase(object):
+    '''
+    Proxy of a ProjectDatabase that records the calls to its public methods
+    in metrics. calls and seconds are the totals of this proxy; resources.py
+    creates one per request.
+
+    If the connection pool of db has no profiler, metrics.statements is
+    set as its profiler, so that the statements are counted too.
+    '''
+
+    def __init__(self, db, metrics):
+        self._db = db
+        self._metrics = metrics
+        self.calls = 0
+        self.seconds = 0.0
+        if db.pool.profiler is None:
+            db.enable_profiling(metrics.statements)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._db, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        def method(*args, **kwargs):
+            labels = (('method', name),)
+            stats = self._metrics.stats()
+            previous = self._metrics.set_method(labels)
+            start = timer()
+            try:
+                result = attribute(*args, **kwargs)
+            except:
+                stats.inc('project_db_errors_total', labels)
+                raise
+            finally:
+                seconds = timer() - start
+                self._metrics.set_method(previous)
+                self.calls += 1
+                self.seconds += seconds
+                stats.inc('project_db_calls_total', labels)
+                stats.inc('project_db_seconds_total', labels, seconds)
+            if isinstance(result, types.GeneratorType):
+                return self._count_rows(result, labels)
+            if isinstance(result, (list, tuple)):
+                stats.inc('project_db_rows_total', labels, len(result))
+            elif isinstance(result, dict):
+                stats.inc('project_db_rows_total', labels)
+            return result
+        #The next lookups of the method do not go through __getattr__
+        self.__dict__[name] = method
+        return method
+
+    def _count_rows(self, rows, labels):
+        '''
+        Count the rows of an iter_* generator as they are consumed. Its
+        statements run while it is consumed, as part of the method.
+        '''
+        count = 0
+        try:
+            while True:
+                previous = self._metrics.set_method(labels)
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    break
+                finally:
+                    self._metrics.set_method(previous)
+                count += 1
+                yield row
+        finally:
+            self._metrics.stats().inc('project_db_rows_total', labels, count)
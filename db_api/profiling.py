@@ -0,0 +1,237 @@
+'''
+Statement tracing and query plan checks for ProjectDatabase (debug mode).
+
+The sqlite3 module of Python 2 has no set_trace_callback, so the pool opens
+its connections with TracingConnection, whose cursors time every execute
+and executemany and report them, and the rows they read or change, to a
+QueryProfiler. The profiler keeps the last statements, and the count, time
+and rows of each statement shape (the SQL with the whitespace collapsed). The first time a shape is seen its plan is
+read with EXPLAIN QUERY PLAN, and a full scan of one of SCAN_TABLES is
+logged as a warning and kept in the stats of the shape.
+
+EXPLAIN runs on a connection of its own: in the sqlite3 module of Python 2
+it would commit the transaction open on the traced connection.
+
+Enable it with ProjectDatabase(path, profiler=QueryProfiler(path)) or
+db.enable_profiling(); see db_test/database_api_tests_common.py for the
+test helper built on it.
+
+Any object with the record and fetched methods of QueryProfiler can be the
+profiler: metrics.StatementMetrics counts the statements by method for the
+/metrics route.
+'''
+import collections, logging, re, sqlite3, threading
+from timeit import default_timer as timer
+
+#Tables that must not be read with a full scan by the hot queries
+SCAN_TABLES = ['TASKS', 'COMMENTS', 'ASSIGNED_TO', 'USERS']
+#Number of statements kept by QueryProfiler.recent
+RECENT_STATEMENTS = 1000
+#Statements whose plan is read
+EXPLAINED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+LOGGER = logging.getLogger(__name__)
+#SCAN TABLE tasks (SQLite < 3.36) or SCAN tasks, with or without an index
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+#Lists of parameters of any length: IN (?,?,?)
+PARAMETER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+
+def shape(sql):
+    '''
+    The statement with the whitespace collapsed and the lists of
+    parameters reduced to one
+    '''
+    return PARAMETER_LIST.sub('?', WHITESPACE.sub(' ', sql).strip())
+
+
+class StatementStats(object):
+    '''
+    Count, time and rows (read or changed) of a statement shape, its plan
+    (the detail column of EXPLAIN QUERY PLAN, None if it was not read) and
+    the SCAN_TABLES it scans
+    '''
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.count = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.plan = None
+        self.scans = []
+
+
+class QueryProfiler(object):
+    '''
+    Collects the statements run on the TracingConnections of a database.
+    Shared by all the connections of a pool.
+    '''
+
+    def __init__(self, db_path, recent=RECENT_STATEMENTS,
+                 scan_tables=SCAN_TABLES):
+        super(QueryProfiler, self).__init__()
+        self.db_path = db_path
+        self.scan_tables = set(table.upper() for table in scan_tables)
+        self.statements = {}
+        self.recent = collections.deque(maxlen=recent)
+        self._lock = threading.Lock()
+        self._explain_con = None
+
+    def record(self, sql, parameters, seconds, rows=0):
+        '''
+        Called by the cursors after every statement, with the rows changed
+        by it. Returns the StatementStats passed to fetched.
+        '''
+        key = shape(sql)
+        with self._lock:
+            self.recent.append((sql, seconds))
+            stats = self.statements.get(key)
+            new = stats is None
+            if new:
+                stats = self.statements[key] = StatementStats(key)
+            stats.count += 1
+            stats.rows += rows
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            if new and key.split(' ', 1)[0].upper() in EXPLAINED:
+                self._explain(stats, sql, parameters)
+            return stats
+
+    def fetched(self, stats, rows):
+        '''
+        Called by the cursors when rows of the statement recorded as stats
+        are read
+        '''
+        with self._lock:
+            stats.rows += rows
+
+    def _explain(self, stats, sql, parameters):
+        try:
+            if self._explain_con is None:
+                self._explain_con = sqlite3.connect(self.db_path,
+                                                    check_same_thread=False)
+            rows = self._explain_con.execute('EXPLAIN QUERY PLAN ' + sql,
+                                             parameters).fetchall()
+        except sqlite3.Error as e:
+            #E.g. a table created by the traced transaction and not
+            #committed yet
+            LOGGER.debug('No plan for %s: %s', stats.sql, e)
+            return
+        stats.plan = [row[-1] for row in rows]
+        for detail in stats.plan:
+            match = SCAN.match(detail)
+            if match and match.group(1).upper() in self.scan_tables:
+                stats.scans.append(match.group(1))
+        if stats.scans:
+            LOGGER.warning('Full scan of %s: %s\n%s', ', '.join(stats.scans),
+                           stats.sql, '\n'.join(stats.plan))
+
+    def scans(self):
+        '''
+        The StatementStats of the shapes that scan one of the scan_tables
+        '''
+        with self._lock:
+            return [stats for stats in self.statements.values() if stats.scans]
+
+    def clear(self):
+        with self._lock:
+            self.statements = {}
+            self.recent.clear()
+
+    def close(self):
+        with self._lock:
+            if self._explain_con is not None:
+                self._explain_con.close()
+                self._explain_con = None
+
+    def report(self, limit=20):
+        '''
+        Text table of the limit statement shapes with the most total time
+        '''
+        with self._lock:
+            statements = sorted(self.statements.values(),
+                                key=lambda stats: -stats.seconds)[:limit]
+        lines = ['%8s %10s %10s %10s  %s' % ('count', 'rows', 'total ms',
+                                              'max ms', 'statement')]
+        for stats in statements:
+            lines.append('%8d %10d %10.3f %10.3f  %s%s'
+                         % (stats.count, stats.rows, stats.seconds * 1000,
+                            stats.max_seconds * 1000, stats.sql,
+                            '  [SCAN %s]' % ', '.join(stats.scans)
+                            if stats.scans else ''))
+        return '\n'.join(lines)
+
+
+class TracingCursor(sqlite3.Cursor):
+    '''
+    Cursor that reports its statements, and the rows read from them, to the
+    profiler of its connection, if it has one
+    '''
+    #What the profiler returned for the last statement
+    _recorded = None
+
+    def execute(self, sql, parameters=()):
+        profiler = self.connection.profiler
+        if profiler is None:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        start = timer()
+        try:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            #rowcount is -1 for the statements that change no row
+            self._recorded = profiler.record(sql, parameters, timer() - start,
+                                             max(self.rowcount, 0))
+
+    def executemany(self, sql, seq_of_parameters):
+        profiler = self.connection.profiler
+        if profiler is None:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        #The plan is read with the first row of parameters
+        rows = list(seq_of_parameters)
+        start = timer()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, rows)
+        finally:
+            self._recorded = profiler.record(sql, rows[0] if rows else (),
+                                             timer() - start,
+                                             max(self.rowcount, 0))
+
+    #fetchone and fetchall do not go through next
+    def fetchone(self):
+        row = sqlite3.Cursor.fetchone(self)
+        if row is not None:
+            self._fetched(1)
+        return row
+
+    def fetchmany(self, *size):
+        rows = sqlite3.Cursor.fetchmany(self, *size)
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = sqlite3.Cursor.fetchall(self)
+        self._fetched(len(rows))
+        return rows
+
+    def next(self):
+        row = sqlite3.Cursor.next(self)
+        self._fetched(1)
+        return row
+
+    def _fetched(self, rows):
+        if rows and self._recorded is not None:
+            self.connection.profiler.fetched(self._recorded, rows)
+
+
+class TracingConnection(sqlite3.Connection):
+    '''
+    Connection whose cursors, including the ones of execute and
+    executemany, are TracingCursors. Nothing is reported until profiler is
+    set.
+    '''
+    profiler = None
+
+    def cursor(self, factory=TracingCursor):
+        return sqlite3.Connection.cursor(self, factory)
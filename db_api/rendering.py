@@ -0,0 +1,118 @@
+'''
+Rendering helpers for the RESTful API in resources.py.
+
+URL templates: url_for is resolved once for every route, with placeholders
+in place of the variables, and later URLs are produced by string
+formatting. Building URLs with the werkzeug routing map for every item of a
+collection is much slower.
+
+Fragments: the invariant parts of the Collection+JSON envelopes (templates
+and static links) are encoded to JSON once and spliced into the responses
+as text, so only the items are serialized on each request.
+'''
+import json
+
+from werkzeug.urls import url_quote
+
+#Placeholder used for the variables when a URL template is resolved
+PLACEHOLDER = '__%s__'
+
+
+class UrlTemplates(object):
+    '''
+    URL templates of the routes of the application.
+
+    Routes are registered with the names of their variables and resolved by
+    compile(), which needs an application and request context because it
+    uses url_for. url() fills a template with quoted values.
+    '''
+
+    def __init__(self):
+        super(UrlTemplates, self).__init__()
+        self._routes = {}
+        self._templates = None
+
+    def register(self, endpoint, *names):
+        self._routes[endpoint] = names
+
+    def compile(self, build):
+        '''
+        Resolve all the registered routes. build is url_for or any function
+        with the same signature.
+        '''
+        templates = {}
+        for endpoint, names in self._routes.items():
+            url = build(endpoint,
+                        **dict((name, PLACEHOLDER % name) for name in names))
+            template = url.replace('%', '%%')
+            for name in names:
+                template = template.replace(PLACEHOLDER % name,
+                                            '%%(%s)s' % name)
+            templates[endpoint] = template
+        self._templates = templates
+
+    @property
+    def compiled(self):
+        return self._templates is not None
+
+    def url(self, endpoint, **values):
+        '''
+        URL of endpoint for the given values, quoted like url_for does
+        '''
+        return self._templates[endpoint] % \
+            dict((name, url_quote(value, safe='/:'))
+                 for name, value in values.items())
+
+
+def encode(value):
+    '''
+    Encode a value as a JSON fragment
+    '''
+    return json.dumps(value)
+
+def extend_links(links, extra):
+    '''
+    Append the link dicts in extra to links, a fragment with a JSON array
+    '''
+    if not extra:
+        return links
+    extra = ', '.join(encode(link) for link in extra)
+    if links == '[]':
+        return '[' + extra + ']'
+    return links[:-1] + ', ' + extra + ']'
+
+def collection_head(href, links=None, template=None, queries=None):
+    '''
+    JSON text of a Collection+JSON document up to the opening bracket of
+    the items array. links, template and queries are fragments; they are
+    left out if they are None.
+    '''
+    parts = ['"version": "1.0"', '"href": ' + encode(href)]
+    if links is not None:
+        parts.append('"links": ' + links)
+    if template is not None:
+        parts.append('"template": ' + template)
+    if queries is not None:
+        parts.append('"queries": ' + queries)
+    return '{"collection": {' + ', '.join(parts) + ', "items": ['
+
+#Closes the items array, the collection and the document
+COLLECTION_TAIL = ']}}'
+
+def iter_collection(head, items, chunk_items):
+    '''
+    Yield the text of a Collection+JSON document: head (see
+    collection_head), the items encoded chunk_items at a time and the tail.
+    '''
+    yield head
+    chunk = []
+    separator = ''
+    for item in items:
+        chunk.append(encode(item))
+        if len(chunk) >= chunk_items:
+            yield separator + ', '.join(chunk)
+            separator = ', '
+            chunk = []
+    if chunk:
+        yield separator + ', '.join(chunk)
+    yield COLLECTION_TAIL
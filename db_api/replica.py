@@ -0,0 +1,296 @@
+'''
+In-memory read replica of the project database.
+
+ProjectDatabase(path, read_replica=True) serves its get_* methods from a
+copy of the database kept in an in-memory SQLite connection; the writes
+and the iter_* generators (which stream rows to the client while holding
+their connection) still go to the file through the connection pool.
+
+The sqlite3 module of Python 2 has no backup API, and iterdump cannot
+restore the shadow tables of FTS5, so the copy is made with the file
+ATTACHed to the in-memory connection: the first load creates the tables
+and their indexes (no triggers: the replica is never written by the
+application) and copies all the rows. The full-text index is not copied;
+search_tasks reads the file.
+
+Refresh is incremental by table. The CHANGES versions tell which of
+USERS, TASKS, ASSIGNED_TO and COMMENTS were written; only those tables and
+the ones their triggers maintain (DEPENDENT_TABLES) are copied again. The
+LOG_TABLES only receive the rows past the last key copied, and lose the
+ones trimmed from the file.
+
+Consistency:
+
+ * Every refresh reads the file in one read transaction and is applied in
+   one transaction, under the lock that also serializes the reads: a read
+   always sees a state of the database that was committed at some point,
+   never a half-applied refresh.
+ * By default the replica is refreshed by the first read that comes more
+   than max_lag seconds after the last check, if PRAGMA data_version shows
+   that the file was written. Reads, including the reads that follow a
+   write made through the same ProjectDatabase, can then lag the file by
+   up to max_lag seconds (plus the time of a refresh).
+ * With read_your_writes the check is made before every read, so every
+   read sees all the transactions committed before it started, by this or
+   any other connection or process. It costs a PRAGMA per read and a
+   refresh after each write.
+ * The lookup cache of ProjectDatabase (get_task, get_user_id) follows the
+   copy: every lookup brings the copy up to date as a read would, and every
+   refresh clears the cache, so a cached value lags no more than a read.
+ * Reads are served one at a time by the single in-memory connection.
+'''
+import sqlite3, threading
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+#Seconds between two checks for changes without read_your_writes
+DEFAULT_MAX_LAG = 1.0
+#Tables copied again when the CHANGES version of the source table changes:
+#the table itself and the tables its triggers write
+DEPENDENT_TABLES = {
+    'USERS': ['USERS', 'USER_TREE', 'ASSIGNEE_STATS'],
+    'TASKS': ['TASKS', 'TASK_STATS', 'ASSIGNEE_STATS'],
+    'ASSIGNED_TO': ['ASSIGNED_TO', 'ASSIGNEE_STATS'],
+    'COMMENTS': ['COMMENTS'],
+}
+#Tables only appended to (or replaced into), by their increasing key
+LOG_TABLES = {'CHANGE_LOG': 'event_id', 'SYNC_ROWS': 'seq'}
+#Tables that are not copied
+SKIPPED_TABLES = ['sqlite_sequence', 'sqlite_stat1']
+
+
+class ReplicaConnection(sqlite3.Connection):
+    '''
+    Connection that keeps its cursors, including the ones of execute, until
+    close_cursors. A cursor left with rows to read keeps the transaction
+    of its connection, and the locks of the attached file, open.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.cursors = []
+
+    def cursor(self, factory=sqlite3.Cursor):
+        cursor = sqlite3.Connection.cursor(self, factory)
+        self.cursors.append(cursor)
+        return cursor
+
+    def close_cursors(self):
+        for cursor in self.cursors:
+            cursor.close()
+        self.cursors = []
+
+
+class ReadReplica(object):
+    '''
+    In-memory copy of the database file db_path, loaded by the first
+    connection() and refreshed as described in the module docstring.
+    on_refresh is called after every refresh that copied new data.
+    '''
+
+    def __init__(self, db_path, max_lag=DEFAULT_MAX_LAG,
+                 read_your_writes=False, on_refresh=None):
+        super(ReadReplica, self).__init__()
+        self.db_path = db_path
+        self.max_lag = max_lag
+        self.read_your_writes = read_your_writes
+        self.on_refresh = on_refresh
+        self.refreshes = 0
+        self._con = None
+        self._version_con = None
+        self._data_version = None
+        self._checked = None
+        self._versions = {}
+        self._tables = []
+        self._sequence = False
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def connection(self):
+        '''
+        The in-memory connection, up to date as required, for the duration
+        of a with block. The block holds the replica: other readers wait.
+        '''
+        with self._lock:
+            self.update()
+            con = self._con
+            factories = (con.row_factory, con.text_factory)
+            try:
+                yield con
+            finally:
+                con.row_factory, con.text_factory = factories
+                con.close_cursors()
+
+    def update(self):
+        '''
+        Refresh the copy if it may be stale, as before every read
+        '''
+        with self._lock:
+            if self._stale():
+                self.refresh()
+
+    def _stale(self):
+        '''
+        True if the file may have been written since the last refresh
+        '''
+        if self._con is None:
+            return True
+        now = timer()
+        if not self.read_your_writes and now - self._checked < self.max_lag:
+            return False
+        self._checked = now
+        return self._version() != self._data_version
+
+    def _version(self):
+        #data_version changes when another connection commits; this one
+        #never writes
+        if self._version_con is None:
+            self._version_con = sqlite3.connect(self.db_path,
+                                                check_same_thread=False)
+        return self._version_con.execute('PRAGMA data_version').fetchone()[0]
+
+    def refresh(self):
+        '''
+        Copy the changes of the file since the last refresh (the whole
+        database the first time)
+        '''
+        with self._lock:
+            version = self._version()
+            if self._con is None:
+                con = sqlite3.connect(':memory:', check_same_thread=False,
+                                      isolation_level=None,
+                                      factory=ReplicaConnection)
+            else:
+                con = self._con
+            con.execute('ATTACH DATABASE ? AS disk', (self.db_path,))
+            try:
+                con.execute('BEGIN')
+                try:
+                    if self._con is None:
+                        self._create_schema(con)
+                    copied = self._copy(con)
+                    con.execute('COMMIT')
+                except:
+                    #The copy keeps its previous state. An error may have
+                    #ended the transaction already.
+                    try:
+                        con.execute('ROLLBACK')
+                    except sqlite3.OperationalError:
+                        pass
+                    raise
+            finally:
+                con.close_cursors()
+                try:
+                    con.execute('DETACH DATABASE disk')
+                except sqlite3.OperationalError:
+                    #Still attached: start again from an empty copy
+                    con.close()
+                    self._con = None
+                    raise
+            self._con = con
+            self._data_version = version
+            self._checked = timer()
+            if copied:
+                self.refreshes += 1
+                if self.on_refresh is not None:
+                    self.on_refresh()
+
+    def _create_schema(self, con):
+        '''
+        Create the tables of the file, but its virtual tables and their
+        shadow tables, and their indexes
+        '''
+        rows = con.execute("SELECT type, name, tbl_name, sql \
+                                FROM disk.sqlite_master \
+                                WHERE sql IS NOT NULL \
+                                ORDER BY type = 'index', rowid").fetchall()
+        virtual = [name for kind, name, table, sql in rows
+                   if sql.upper().startswith('CREATE VIRTUAL')]
+        def skipped(table):
+            return table in SKIPPED_TABLES or any(
+                table == name or table.startswith(name + '_')
+                for name in virtual)
+        self._tables = []
+        for kind, name, table, sql in rows:
+            if kind not in ('table', 'index') or skipped(table):
+                continue
+            con.execute(sql)
+            if kind == 'table':
+                self._tables.append(name)
+        #Created with the first AUTOINCREMENT table
+        self._sequence = con.execute("SELECT count(*) FROM main.sqlite_master \
+                                        WHERE name = 'sqlite_sequence'"
+                                     ).fetchone()[0] > 0
+        self._versions = {}
+
+    def _copy(self, con):
+        '''
+        Copy the tables changed in the file. Returns False if nothing was
+        copied.
+        '''
+        try:
+            versions = dict(con.execute('SELECT table_name, version \
+                                            FROM disk.CHANGES').fetchall())
+        except sqlite3.OperationalError:
+            #Not migrated: no CHANGES table, everything is copied
+            versions = {}
+        changed = set()
+        for source, tables in DEPENDENT_TABLES.items():
+            if source not in versions or \
+               versions[source] != self._versions.get(source):
+                changed.update(tables)
+        if changed:
+            changed.add('CHANGES')
+        copied = False
+        for table in self._tables:
+            if table in LOG_TABLES:
+                copied = self._copy_log(con, table, LOG_TABLES[table]) or copied
+            elif table in changed or not _maintained(table):
+                con.execute('DELETE FROM main."%s"' % table)
+                con.execute('INSERT INTO main."%s" SELECT * FROM disk."%s"'
+                            % (table, table))
+                copied = True
+        if copied and self._sequence:
+            con.execute('DELETE FROM main.sqlite_sequence')
+            con.execute('INSERT INTO main.sqlite_sequence \
+                            SELECT * FROM disk.sqlite_sequence')
+        self._versions = versions
+        return copied
+
+    def _copy_log(self, con, table, key):
+        '''
+        Add the rows past the last key of the replica and drop the ones
+        older than the first row of the file. Returns True if a row changed.
+        '''
+        cur = con.execute('DELETE FROM main."%(t)s" WHERE %(k)s < coalesce( \
+                              (SELECT min(%(k)s) FROM disk."%(t)s"), \
+                              (SELECT max(%(k)s) FROM main."%(t)s") + 1)'
+                          % dict(t=table, k=key))
+        deleted = cur.rowcount
+        cur = con.execute('INSERT OR REPLACE INTO main."%(t)s" \
+                              SELECT * FROM disk."%(t)s" WHERE %(k)s > \
+                              coalesce((SELECT max(%(k)s) FROM main."%(t)s"), -1)'
+                          % dict(t=table, k=key))
+        return deleted > 0 or cur.rowcount > 0
+
+    def close(self):
+        '''
+        Drop the copy; the next connection() loads it again
+        '''
+        with self._lock:
+            for con in (self._con, self._version_con):
+                if con is not None:
+                    con.close()
+            self._con = None
+            self._version_con = None
+            self._data_version = None
+            self._versions = {}
+
+
+def _maintained(table):
+    '''
+    True if the changes of table are followed through DEPENDENT_TABLES.
+    The other tables are copied on every refresh.
+    '''
+    return table == 'CHANGES' or any(table in tables
+                                     for tables in DEPENDENT_TABLES.values())
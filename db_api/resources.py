@@ -1,11 +1,17 @@
-import json
+import json, hashlib, time
 
-from flask import Flask, request, Response, g, jsonify
+from flask import Flask, request, Response, g, jsonify, stream_with_context, \
+                  url_for
 from flask.ext.restful import Resource, Api, abort
 from werkzeug.exceptions import NotFound,  UnsupportedMediaType
+from werkzeug.http import http_date
+from werkzeug.urls import url_encode
 
 from utils import RegexConverter
 import database
+import feed
+import metrics
+import rendering
 
 
 DEFAULT_DB_PATH = 'db/project.db'
@@ -15,6 +21,66 @@ COLLECTIONJSON = "application/vnd.collection+json"
 HAL = "application/hal+json"
 PROJECT_PROFILES = "http://confluence.atlassian.virtues.fi/display/PWP/PWP01#PWP01-RESTfulAPIdesign"
 
+#Page sizes of the paginated collections
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+#Number of items written at a time in a streamed collection
+STREAM_CHUNK_ITEMS = 100
+#Maximum number of templates in a bulk POST to the tasks collection
+MAX_BULK_TASKS = 5000
+
+#Change feed: default and maximum seconds a long poll waits for changes
+LONG_POLL_TIMEOUT = 30
+MAX_LONG_POLL_TIMEOUT = 60
+#Seconds between the heartbeats of an event stream, and seconds before the
+#stream is closed (the client reconnects with Last-Event-ID)
+SSE_HEARTBEAT = 15
+SSE_MAX_SECONDS = 300
+#Milliseconds the EventSource waits before reconnecting
+SSE_RETRY = 3000
+#Seconds a watcher refused with 503 is told to wait (Retry-After)
+WATCHERS_RETRY_AFTER = 5
+
+#Collection+JSON templates, encoded once
+TASK_TEMPLATE = rendering.encode({
+          "data" : [
+                {"prompt" : "Title of the task", "name" : "title", "value" : "", "required":True},
+                {"prompt" : "Category of the task", "name" : "category", "value" : "", "required":True},
+                {"prompt" : "Description of the task", "name" : "description", "value" : "", "required":True},
+                {"prompt" : "Priority of the task", "name" : "priority", "value" : "", "required":True},
+                {"prompt" : "Status of the task", "name" : "status", "value" : "", "required":True}]
+        })
+USER_TEMPLATE = rendering.encode({
+                "data" : [
+                {"prompt" : "Insert user nickname", "name" : "nickname", "value" : "", "required":True},
+                {"prompt" : "Insert user role", "name" : "role", "value" : "", "required":True},
+                {"prompt" : "Insert user e-mail adress", "name" : "email", "value" : "", "required":True},
+                {"prompt" : "Insert user's boss", "name" : "boss", "value" : "", "required":True}
+                ]
+        })
+COMMENT_TEMPLATE = rendering.encode({
+          "data" : [
+                {"prompt" : "Comment body", "name" : "comment", "value" : "", "required":True}
+                ]
+        })
+ASSIGNEE_TEMPLATE = rendering.encode({
+          "data" : [
+                {"prompt" : "User to assign", "name" : "nickname", "value" : "", "required":True}
+                ]
+        })
+TEAM_TEMPLATE = rendering.encode({
+          "data" : [
+                {"prompt" : "Member name", "name" : "nickname", "value" : "", "required":True}
+                ]
+        })
+
+#URL templates of the routes, resolved before the first request
+URLS = rendering.UrlTemplates()
+#Encoded links of the collections that only depend on the URL templates
+LINKS = {}
+#Encoded Collection+JSON queries of the task search
+TASK_SEARCH_QUERIES = None
+
 #Define the application and the api
 app = Flask(__name__)
 app.debug = True
@@ -23,6 +89,15 @@ app.debug = True
 app.config.update({'DATABASE':database.ProjectDatabase(DEFAULT_DB_PATH)})
 #Start the RESTful API.
 api = Api(app)
+#Request and database metrics served at /metrics. Set the METRICS config
+#value to False to disable them.
+METRICS = metrics.Metrics()
+#Paths of the requests that wait for changes, run off the executor by the
+#event loop server (see async_server.py)
+LONG_REQUEST_PATHS = ['/project/api/changes/']
+#Wakes up the change feed requests when the change log grows
+NOTIFIER = feed.ChangeNotifier(
+    lambda: app.config['DATABASE'].get_change_bounds()[1])
 
 
 def create_error_response(status_code, title, message, resource_type=None):
@@ -38,11 +113,192 @@ def resource_not_found(error):
 def unknown_error(error):
     return create_error_response(500, "Error", "The system has failed. Please, contact the administrator")
 
+def wants_stream():
+    '''
+    True if the collection should be streamed: either the STREAM_COLLECTIONS
+    config value is set or the request has the stream=true query parameter.
+    '''
+    stream = request.args.get('stream')
+    if stream is not None:
+        return stream.lower() in ('1', 'true', 'yes')
+    return app.config.get('STREAM_COLLECTIONS', False)
+
+def conditional_get(*tables):
+    '''
+    Conditional GET support for a resource built from the given tables.
+
+    The ETag is derived from the change versions of the tables kept by the
+    database (see ProjectDatabase.get_table_versions) and the request path
+    with its query string; Last-Modified is the last write to any of the
+    tables. No row data is read.
+
+    Returns (response, headers). response is a 304 Response when the
+    If-None-Match or If-Modified-Since headers of the request show that the
+    client copy is current, otherwise None. headers must be added to the
+    200 response.
+    '''
+    versions = g.db.get_table_versions(tables)
+    tag = hashlib.sha1(repr((sorted(versions.items()),
+                             request.full_path))).hexdigest()
+    last_modified = max(modified for version, modified in versions.values())
+    headers = {'ETag': '"%s"' % tag, 'Last-Modified': http_date(last_modified)}
+    if request.if_none_match:
+        #If-Modified-Since is ignored when If-None-Match is present
+        if request.if_none_match.contains_weak(tag):
+            return Response(status=304, headers=headers), headers
+    elif request.if_modified_since is not None:
+        since = request.if_modified_since
+        if since.tzinfo is not None:
+            since = since.replace(tzinfo=None) - since.utcoffset()
+        if last_modified <= since:
+            return Response(status=304, headers=headers), headers
+    return None, headers
+
+def render_collection(head, items, headers=None, stream=False):
+    '''
+    Render a Collection+JSON document. head is the text returned by
+    rendering.collection_head and items an iterable of item dicts.
+
+    With stream the items are normally built from one of the iter_*
+    generators of the database API, so the rows are read from the cursor
+    while the response is being sent. Items are then written
+    STREAM_CHUNK_ITEMS at a time in a chunked response.
+    '''
+    document = rendering.iter_collection(head, items, STREAM_CHUNK_ITEMS)
+    if stream:
+        body = stream_with_context(document)
+    else:
+        body = ''.join(document)
+    return Response(body, 200, headers=headers,
+                    mimetype=COLLECTIONJSON+";"+PROJECT_PROFILES)
+
+def since_params():
+    '''
+    Values of the since and limit query parameters of the collections in
+    delta sync mode, (None, None) if since is not in the request. limit is
+    None if it is not given. Raises ValueError if since is not an integer
+    of at least 0 or limit an integer of at least 1.
+    '''
+    since = request.args.get('since')
+    if since is None:
+        return None, None
+    since = int(since)
+    limit = request.args.get('limit')
+    limit = int(limit) if limit is not None else None
+    if since < 0 or (limit is not None and limit < 1):
+        raise ValueError()
+    return since, limit
+
+def render_since(href, links, template, rows, since, item, tombstone,
+                 headers=None):
+    '''
+    Render the rows returned by one of the get_*_since methods of the
+    database API as a Collection+JSON document. item and tombstone build
+    the items of the existing and of the deleted rows; seq and deleted are
+    added to their data. The "sync" link and the X-Sync-Seq header give the
+    new high-water mark: the since value of the next sync.
+    '''
+    seq = rows[-1]['seq'] if rows else since
+    links = rendering.extend_links(links, [
+        {"href" : href + '?since=%d' % seq, "rel" : "sync",
+         "prompt" : "Changes after these ones"}])
+    head = rendering.collection_head(href, links, template)
+    def items():
+        for row in rows:
+            _item = tombstone(row) if row['deleted'] else item(row)
+            _item['data'].append({'name':'seq', 'value':row['seq']})
+            _item['data'].append({'name':'deleted', 'value':row['deleted']})
+            yield _item
+    headers = dict(headers or {})
+    headers['X-Sync-Seq'] = str(seq)
+    return render_collection(head, items(), headers)
+
+def since_error(resource_type):
+    return create_error_response(400, "Wrong query parameters",
+                                 "since and limit must be integers, since at least 0 and limit at least 1",
+                                 resource_type)
+
+@app.before_first_request
+def migrate_database():
+    '''Upgrades the schema of the database to the last version before the
+    first request is served'''
+    app.config['DATABASE'].migrate()
+
+def compile_rendering():
+    '''Resolves the URL templates of the routes and encodes the links that
+    only depend on them'''
+    URLS.compile(url_for)
+    LINKS['tasks'] = rendering.encode([
+        {"href" : URLS.url('users'), "rel" : "users-all", "prompt" : "Users in the system"}])
+    LINKS['users'] = rendering.encode([
+        {"href" : URLS.url('tasks'), "rel" : "users-all", "prompt" : "Tasks in system"}])
+    global TASK_SEARCH_QUERIES
+    TASK_SEARCH_QUERIES = rendering.encode([
+        {"href" : URLS.url('task_search'), "rel" : "search", "prompt" : "Search tasks",
+         "data" : [{"name" : "q", "value" : ""}, {"name" : "limit", "value" : ""}]}])
+    LINKS['comments'] = rendering.encode([
+        {'prompt':'List of all users in the system',
+         'rel':'users-all','href': URLS.url('users')},
+        {'prompt':'List of all users in the system',
+         'rel':'tasks-all','href': URLS.url('tasks')}])
+    LINKS['assignees'] = rendering.encode([
+        {'prompt':'List of all users in the system',
+         'rel':'users-all','href': URLS.url('users')},
+        {'prompt':'List of all tasks ihn the system',
+         'rel':'tasks-all','href': URLS.url('tasks')}])
+
+#Not used as a decorator so that compile_rendering stays callable, for
+#instance from the benchmarks
+app.before_first_request(compile_rendering)
+
 @app.before_request
 def set_database():
     '''Stores an instance of the database API before each request in the flas.g
     variable accessible only from the application context'''
-    g.db = app.config['DATABASE']
+    if app.config.get('METRICS', True):
+        g.metrics_start = metrics.timer()
+        g.db = metrics.InstrumentedDatabase(app.config['DATABASE'], METRICS)
+    else:
+        g.db = app.config['DATABASE']
+
+def record_request(status):
+    '''
+    Record the latency, the status and the database calls of the request
+    in METRICS. Called once per request.
+    '''
+    start = getattr(g, 'metrics_start', None)
+    if start is None:
+        return
+    g.metrics_start = None
+    endpoint = request.endpoint or 'none'
+    stats = METRICS.stats()
+    stats.inc('project_http_requests_total',
+              (('endpoint', endpoint), ('method', request.method),
+               ('status', status)))
+    stats.observe('project_http_request_duration_seconds',
+                  (('endpoint', endpoint), ('method', request.method)),
+                  metrics.timer() - start)
+    stats.observe('project_http_request_db_calls', (('endpoint', endpoint),),
+                  g.db.calls)
+
+@app.after_request
+def record_response(response):
+    record_request(response.status_code)
+    return response
+
+@app.teardown_request
+def record_exception(exception):
+    '''Requests that end with an unhandled exception do not go through
+    after_request'''
+    if exception is not None:
+        record_request(500)
+
+@app.route('/metrics')
+def show_metrics():
+    '''
+    Request and database metrics in the Prometheus text format
+    '''
+    return Response(METRICS.render(), 200, content_type=metrics.CONTENT_TYPE)
 
 
 #Define the resources
@@ -52,61 +308,182 @@ class Tasks(Resource):
     '''
     def get(self):
         '''
-        Get all messages in my system.
-
-        INPUT parameters:
-          None
+        Get a page of the tasks in my system.
+
+        INPUT parameters (query string, all optional):
+          * limit: number of tasks in the page. Default DEFAULT_PAGE_SIZE,
+            at most MAX_PAGE_SIZE.
+          * after: return the tasks following the task with this id
+          * before: return the tasks preceding the task with this id
+          * sort: id (default), priority, status, category or date; with a
+            leading - in descending order. Ties are ordered by id.
+          * status, category, priority: only the tasks with this value. Can
+            be repeated to accept several values (status=1&status=2).
+          * created_after, created_before: creation date range, as
+            YYYY-MM-DD or YYYY-MM-DD HH:MM:SS (after inclusive, before
+            exclusive).
+          * since: delta sync. Only the tasks created, updated or deleted
+            after this modification sequence number, in sequence order, at
+            most limit of them (all if limit is not given). Deleted tasks
+            are items with deleted true; every item has its seq. The "sync"
+            link and the X-Sync-Seq header give the since value for the next
+            sync. The other parameters are ignored.
 
         OUTPUT: 
          * Media type: Collection+JSON: 
          * Profile: Task profile
+         * The links contain "next" and "prev" when there are more pages.
+        The next and prev links keep the sort and the filters.
+        Returns 400 if the query parameters are not valid.
+
+        In streaming mode (see wants_stream) all the tasks, or all the tasks
+        following after, are written in one chunked response without
+        pagination links.
 
         '''
-        
-        #Extract tasks from database
-        tasks_db = g.db.get_tasks()
+        try:
+            since, limit = since_params()
+        except ValueError:
+            return since_error("Tasks")
+        if since is not None:
+            return self._since(since, limit)
+
+        try:
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+            after = request.args.get('after')
+            before = request.args.get('before')
+            after = int(after) if after is not None else None
+            before = int(before) if before is not None else None
+            if limit < 1 or (after is not None and before is not None):
+                raise ValueError()
+        except ValueError:
+            return create_error_response(400, "Wrong query parameters",
+                                         "limit, after and before must be integers, limit at least 1 and after and before cannot be used together",
+                                         "Tasks")
+        limit = min(limit, MAX_PAGE_SIZE)
+        try:
+            sort, filters, query = self._filters()
+        except ValueError:
+            return create_error_response(400, "Wrong query parameters",
+                                         "status and priority must be levels %s, category one of %s, sort one of %s with an optional - and the dates YYYY-MM-DD or YYYY-MM-DD HH:MM:SS"
+                                         % (database.TASK_LEVELS, database.TASK_CATEGORIES, sorted(database.TASK_SORT_KEYS)),
+                                         "Tasks")
+        stream = wants_stream()
+        not_modified, headers = conditional_get('TASKS')
+        if not_modified:
+            return not_modified
+
+        #Extract tasks from database. One extra task is requested to know if
+        #there is another page in the direction we are walking.
+        tasks_db = []
+        more = False
+        if not stream:
+            tasks_db = g.db.get_tasks(limit=limit + 1, after_id=after,
+                                      before_id=before, sort=sort, **filters)
+            more = len(tasks_db) > limit
+            if more:
+                if before is not None:
+                    tasks_db = tasks_db[1:]
+                else:
+                    tasks_db = tasks_db[:limit]
 
         #Create the envelope
-        envelope = {}
-        collection = {}
-        envelope["collection"] = collection
-        collection['version'] = "1.0"
-        collection['href'] = api.url_for(Tasks)
-        collection['links'] = [{"href" : api.url_for(Users), "rel" : "users-all", "prompt" : "Users in the system"}]
-        collection['template'] = {
-          "data" : [
-                {"prompt" : "Title of the task", "name" : "title", "value" : "", "required":True},
-                {"prompt" : "Category of the task", "name" : "category", "value" : "", "required":True},
-                {"prompt" : "Description of the task", "name" : "description", "value" : "", "required":True},
-                {"prompt" : "Priority of the task", "name" : "priority", "value" : "", "required":True},
-                {"prompt" : "Status of the task", "name" : "status", "value" : "", "required":True}]
-        }
+        links = []
+        if tasks_db:
+            has_next = more if before is None else True
+            has_prev = more if before is not None else after is not None
+            if has_next:
+                links.append({"href" : URLS.url('tasks') + '?limit=%d&after=%d' % (limit, tasks_db[-1]['task_id']) + query,
+                              "rel" : "next", "prompt" : "Next page of tasks"})
+            if has_prev:
+                links.append({"href" : URLS.url('tasks') + '?limit=%d&before=%d' % (limit, tasks_db[0]['task_id']) + query,
+                              "rel" : "prev", "prompt" : "Previous page of tasks"})
+        head = rendering.collection_head(URLS.url('tasks'),
+                                         rendering.extend_links(LINKS['tasks'], links),
+                                         TASK_TEMPLATE)
         #Create the items
-        items = []
-        for task in tasks_db: 
-            _task = task['task_id']
-            _title = task['title']
-            _category = task['category']
-            _status = task['status']
-            _date = task['date']
-            _url = api.url_for(Task, taskid=_task)
-            task = {}
-            task['href'] = _url
-            task['data'] = []
-            value0 = {'name':'title', 'value':_title}
-            value1 = {'name':'category', 'value':_category}
-            value2 = {'name':'status', 'value':_status}
-            value3 = {'name':'date', 'value':_date}
-            task['data'].append(value0)
-            task['data'].append(value1)
-            task['data'].append(value2)
-            task['data'].append(value3)
-            task['links'] = [{"href" : api.url_for(Comments, taskid=_task), "rel" : "Comments", "prompt" : "Comments for this task"},
-                             {"href" : api.url_for(Assignees, taskid=_task), "rel" : "Assignees", "prompt" : "Assignees for this task"}]
-            items.append(task)
-        collection['items'] = items
-        
-        return envelope
+        if stream:
+            tasks_db = g.db.iter_tasks(after_id=after, sort=sort, **filters)
+        return render_collection(head, (self._item(task) for task in tasks_db),
+                                 headers, stream)
+
+    def _since(self, since, limit):
+        '''
+        Delta sync response of get
+        '''
+        not_modified, headers = conditional_get('TASKS')
+        if not_modified:
+            return not_modified
+        def tombstone(task):
+            return {'href': URLS.url('task', taskid=task['task_id']),
+                    'data': [], 'links': []}
+        return render_since(URLS.url('tasks'), LINKS['tasks'], TASK_TEMPLATE,
+                            g.db.get_tasks_since(since, limit), since,
+                            self._item, tombstone, headers)
+
+    @staticmethod
+    def _filters():
+        '''
+        Read the sort and the filters of get from the query string.
+        Returns (sort, filters, query): the arguments of get_tasks and the
+        query string fragment that repeats them in the pagination links.
+        Raises ValueError if a value is wrong.
+        '''
+        sort = request.args.get('sort')
+        if sort is not None and sort.lstrip('-') not in database.TASK_SORT_KEYS:
+            raise ValueError()
+        filters = {}
+        params = []
+        for name in ['status', 'category', 'priority']:
+            values = request.args.getlist(name)
+            if not values:
+                continue
+            if name != 'category':
+                values = [int(value) for value in values]
+            allowed = database.TASK_CATEGORIES if name == 'category' \
+                      else database.TASK_LEVELS
+            if any(value not in allowed for value in values):
+                raise ValueError()
+            filters[name] = values
+            params.extend((name, value) for value in values)
+        for name in ['created_after', 'created_before']:
+            value = request.args.get(name)
+            if value is None:
+                continue
+            if database.parse_task_date(value) is None:
+                raise ValueError()
+            filters[name] = value
+            params.append((name, value))
+        if sort is not None:
+            params.append(('sort', sort))
+        query = '&' + url_encode(params) if params else ''
+        return sort, filters, query
+
+    @staticmethod
+    def _item(task):
+        '''
+        Create the Collection+JSON item of a task returned by the database API
+        '''
+        _task = task['task_id']
+        _title = task['title']
+        _category = task['category']
+        _status = task['status']
+        _date = task['date']
+        _url = URLS.url('task', taskid=_task)
+        task = {}
+        task['href'] = _url
+        task['data'] = []
+        value0 = {'name':'title', 'value':_title}
+        value1 = {'name':'category', 'value':_category}
+        value2 = {'name':'status', 'value':_status}
+        value3 = {'name':'date', 'value':_date}
+        task['data'].append(value0)
+        task['data'].append(value1)
+        task['data'].append(value2)
+        task['data'].append(value3)
+        task['links'] = [{"href" : URLS.url('comments', taskid=_task), "rel" : "Comments", "prompt" : "Comments for this task"},
+                         {"href" : URLS.url('assignees', taskid=_task), "rel" : "Assignees", "prompt" : "Assignees for this task"}]
+        return task
 
     def post(self):
         '''
@@ -135,6 +512,20 @@ class Tasks(Resource):
                 {"prompt" : "Status of the task", "name" : "status", "value" : "", "required":True}]
         }}
 
+        BULK CREATION:
+        Several tasks are created at once if the body contains a "templates"
+        array instead of "template" (at most MAX_BULK_TASKS):
+
+          {"templates" : [{"data" : [...]}, {"data" : [...]}]}
+
+        All the valid tasks are inserted in one transaction. Returns 200 with
+        one result per template, in the same order:
+
+          {"results" : [{"status" : 201, "href" : "/project/api/tasks/3/"},
+                        {"status" : 400, "message" : "..."}]}
+
+        Returns 400 if "templates" is not a list or is too long.
+
         '''
         
 
@@ -143,40 +534,25 @@ class Tasks(Resource):
         if not input:
             abort(415)
 
-        try: 
-            data = input['template']['data']
-            title = None
-            category = None
-            description = None
-            priority = None
-            status = None
+        if 'templates' in input:
+            return self._post_many(input['templates'])
 
-            for d in data: 
-                if d['name'] == 'title':
-                    title = d['value']
-                elif d['name'] == 'category':
-                    category = d['value']
-                elif d['name'] == 'description':
-                    description = d['value']
-                elif d['name'] == 'priority':
-                    priority = d['value']
-                elif d['name'] == 'status':
-                    status = d['value']
-
-            #Check that the data is correct
-            if not title or not category or not description or not priority or not status:
-                return create_error_response(400, "Wrong request format",
-                                             "Be sure you include task title, category, description, priority and status",
-                                             "Tasks")
+        try: 
+            task = self._parse_template(input['template'])
         except: 
             #This is launched if either title or body does not exist or if 
             # the template.data array does not exist.
+            task = None
+        #Check that the data is correct
+        if task is None:
             return create_error_response(400, "Wrong request format",
                                              "Be sure you include task title, category, description, priority and status",
                                              "Tasks")
         
         #Create new task or raise an error 500
-        newtask = g.db.add_task(title, category, description, int(priority), int(status))
+        newtask = g.db.add_task(task['title'], task['category'],
+                                task['description'], task['priority'],
+                                task['status'])
         if newtask == False:
             abort(500)
                
@@ -185,6 +561,113 @@ class Tasks(Resource):
 
         return Response(status=201, headers={'Location':url})
 
+    def _parse_template(self, template):
+        '''
+        Extract the task fields from a Collection+JSON template. Returns None
+        if a field is missing. Raises an exception if the template is
+        malformed.
+        '''
+        task = dict(title=None, category=None, description=None,
+                    priority=None, status=None)
+        for d in template['data']: 
+            if d['name'] in task:
+                task[d['name']] = d['value']
+        if not all(task.values()):
+            return None
+        task['priority'] = int(task['priority'])
+        task['status'] = int(task['status'])
+        return task
+
+    def _post_many(self, templates):
+        '''
+        Bulk creation of tasks, see post
+        '''
+        if not isinstance(templates, list) or len(templates) > MAX_BULK_TASKS:
+            return create_error_response(400, "Wrong request format",
+                                         "templates must be a list of at most %d templates"
+                                         % MAX_BULK_TASKS,
+                                         "Tasks")
+        results = []
+        rows = []
+        for template in templates:
+            try:
+                task = self._parse_template(template)
+            except:
+                task = None
+            if task is None or task['category'] not in database.TASK_CATEGORIES \
+                    or task['priority'] not in database.TASK_LEVELS \
+                    or task['status'] not in database.TASK_LEVELS:
+                results.append({'status': 400,
+                                'message': "Be sure you include task title, category, description, priority and status with valid values"})
+            else:
+                results.append(None)
+                rows.append(task)
+
+        if rows:
+            ids = g.db.add_tasks(rows)
+            if ids == False:
+                abort(500)
+            ids = iter(ids)
+            for i, result in enumerate(results):
+                if result is None:
+                    results[i] = {'status': 201,
+                                  'href': URLS.url('task', taskid=next(ids))}
+        return {'results': results}
+
+class TaskSearch(Resource):
+    '''
+    Full-text search of the tasks
+    '''
+    def get(self):
+        '''
+        Search the tasks by the words of their title, description and
+        comments (see ProjectDatabase.search_tasks).
+
+        INPUT parameters (query string):
+          * q: words to search. A word ending in * matches as a prefix.
+          * limit: maximum number of results. Default DEFAULT_PAGE_SIZE, at
+            most MAX_PAGE_SIZE.
+
+        OUTPUT:
+         * Media type: Collection+JSON:
+         * Profile: Task profile
+         * Items in rank order, with rank and snippet in their data.
+         * The search query is described in the queries of the collection.
+        Returns 400 if q has no words or limit is not a positive integer.
+        '''
+        try:
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+            if limit < 1:
+                raise ValueError()
+        except ValueError:
+            return create_error_response(400, "Wrong query parameters",
+                                         "limit must be an integer, at least 1",
+                                         "TaskSearch")
+        limit = min(limit, MAX_PAGE_SIZE)
+        not_modified, headers = conditional_get('TASKS', 'COMMENTS')
+        if not_modified:
+            return not_modified
+        tasks_db = g.db.search_tasks(request.args.get('q', ''), limit)
+        if tasks_db is False:
+            return create_error_response(400, "Wrong query parameters",
+                                         "q must contain at least one word",
+                                         "TaskSearch")
+        head = rendering.collection_head(URLS.url('task_search'),
+                                         LINKS['tasks'],
+                                         queries=TASK_SEARCH_QUERIES)
+        return render_collection(head, (self._item(task) for task in tasks_db),
+                                 headers)
+
+    @staticmethod
+    def _item(task):
+        '''
+        Task item of Tasks with the rank and the snippet of the match
+        '''
+        item = Tasks._item(task)
+        item['data'].append({'name':'rank', 'value':task['rank']})
+        item['data'].append({'name':'snippet', 'value':task['snippet']})
+        return item
+
 class Task(Resource):
     '''
     Single task.
@@ -206,6 +689,9 @@ class Task(Resource):
         '''
 
         #PEFORM OPERATIONS INITIAL CHECKS
+        not_modified, headers = conditional_get('TASKS')
+        if not_modified:
+            return not_modified
         #Get the message from db
         task_db = g.db.get_task(taskid)
         if not task_db:
@@ -223,18 +709,18 @@ class Task(Resource):
             }
         ]
         links['curies'] = _curies
-        links['self'] = {'href':api.url_for(Task, taskid=taskid),
+        links['self'] = {'href':URLS.url('task', taskid=taskid),
                          'profile': PROJECT_PROFILES}
-        links['collection'] = {'href':api.url_for(Tasks),
+        links['collection'] = {'href':URLS.url('tasks'),
                                'profile': PROJECT_PROFILES,
                                'type':COLLECTIONJSON}
-        links['users-all'] = {'href':api.url_for(Users),
+        links['users-all'] = {'href':URLS.url('users'),
                                'profile': PROJECT_PROFILES,
                                'type':COLLECTIONJSON}
-        links['comments'] = {"href" : api.url_for(Comments, taskid=taskid),
+        links['comments'] = {"href" : URLS.url('comments', taskid=taskid),
                              'profile' : PROJECT_PROFILES,
                              'type':COLLECTIONJSON}
-        links['assignees'] = {"href" : api.url_for(Assignees, taskid=taskid),
+        links['assignees'] = {"href" : URLS.url('assignees', taskid=taskid),
                              'profile' : PROJECT_PROFILES,
                              'type':COLLECTIONJSON}
 
@@ -254,7 +740,8 @@ class Task(Resource):
         envelope['status'] = task_db['status']
         envelope['date_created'] = task_db['date']
         
-        return Response (json.dumps(envelope), 200, mimetype=HAL+";"+PROJECT_PROFILES)
+        return Response (json.dumps(envelope), 200, headers=headers,
+                         mimetype=HAL+";"+PROJECT_PROFILES)
 
     def delete(self, taskid):
         '''
@@ -303,7 +790,11 @@ class Task(Resource):
 
         '''
 
-        #CHECK THAT MESSAGE EXISTS
+        #CHECK THAT THE TASK EXISTS
+        try:
+            taskid = int(taskid)
+        except ValueError:
+            raise NotFound()
         if not g.db.get_task(taskid):
             raise NotFound()
 
@@ -333,19 +824,25 @@ class Task(Resource):
                     
             if not title or not category or not description or not priority or not status:
                 abort(400)
+            priority = int(priority)
+            status = int(status)
         except: 
             abort(400)
         else:
-            if not g.db.update_title(int(taskid),title):
-                return NotFound()
-            elif not g.db.update_description(int(taskid),description):
-                return NotFound()
-            elif not g.db.update_category(int(taskid),category):
-                return NotFound()
-            elif not g.db.update_priority(int(taskid),int(priority)):
-                return NotFound()
-            elif not g.db.update_status(int(taskid),int(status)):
-                return NotFound
+            if category not in database.TASK_CATEGORIES \
+                    or priority not in database.TASK_LEVELS \
+                    or status not in database.TASK_LEVELS:
+                return create_error_response(400, "Wrong request format",
+                                             "category must be one of %s, priority and status one of %s"
+                                             % (database.TASK_CATEGORIES, database.TASK_LEVELS),
+                                             "Task")
+            #All the fields are written in one transaction. With valid
+            #values it only fails if the task was deleted meanwhile.
+            if not g.db.update_task(taskid, title=title,
+                                    description=description,
+                                    category=category, priority=priority,
+                                    status=status):
+                raise NotFound()
             return '', 204
 
 class Users(Resource): 
@@ -358,40 +855,56 @@ class Users(Resource):
             * Media type: Collection+JSON: 
             * Profile: User profile
 
+        In streaming mode (see wants_stream) the users are written in a
+        chunked response while they are read from the database.
+
+        With the since query parameter (and optionally limit) only the users
+        changed after that modification sequence number are returned, with
+        their user_id (see Tasks.get).
+
         '''
-        users_db = g.db.get_users()
+        try:
+            since, limit = since_params()
+        except ValueError:
+            return since_error("Users")
+        not_modified, headers = conditional_get('USERS')
+        if not_modified:
+            return not_modified
+        if since is not None:
+            def item(user):
+                _item = self._item(user)
+                _item['data'].append({'name':'user_id', 'value':user['user_id']})
+                return _item
+            return render_since(URLS.url('users'), LINKS['users'],
+                                USER_TEMPLATE,
+                                g.db.get_users_since(since, limit), since,
+                                item, item, headers)
 
-       #Create the envelope
-        envelope = {}
-        collection = {}
-        envelope["collection"] = collection
-        collection['version'] = "1.0"
-        collection['href'] = api.url_for(Users)
-        collection['links'] = [{"href" : api.url_for(Tasks), "rel" : "users-all", "prompt" : "Tasks in system"}]
-        collection['template'] = {
-                "data" : [
-                {"prompt" : "Insert user nickname", "name" : "nickname", "value" : "", "required":True},
-                {"prompt" : "Insert user role", "name" : "role", "value" : "", "required":True},
-                {"prompt" : "Insert user e-mail adress", "name" : "email", "value" : "", "required":True},
-                {"prompt" : "Insert user's boss", "name" : "boss", "value" : "", "required":True}
-                ]
-        }
+        #Create the envelope
+        head = rendering.collection_head(URLS.url('users'), LINKS['users'],
+                                         USER_TEMPLATE)
         #Create the items
-        items = []
-        for user in users_db: 
-            print user
-            _nickname = user['nickname']
-            _url = api.url_for(User, username=_nickname)
-            user = {}
-            user['href'] = _url
-            user['data'] = []
-            value = {'name':'nickname', 'value':_nickname}
-            user['data'].append(value)
-            user['links'] = []
-            items.append(user)
-        collection['items'] = items
-        
-        return envelope
+        stream = wants_stream()
+        if stream:
+            users_db = g.db.iter_users()
+        else:
+            users_db = g.db.get_users()
+        return render_collection(head, (self._item(user) for user in users_db),
+                                 headers, stream)
+
+    def _item(self, user):
+        '''
+        Create the Collection+JSON item of a user returned by the database API
+        '''
+        _nickname = user['nickname']
+        _url = URLS.url('user', username=_nickname)
+        user = {}
+        user['href'] = _url
+        user['data'] = []
+        value = {'name':'nickname', 'value':_nickname}
+        user['data'].append(value)
+        user['links'] = []
+        return user
 
     
     def post(self):
@@ -484,6 +997,9 @@ class User(Resource):
 
         '''
         #PERFORM OPERATIONS
+        not_modified, headers = conditional_get('USERS')
+        if not_modified:
+            return not_modified
         user_id = g.db.get_user_id(username)
 
         if user_id == False:
@@ -504,15 +1020,16 @@ class User(Resource):
 
         ]
         links['curies'] = _curies
-        links['self'] = {'href':api.url_for(User, username=username),
+        links['self'] = {'href':URLS.url('user', username=username),
                          'profile': PROJECT_PROFILES}
-        links['collection'] = {'href':api.url_for(Users),
+        links['collection'] = {'href':URLS.url('users'),
                          'profile': PROJECT_PROFILES}
         envelope['userid'] = user_id
         envelope['nickname'] = username
         
         #RENDER
-        return Response (json.dumps(envelope), 200, mimetype=HAL+";"+PROJECT_PROFILES)
+        return Response (json.dumps(envelope), 200, headers=headers,
+                         mimetype=HAL+";"+PROJECT_PROFILES)
 
     def delete(self, username):
         '''
@@ -590,49 +1107,69 @@ class User(Resource):
 
 class Comments(Resource):
     def get(self, taskid):
-        comments_db = g.db.get_comments(taskid)
+        '''
+        Return 200 if everything is OK
+
+        In streaming mode (see wants_stream) the comments are written in a
+        chunked response while they are read from the database.
+
+        With the since query parameter (and optionally limit) only the
+        comments changed after that modification sequence number are
+        returned (see Tasks.get).
+        '''
+        try:
+            since, limit = since_params()
+        except ValueError:
+            return since_error("Comments")
+        not_modified, headers = conditional_get('COMMENTS')
+        if not_modified:
+            return not_modified
 
         #FILTER AND GENERATE RESPONSE
 
         #Create the envelope
-        envelope = {}
-        collection = {}
-        envelope["collection"] = collection
-        collection['version'] = "1.0"
-        collection['href'] = api.url_for(Comments, taskid=taskid)
-        collection['links'] = [{'prompt':'List of all users in the system', 
-                              'rel':'users-all','href': api.url_for(Users)},
-                               {'prompt':'List of all users in the system', 
-                              'rel':'tasks-all','href': api.url_for(Tasks)},
-                               {'prompt':'Task',
-                                'rel':'task', 'href' : api.url_for(Task, taskid=taskid)}
-                           ]
-        collection['template'] = {
-          "data" : [
-                {"prompt" : "Comment body", "name" : "comment", "value" : "", "required":True}
-                ]
-        }
+        _url = URLS.url('comments', taskid=taskid)
+        links = rendering.extend_links(LINKS['comments'], [
+            {'prompt':'Task',
+             'rel':'task', 'href' : URLS.url('task', taskid=taskid)}])
+        if since is not None:
+            def tombstone(comment):
+                return {'href': _url, 'links': [],
+                        'data': [{'name':'comment_id', 'value':comment['comment_id']}]}
+            return render_since(_url, links, COMMENT_TEMPLATE,
+                                g.db.get_comments_since(taskid, since, limit),
+                                since, lambda comment: self._item(_url, comment),
+                                tombstone, headers)
+        head = rendering.collection_head(_url, links, COMMENT_TEMPLATE)
         #Create the items
-        items = []
-        for comment in comments_db: 
-            _id = comment['comment_id']
-            _comment = comment['comment']
-            _date = comment['date']
-            _url = api.url_for(Comments, taskid=taskid)
-            comment = {}
-            comment['href'] = _url
-            comment['data'] = []
-            value0 = {'name':'comment_id', 'value':_id}
-            value1 = {'name':'comment', 'value':_comment}
-            value2 = {'name':'date', 'value':_date}
-            comment['data'].append(value0)
-            comment['data'].append(value1)
-            comment['data'].append(value2)
-            comment['links'] = []
-            items.append(comment)
-        collection['items'] = items
-        
-        return envelope
+        stream = wants_stream()
+        if stream:
+            comments_db = g.db.iter_comments(taskid)
+        else:
+            comments_db = g.db.get_comments(taskid)
+        return render_collection(head, (self._item(_url, comment)
+                                        for comment in comments_db),
+                                 headers, stream)
+
+    def _item(self, _url, comment):
+        '''
+        Create the Collection+JSON item of a comment returned by the database
+        API. _url is the URL of the collection.
+        '''
+        _id = comment['comment_id']
+        _comment = comment['comment']
+        _date = comment['date']
+        comment = {}
+        comment['href'] = _url
+        comment['data'] = []
+        value0 = {'name':'comment_id', 'value':_id}
+        value1 = {'name':'comment', 'value':_comment}
+        value2 = {'name':'date', 'value':_date}
+        comment['data'].append(value0)
+        comment['data'].append(value1)
+        comment['data'].append(value2)
+        comment['links'] = []
+        return comment
 
     def post(self, taskid):
         '''
@@ -707,49 +1244,68 @@ class Assignees(Resource):
 
         '''
         Return 200 if everything is OK
+
+        In streaming mode (see wants_stream) the assignees are written in a
+        chunked response while they are read from the database.
+
+        With the since query parameter (and optionally limit) only the
+        assignments changed after that modification sequence number are
+        returned (see Tasks.get). Renaming a user does not change its
+        assignments.
         '''
+        try:
+            since, limit = since_params()
+        except ValueError:
+            return since_error("Assignees")
+        #The nicknames of the assignees come from USERS
+        not_modified, headers = conditional_get('ASSIGNED_TO', 'USERS')
+        if not_modified:
+            return not_modified
         
-        assignee_db = g.db.get_assigned_users(taskid)
-
         #FILTER AND GENERATE RESPONSE
 
         #Create the envelope
-        envelope = {}
-        collection = {}
-        envelope["collection"] = collection
-        collection['version'] = "1.0"
-        collection['href'] = api.url_for(Assignees, taskid=taskid)
-        collection['links'] = [{'prompt':'List of all users in the system', 
-                              'rel':'users-all','href': api.url_for(Users)},
-                               {'prompt':'List of all tasks ihn the system', 
-                              'rel':'tasks-all','href': api.url_for(Tasks)},
-                               {'prompt':'This task', 
-                              'rel':'task','href': api.url_for(Task, taskid=taskid)}
-                           ]
-        collection['template'] = {
-          "data" : [
-                {"prompt" : "User to assign", "name" : "nickname", "value" : "", "required":True}
-                ]
-        }
+        _url = URLS.url('assignees', taskid=taskid)
+        links = rendering.extend_links(LINKS['assignees'], [
+            {'prompt':'This task',
+             'rel':'task','href': URLS.url('task', taskid=taskid)}])
+        if since is not None:
+            def tombstone(assignee):
+                return {'href': _url, 'links': [],
+                        'data': [{'name':'user_id', 'value':assignee['user']}]}
+            return render_since(_url, links, ASSIGNEE_TEMPLATE,
+                                g.db.get_assignees_since(taskid, since, limit),
+                                since, lambda assignee: self._item(_url, assignee),
+                                tombstone, headers)
+        head = rendering.collection_head(_url, links, ASSIGNEE_TEMPLATE)
         #Create the items
-        items = []
-        for assignee in assignee_db: 
-            _id = assignee['user']
-            _nickname = g.db.get_user(_id)
-            _url = api.url_for(Assignees, taskid=taskid)
-            assignee = {}
-            assignee['href'] = _url
-            assignee['data'] = []
-            value0 = {'name':'user_id', 'value':_id}
-            value1 = {'name':'nickname', 'value':_nickname}
-            assignee['data'].append(value0)
-            assignee['data'].append(value1)
-            assignee['links'] = []
-            items.append(assignee)
-        collection['items'] = items
+        stream = wants_stream()
+        if stream:
+            assignee_db = g.db.iter_assignees(taskid)
+        else:
+            assignee_db = g.db.get_assignees(taskid)
         
         #RENDER
-        return envelope
+        return render_collection(head, (self._item(_url, assignee)
+                                        for assignee in assignee_db),
+                                 headers, stream)
+
+    def _item(self, _url, assignee):
+        '''
+        Create the Collection+JSON item of an assignee returned by the
+        database API. _url is the URL of the collection.
+        '''
+        _id = assignee['user']
+        _nickname = assignee['nickname']
+        assignee = {}
+        assignee['href'] = _url
+        assignee['data'] = []
+        value0 = {'name':'user_id', 'value':_id}
+        value1 = {'name':'nickname', 'value':_nickname}
+        assignee['data'].append(value0)
+        assignee['data'].append(value1)
+        assignee['links'] = []
+        return assignee
 
     
     def post(self,taskid):
@@ -793,15 +1349,11 @@ class Assignees(Resource):
                                              "Be sure you include task title, category, description, priority and status",
                                              "Tasks")
 
-        userid = g.db.get_user_id(nickname)
-        if not userid:
+        #Fails only if the nickname does not exist
+        if not g.db.assign_to_task_by_nickname(taskid, nickname):
             return create_error_response(404, "No such username",
                                               "Be sure you have a right username",
                                               "Assignees")
-        
-        newassignee = g.db.assign_to_task(taskid,userid)
-        if not newassignee:
-            abort(500)
                
         url = api.url_for(Assignees, taskid=taskid)
 
@@ -811,8 +1363,7 @@ class Assignees(Resource):
 class Assignee(Resource):
     
     def delete(self,taskid,username):
-        userid = g.db.get_user_id(username)
-        if g.db.remove_assignee(taskid,userid):
+        if g.db.remove_assignee_by_nickname(taskid,username):
             #RENDER RESPONSE
             return '', 204
         else:
@@ -826,42 +1377,48 @@ class Team(Resource):
     def get(self, leaderid):
         '''
         Returns 200 if OK
-        
+        Returns 400 if depth is not valid
+
+        INPUT:
+          * depth (query string): levels of the hierarchy under the leader,
+            1 (default) for the direct reports, all for everyone.
+
         Meditype: collection + JSON
         Profile: User profile?
+        Item data: nickname and depth (0 for the leader)
         '''
-        team_db = g.db.get_team(leaderid)
+        depth = request.args.get('depth', '1')
+        try:
+            depth = None if depth == 'all' else int(depth)
+            if depth is not None and depth < 1:
+                raise ValueError()
+        except ValueError:
+            return create_error_response(400, "Wrong depth",
+                                         "depth must be a positive integer or all",
+                                         "Team")
+        not_modified, headers = conditional_get('USERS')
+        if not_modified:
+            return not_modified
+        team_db = g.db.get_hierarchy(leaderid, depth)
 
         #Create the envelope
-        envelope = {}
-        collection = {}
-        envelope["collection"] = collection
-        collection['version'] = "1.0"
-        collection['href'] = api.url_for(Team, leaderid=leaderid)
-        #collection['links'] = [{'prompt':'List of all users in the Forum', 
-        #                      'rel':'users-all','href': api.url_for(Users)}
-        #                   ]
-        collection['template'] = {
-          "data" : [
-                {"prompt" : "Member name", "name" : "nickname", "value" : "", "required":True}
-                ]
-        }
+        _url = URLS.url('team', leaderid=leaderid)
+        head = rendering.collection_head(_url, template=TEAM_TEMPLATE)
         #Create the items
         items = []
-        for team in team_db: 
+        for team in team_db:
             _nickname = team['nickname']
-            _url = api.url_for(Team, leaderid=leaderid)
             comment = {}
             comment['href'] = _url
             comment['data'] = []
             value = {'name':'nickname', 'value':_nickname}
             comment['data'].append(value)
+            comment['data'].append({'name':'depth', 'value':team['depth']})
             comment['links'] = []
             items.append(comment)
-        collection['items'] = items
         
         #RENDER
-        return envelope
+        return render_collection(head, items, headers)
 
     def post(self, leaderid):
         '''
@@ -897,11 +1454,20 @@ class Team(Resource):
                                              "Be sure you include task title, category, description, priority and status",
                                              "Tasks")
         
-        userid = g.db.get_user_id(nickname)
-        
-        newcomment = g.db.add_to_team(userid, leaderid)
-        if newcomment == False:
-            abort(500)
+        #None if the nickname does not exist, False if the leader is already
+        #in the team of the user
+        added = g.db.add_to_team_by_nickname(nickname, leaderid)
+        if added is None:
+            return create_error_response(404, "Unknown user",
+                                         "There is no a user with nickname %s"
+                                         % nickname,
+                                         "User")
+        if not added:
+            return create_error_response(409, "Team cycle",
+                                         "The user %s is above the leader %s"
+                                         " in the hierarchy" % (nickname,
+                                                                leaderid),
+                                         "Team")
                
         #Create the Location header with the id of the message created
         #TODO: Add ID to DB api or other witchcraft?
@@ -912,29 +1478,221 @@ class Team(Resource):
 class Team_member(Resource):
     def delete(self, leaderid, nickname):
 
-        memberid = g.db.get_user_id(nickname)
-        if memberid:
-            if g.db.remove_from_team(memberid,leaderid):
-                #RENDER RESPONSE
-                return '', 204
-            else:
-                #GENERATE ERROR RESPONSE
-                return create_error_response(404, "Unknown user",
-                "There is no a user with nickname %s" 
-                % nickname,
-                   "User")
-
+        if g.db.remove_from_team_by_nickname(nickname,leaderid):
+            #RENDER RESPONSE
+            return '', 204
         else:
+            #GENERATE ERROR RESPONSE
             return create_error_response(404, "Unknown team member",
             "There is no team member with nickname %s" % nickname,
             "Team_member")
 
+class Changes(Resource):
+    '''
+    Feed of the changes to tasks, comments and assignments
+    '''
+    def get(self):
+        '''
+        Changes logged after an event, as Server-Sent Events or long poll.
+
+        INPUT:
+          * after (query string) or the Last-Event-ID header: id of the last
+            event the client has seen. Without it the feed starts at the
+            current last event (only new changes are sent).
+          * timeout (query string, long poll only): seconds to wait when
+            there are no changes yet. Default LONG_POLL_TIMEOUT, at most
+            MAX_LONG_POLL_TIMEOUT; 0 returns at once.
+          * limit (query string, long poll only): maximum number of changes.
+            Default DEFAULT_PAGE_SIZE, at most MAX_PAGE_SIZE.
+
+        OUTPUT:
+        If the request accepts text/event-stream, an event stream: one event
+        per change, with the event id, the kind (task, comment or
+        assignment) as event type and the JSON of the item as data, and a
+        comment line every SSE_HEARTBEAT seconds. The stream ends after
+        SSE_MAX_SECONDS; EventSource reconnects with Last-Event-ID. If the
+        changes after the given event have been trimmed from the log a
+        reset event is sent first: the client has to reload the
+        collections.
+
+        Otherwise a Collection+JSON document with the changes (returned as
+        soon as there is one, or empty after timeout) and a next link to
+        poll for the following ones. Item data: event_id, kind, action
+        (created, updated or deleted), date and the links to the task and
+        to the comment or the assigned user.
+
+        Every event stream, and every long poll that has to wait, holds a
+        server thread; NOTIFIER.max_watchers of them are served at the same
+        time by a process (see feed.py).
+
+        Returns 400 if the parameters are not valid, 410 for long polls
+        after trimmed changes and 503, with a Retry-After header, when
+        max_watchers requests are already waiting.
+        '''
+        try:
+            after = request.args.get('after',
+                                     request.headers.get('Last-Event-ID'))
+            after = int(after) if after is not None else None
+            timeout = float(request.args.get('timeout', LONG_POLL_TIMEOUT))
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+            if timeout < 0 or limit < 1 or (after is not None and after < 0):
+                raise ValueError()
+        except ValueError:
+            return create_error_response(400, "Wrong query parameters",
+                                         "after and limit must be positive integers and timeout a positive number",
+                                         "Changes")
+        timeout = min(timeout, MAX_LONG_POLL_TIMEOUT)
+        limit = min(limit, MAX_PAGE_SIZE)
+        first, last = g.db.get_change_bounds()
+        if after is None:
+            after = last
+        reset = after < first - 1
+        if request.accept_mimetypes.best == 'text/event-stream':
+            if not NOTIFIER.acquire():
+                return self._busy()
+            try:
+                response = self._stream(g.db, after, reset, last)
+            except:
+                NOTIFIER.release()
+                raise
+            #Released when the server closes the stream
+            response.call_on_close(NOTIFIER.release)
+            return response
+
+        if reset:
+            return create_error_response(410, "Changes trimmed",
+                                         "The changes after event %d are no longer available, reload the collections and poll after event %d"
+                                         % (after, last),
+                                         "Changes")
+        if after >= last and timeout > 0:
+            if not NOTIFIER.acquire():
+                return self._busy()
+            try:
+                NOTIFIER.wait(after, timeout)
+            finally:
+                NOTIFIER.release()
+        changes = g.db.get_changes(after, limit)
+        if changes:
+            after = changes[-1]['event_id']
+        links = [{"href" : URLS.url('changes') + '?after=%d' % after,
+                  "rel" : "next", "prompt" : "Changes after these ones"}]
+        head = rendering.collection_head(URLS.url('changes'),
+                                         rendering.extend_links(LINKS['tasks'], links))
+        return render_collection(head, (self._item(change) for change in changes),
+                                 {'Cache-Control': 'no-cache'})
+
+    @staticmethod
+    def _busy():
+        '''
+        503 response of get when too many requests are waiting
+        '''
+        response = create_error_response(503, "Too many watchers",
+                                         "The change feed is already serving %d waiting requests, retry later"
+                                         % NOTIFIER.max_watchers,
+                                         "Changes")
+        response.headers['Retry-After'] = str(WATCHERS_RETRY_AFTER)
+        return response
+
+    def _stream(self, db, after, reset, last):
+        '''
+        Event stream response of get
+        '''
+        def events():
+            yield 'retry: %d\n\n' % SSE_RETRY
+            position = after
+            if reset:
+                position = last
+                yield 'id: %d\nevent: reset\ndata: %s\n\n' % (
+                    position, rendering.encode({'after': position}))
+            deadline = time.time() + SSE_MAX_SECONDS
+            while time.time() < deadline:
+                changes = db.get_changes(position, STREAM_CHUNK_ITEMS)
+                for change in changes:
+                    position = change['event_id']
+                    yield 'id: %d\nevent: %s\ndata: %s\n\n' % (
+                        position, change['kind'],
+                        rendering.encode(self._item(change)))
+                if len(changes) < STREAM_CHUNK_ITEMS:
+                    if NOTIFIER.wait(position, SSE_HEARTBEAT) <= position:
+                        yield ': heartbeat\n\n'
+        return Response(stream_with_context(events()),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+
+    @staticmethod
+    def _item(change):
+        '''
+        Create the Collection+JSON item of a change returned by the database
+        API. Its href is the resource that changed.
+        '''
+        _task = change['task_id']
+        links = [{"href" : URLS.url('task', taskid=_task), "rel" : "task", "prompt" : "Task"}]
+        if change['kind'] == 'comment':
+            href = URLS.url('comment', taskid=_task, commentid=change['item_id'])
+            links.append({"href" : href, "rel" : "comment", "prompt" : "Comment"})
+        elif change['kind'] == 'assignment':
+            href = URLS.url('assignees', taskid=_task)
+            if change['nickname'] is not None:
+                links.append({"href" : URLS.url('user', username=change['nickname']),
+                              "rel" : "user", "prompt" : "Assigned user"})
+        else:
+            href = links[0]['href']
+        data = [{'name':'event_id', 'value':change['event_id']},
+                {'name':'kind', 'value':change['kind']},
+                {'name':'action', 'value':change['action']},
+                {'name':'date', 'value':change['date']}]
+        if change['kind'] == 'assignment':
+            data.append({'name':'user_id', 'value':change['item_id']})
+        return {'href':href, 'data':data, 'links':links}
+
+class Stats(Resource):
+    '''
+    Summary of the tasks for dashboards
+    '''
+    def get(self):
+        '''
+        Number of tasks by status, category and priority, and the workload of
+        each assignee. The counts are kept up to date by the database, so no
+        task is read.
+
+        OUTPUT:
+         * Media type: application/hal+json
+         * Profile: Stats profile
+         * total: number of tasks. status, category and priority: objects
+           from each value to its number of tasks.
+         * assignees: list with user, nickname, tasks (number of tasks
+           assigned) and status (by status of the task), with a link to the
+           user.
+        '''
+        not_modified, headers = conditional_get('TASKS', 'ASSIGNED_TO', 'USERS')
+        if not_modified:
+            return not_modified
+        stats = g.db.get_task_stats()
+        links = {}
+        links['curies'] = [{"name": "msg", "href": PROJECT_PROFILES}]
+        links['self'] = {'href':URLS.url('stats'),
+                         'profile': PROJECT_PROFILES}
+        links['tasks'] = {'href':URLS.url('tasks'),
+                          'profile': PROJECT_PROFILES,
+                          'type':COLLECTIONJSON}
+        for assignee in stats['assignees']:
+            assignee['_links'] = {'user': {
+                'href':URLS.url('user', username=assignee['nickname']),
+                'profile': PROJECT_PROFILES}}
+        envelope = {'_links': links}
+        envelope.update(stats)
+        return Response(json.dumps(envelope), 200, headers=headers,
+                        mimetype=HAL+";"+PROJECT_PROFILES)
+
 app.url_map.converters['regex'] = RegexConverter
 
 
 #Define the routes
 api.add_resource(Tasks, '/project/api/tasks/',
                  endpoint='tasks')
+api.add_resource(TaskSearch, '/project/api/tasks/search/',
+                 endpoint='task_search')
 api.add_resource(Task, '/project/api/tasks/<taskid>/',
                 endpoint='task')
 api.add_resource(Assignees, '/project/api/tasks/<taskid>/assignees/',
@@ -953,6 +1711,23 @@ api.add_resource(Team, '/project/api/users/team/<leaderid>/',
                  endpoint='team')
 api.add_resource(Team_member, '/project/api/users/team/<leaderid>/<nickname>/',
                  endpoint='team_member')
+api.add_resource(Changes, '/project/api/changes/',
+                 endpoint='changes')
+api.add_resource(Stats, '/project/api/stats/',
+                 endpoint='stats')
+
+#URL templates used to render the resources (see compile_rendering)
+URLS.register('tasks')
+URLS.register('task', 'taskid')
+URLS.register('task_search')
+URLS.register('assignees', 'taskid')
+URLS.register('comments', 'taskid')
+URLS.register('comment', 'taskid', 'commentid')
+URLS.register('users')
+URLS.register('user', 'username')
+URLS.register('team', 'leaderid')
+URLS.register('changes')
+URLS.register('stats')
 
 #Start the application
 if __name__ == '__main__':
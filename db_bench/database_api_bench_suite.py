@@ -0,0 +1,317 @@
+'''
+Benchmark of every public ProjectDatabase method at scale.
+
+For each dataset size (number of tasks, see db_bench/datasets.py) a copy of
+the generated dataset is opened and each method is called up to
+--iterations times, or until --max-seconds have been spent on it. Reads
+run first, then writes, then the methods that delete rows, each one on
+rows no earlier method has removed. The latency of every call is recorded
+and the report gives ops per second and the p50, p95 and p99 latencies.
+
+The generated datasets are kept in --data-dir (bench_<tasks>_<seed>.db) and
+reused by later runs; --output saves the results as JSON and --compare
+prints the change against a saved run and exits with status 1 if any
+method got slower than --threshold.
+
+Run from the root directory:
+
+python -m db_bench.database_api_bench_suite [--sizes 10000 100000 1000000]
+          [--iterations N] [--max-seconds S] [--seed N] [--methods NAME...]
+          [--output FILE] [--compare FILE] [--threshold RATIO]
+'''
+import argparse, itertools, json, math, os, platform, sqlite3, sys, time
+from timeit import default_timer as timer
+
+import db_api.database
+from db_bench import datasets
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_ITERATIONS = 1000
+DEFAULT_MAX_SECONDS = 5.0
+DEFAULT_DATA_DIR = 'db'
+#Working copy of the dataset being measured
+db_path = 'db/project_bench.db'
+#Relative slowdown of the p50 latency reported as a regression by --compare
+DEFAULT_THRESHOLD = 0.25
+PERCENTILES = [50, 95, 99]
+#Page size of the methods that read a page of a collection
+PAGE = 50
+
+
+class Dataset(object):
+    '''
+    Sizes of the dataset being measured and the addresses of its rows
+    '''
+
+    def __init__(self, tasks, seed):
+        self.tasks = tasks
+        self.users = datasets.users_for(tasks)
+        self.leaders = datasets.leaders_for(tasks)
+        self.members = self.users - self.leaders
+        self.comments = tasks * datasets.COMMENTS_PER_TASK
+        self.words = datasets.vocabulary(seed)
+
+    def task(self, i):
+        return i * 7919 % self.tasks + 1
+
+    def user(self, i):
+        return i * 104729 % self.users + 1
+
+    def member(self, i, block=0, blocks=1):
+        '''
+        A member (nobody reports to them) of the block-th of blocks
+        disjoint ranges of members
+        '''
+        size = self.members // blocks
+        return self.leaders + block * size + i % size + 1
+
+    def leader(self, i):
+        return i % self.leaders + 1
+
+    def word(self, i):
+        return self.words[i * 31 % len(self.words)]
+
+
+def nickname(user_id):
+    return 'user%d' % user_id
+
+def _task_row(i):
+    return dict(title='Bench task %d' % i, category='bug',
+                description='Added by the benchmark', priority=i % 4 + 1,
+                status=i % 4 + 1)
+
+#(method, call, limit): call(db, dataset, i) makes the i-th call of the
+#method; limit(dataset), if given, is the number of calls that find a row
+#to work on. Methods can appear more than once with a label in brackets.
+READS = [
+    ('get_schema_version', lambda db, d, i: db.get_schema_version(), None),
+    ('get_table_versions', lambda db, d, i: db.get_table_versions(['TASKS', 'USERS']), None),
+    ('get_cache_stats', lambda db, d, i: db.get_cache_stats(), None),
+    ('get_change_bounds', lambda db, d, i: db.get_change_bounds(), None),
+    ('get_changes', lambda db, d, i: db.get_changes(0, PAGE), None),
+    ('get_users', lambda db, d, i: db.get_users(), None),
+    ('iter_users', lambda db, d, i: list(itertools.islice(db.iter_users(), PAGE)), None),
+    ('get_user', lambda db, d, i: db.get_user(d.user(i)), None),
+    ('get_role', lambda db, d, i: db.get_role(d.user(i)), None),
+    ('get_user_id', lambda db, d, i: db.get_user_id(nickname(d.user(i))), None),
+    ('get_team', lambda db, d, i: db.get_team(d.leader(i)), None),
+    ('get_hierarchy', lambda db, d, i: db.get_hierarchy(1), None),
+    ('get_chain_of_command', lambda db, d, i: db.get_chain_of_command(d.user(i)), None),
+    ('get_task', lambda db, d, i: db.get_task(d.task(i)), None),
+    ('get_tasks', lambda db, d, i: db.get_tasks(PAGE, after_id=d.task(i)), None),
+    ('get_tasks[sort]', lambda db, d, i: db.get_tasks(PAGE, sort='-priority'), None),
+    ('get_tasks[filter]', lambda db, d, i: db.get_tasks(PAGE, status=i % 4 + 1,
+                                                        category='bug'), None),
+    ('iter_tasks', lambda db, d, i: list(itertools.islice(
+                        db.iter_tasks(after_id=d.task(i)), PAGE)), None),
+    ('search_tasks', lambda db, d, i: db.search_tasks(d.word(i)), None),
+    ('get_task_stats', lambda db, d, i: db.get_task_stats(), None),
+    ('get_tasks_since', lambda db, d, i: db.get_tasks_since(d.task(i), PAGE), None),
+    ('get_users_since', lambda db, d, i: db.get_users_since(d.user(i), PAGE), None),
+    ('get_comments_since', lambda db, d, i: db.get_comments_since(d.task(i), 0), None),
+    ('get_assignees_since', lambda db, d, i: db.get_assignees_since(d.task(i), 0), None),
+    ('get_assigned_users', lambda db, d, i: db.get_assigned_users(d.task(i)), None),
+    ('iter_assigned_users', lambda db, d, i: list(db.iter_assigned_users(d.task(i))), None),
+    ('get_assignees', lambda db, d, i: db.get_assignees(d.task(i)), None),
+    ('iter_assignees', lambda db, d, i: list(db.iter_assignees(d.task(i))), None),
+    ('get_comments', lambda db, d, i: db.get_comments(d.task(i)), None),
+    ('iter_comments', lambda db, d, i: list(db.iter_comments(d.task(i))), None),
+]
+WRITES = [
+    ('add_task', lambda db, d, i: db.add_task(**_task_row(i)), None),
+    ('add_tasks', lambda db, d, i: db.add_tasks([_task_row(i)] * 100), None),
+    ('update_task', lambda db, d, i: db.update_task(d.task(i), title='Updated %d' % i,
+                                                    priority=i % 4 + 1), None),
+    ('update_title', lambda db, d, i: db.update_title(d.task(i), 'Title %d' % i), None),
+    ('update_description', lambda db, d, i: db.update_description(d.task(i), 'Description %d' % i), None),
+    ('update_category', lambda db, d, i: db.update_category(d.task(i), 'UX'), None),
+    ('update_priority', lambda db, d, i: db.update_priority(d.task(i), i % 4 + 1), None),
+    ('update_status', lambda db, d, i: db.update_status(d.task(i), i % 4 + 1), None),
+    ('add_comment', lambda db, d, i: db.add_comment('Comment %d' % i, d.task(i)), None),
+    ('assign_to_task', lambda db, d, i: db.assign_to_task(d.task(i), d.user(i)), None),
+    ('assign_to_task_by_nickname', lambda db, d, i: db.assign_to_task_by_nickname(
+                                        d.task(i), nickname(d.user(i))), None),
+    ('add_user', lambda db, d, i: db.add_user('bench%d' % i, 'bench@example.com',
+                                              'member', d.leader(i)), None),
+    ('update_username', lambda db, d, i: db.update_username(nickname(d.user(i)),
+                                                            nickname(d.user(i))), None),
+    ('add_to_team', lambda db, d, i: db.add_to_team(d.member(i, 0, 2), d.leader(i)), None),
+    ('remove_from_team', lambda db, d, i: db.remove_from_team(d.member(i, 0, 2), d.leader(i)), None),
+    ('add_to_team_by_nickname', lambda db, d, i: db.add_to_team_by_nickname(
+                                     nickname(d.member(i, 1, 2)), d.leader(i)), None),
+    ('remove_from_team_by_nickname', lambda db, d, i: db.remove_from_team_by_nickname(
+                                          nickname(d.member(i, 1, 2)), d.leader(i)), None),
+    ('trim_changes', lambda db, d, i: db.trim_changes(1000), None),
+    ('rebuild_task_stats', lambda db, d, i: db.rebuild_task_stats(), None),
+]
+#Each call removes a different row
+DELETES = [
+    ('remove_assignee', lambda db, d, i: db.remove_assignee(
+        i + 1, datasets.first_assignee(i + 1, d.users)), lambda d: d.tasks // 2),
+    ('remove_assignee_by_nickname', lambda db, d, i: db.remove_assignee_by_nickname(
+        d.tasks - i, nickname(datasets.first_assignee(d.tasks - i, d.users))),
+        lambda d: d.tasks // 2),
+    ('delete_comment', lambda db, d, i: db.delete_comment(i + 1), lambda d: d.comments),
+    ('remove_task', lambda db, d, i: db.remove_task(d.tasks - i), lambda d: d.tasks),
+    ('delete_user', lambda db, d, i: db.delete_user(d.users - i), lambda d: d.members),
+]
+BENCHMARKS = READS + WRITES + DELETES
+#Public methods that are not measured: the connection handling and the
+#set up of the database
+SKIPPED = ['connection', 'close', 'clean', 'load_init_values', 'migrate',
+           'create_tables_from_schema', 'load_table_values_from_dump']
+
+def unmeasured():
+    '''
+    Public ProjectDatabase methods missing from BENCHMARKS and SKIPPED
+    '''
+    measured = set(name.split('[')[0] for name, call, limit in BENCHMARKS)
+    return sorted(name for name in dir(db_api.database.ProjectDatabase)
+                  if not name.startswith('_') and
+                  callable(getattr(db_api.database.ProjectDatabase, name)) and
+                  name not in measured and name not in SKIPPED)
+
+def percentile(latencies, p):
+    '''
+    Nearest rank percentile of a sorted list
+    '''
+    rank = int(math.ceil(p / 100.0 * len(latencies)))
+    return latencies[max(rank, 1) - 1]
+
+def measure(db, dataset, call, iterations, max_seconds):
+    '''
+    Time the calls of a method. Returns a dict with calls, seconds,
+    ops_per_second, mean_ms, max_ms and the p<n>_ms of PERCENTILES.
+    '''
+    latencies = []
+    total = 0.0
+    for i in range(iterations):
+        start = timer()
+        call(db, dataset, i)
+        latency = timer() - start
+        latencies.append(latency)
+        total += latency
+        if total >= max_seconds:
+            break
+    latencies.sort()
+    result = dict(calls=len(latencies), seconds=total,
+                  ops_per_second=len(latencies) / total if total else 0.0,
+                  mean_ms=total * 1000 / len(latencies),
+                  max_ms=latencies[-1] * 1000)
+    for p in PERCENTILES:
+        result['p%d_ms' % p] = percentile(latencies, p) * 1000
+    return result
+
+def run_size(tasks, args, out):
+    '''
+    Benchmark the selected methods on a copy of the dataset of tasks tasks.
+    Returns a dict from method to measure results.
+    '''
+    def progress(step):
+        out.write('  generating %d tasks: %s\n' % (tasks, step))
+    template = datasets.dataset(args.data_dir, tasks, args.seed, progress)
+    datasets.copy(template, db_path)
+    dataset = Dataset(tasks, args.seed)
+    out.write('\n%d tasks\n%-30s %7s %10s %9s %9s %9s\n'
+              % (tasks, 'method', 'calls', 'ops/s', 'p50 ms', 'p95 ms',
+                 'p99 ms'))
+    db = db_api.database.ProjectDatabase(db_path)
+    results = {}
+    try:
+        for name, call, limit in BENCHMARKS:
+            if args.methods and name.split('[')[0] not in args.methods \
+               and name not in args.methods:
+                continue
+            iterations = args.iterations
+            if limit is not None:
+                iterations = min(iterations, limit(dataset))
+            result = measure(db, dataset, call, iterations, args.max_seconds)
+            results[name] = result
+            out.write('%-30s %7d %10.1f %9.3f %9.3f %9.3f\n'
+                      % (name, result['calls'], result['ops_per_second'],
+                         result['p50_ms'], result['p95_ms'], result['p99_ms']))
+    finally:
+        db.close()
+        os.remove(db_path)
+    return results
+
+def compare(baseline, current, threshold, out):
+    '''
+    Print the change of ops/s and p50 latency of every method measured in
+    both runs. Returns the list of (size, method) whose p50 latency grew
+    more than threshold (a ratio).
+    '''
+    regressions = []
+    for size in sorted(current['results'], key=int):
+        if size not in baseline['results']:
+            continue
+        out.write('\n%s tasks: change against %s\n' % (size, baseline['meta']['date']))
+        out.write('%-30s %12s %12s\n' % ('method', 'ops/s', 'p50'))
+        old_results = baseline['results'][size]
+        for name, result in sorted(current['results'][size].items()):
+            if name not in old_results:
+                continue
+            old = old_results[name]
+            speed = result['ops_per_second'] / old['ops_per_second'] - 1
+            latency = result['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0.0
+            flag = ''
+            if latency > threshold:
+                regressions.append((size, name))
+                flag = '  REGRESSION'
+            out.write('%-30s %+11.1f%% %+11.1f%%%s\n'
+                      % (name, speed * 100, latency * 100, flag))
+    return regressions
+
+def main(argv=None, out=sys.stdout):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ProjectDatabase methods on generated '
+                    'datasets.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='numbers of tasks of the datasets '
+                             '(default %(default)s)')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS,
+                        help='maximum calls per method (default %(default)s)')
+    parser.add_argument('--max-seconds', type=float, default=DEFAULT_MAX_SECONDS,
+                        help='maximum time per method (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generated data (default %(default)s)')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR,
+                        help='directory of the generated datasets '
+                             '(default %(default)s)')
+    parser.add_argument('--methods', nargs='+',
+                        help='only measure these methods')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='p50 slowdown reported as a regression '
+                             '(default %(default)s)')
+    args = parser.parse_args(argv)
+
+    missing = unmeasured()
+    if missing:
+        out.write('Not benchmarked: %s\n' % ', '.join(missing))
+    report = {'meta': {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'seed': args.seed,
+                       'iterations': args.iterations,
+                       'max_seconds': args.max_seconds,
+                       'python': platform.python_version(),
+                       'sqlite': sqlite3.sqlite_version,
+                       'platform': platform.platform()},
+              'results': {}}
+    for tasks in args.sizes:
+        report['results'][str(tasks)] = run_size(tasks, args, out)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold, out)
+        if regressions:
+            out.write('\n%d regressions\n' % len(regressions))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
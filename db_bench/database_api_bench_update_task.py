@@ -0,0 +1,51 @@
+'''
+Benchmark for updating all the fields of a task.
+
+Compares the chain of update_title, update_description, update_category,
+update_priority and update_status (one transaction each) against a single
+update_task call.
+
+Run from the root directory:
+
+python -m db_bench.database_api_bench_update_task [rounds]
+'''
+import os, sys, time
+
+import db_api.database
+
+db_path = 'db/project_bench.db'
+
+def chain(db, task_id, i):
+    db.get_task(task_id)
+    db.update_title(task_id, 'Title %d' % i)
+    db.update_description(task_id, 'Description %d' % i)
+    db.update_category(task_id, 'backend')
+    db.update_priority(task_id, i % 4 + 1)
+    db.update_status(task_id, i % 4 + 1)
+
+def single(db, task_id, i):
+    db.update_task(task_id, title='Title %d' % i,
+                   description='Description %d' % i, category='backend',
+                   priority=i % 4 + 1, status=i % 4 + 1)
+
+def run(function, db, rounds):
+    start = time.time()
+    for i in range(rounds):
+        function(db, 1, i)
+    return time.time() - start
+
+def main(rounds=1000):
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db = db_api.database.ProjectDatabase(db_path)
+    db.load_init_values()
+    try:
+        for name, function in [('chain', chain), ('update_task', single)]:
+            elapsed = run(function, db, rounds)
+            print '%-12s %8.1f updates/s  %7.3f ms/update' % \
+                  (name, rounds / elapsed, elapsed * 1000 / rounds)
+    finally:
+        db.clean()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
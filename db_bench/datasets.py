@@ -0,0 +1,159 @@
+'''
+Deterministic synthetic datasets for the benchmarks.
+
+generate(path, tasks, seed) builds a database with the given number of
+tasks and matching users, comments and assignments. The same (tasks, seed)
+always gives the same database, so results of different runs (and of
+different commits) can be compared. The layout is regular so that the
+benchmarks can address rows without reading them:
+
+ * users: users_for(tasks) of them, nickname 'user<id>'. The first
+   leaders_for(tasks) users are leaders, each one under an earlier leader
+   (a multi-level hierarchy); the others are members under a leader, so
+   nobody reports to them.
+ * tasks: ids 1..tasks, created one minute apart.
+ * comments: COMMENTS_PER_TASK per task, ids (t-1)*COMMENTS_PER_TASK+1...
+ * assignments: task t is assigned to first_assignee(t, users) and every
+   third task also to second_assignee(t, users).
+
+Rows are loaded with db_api.importer into a database without indexes or
+triggers and the migrations are run afterwards, which builds the indexes,
+the search index and the trigger-maintained tables in bulk.
+'''
+import os, random, shutil
+from datetime import datetime, timedelta
+
+import db_api.database
+import db_api.importer
+
+#Tasks per user, tasks per leader and comments per task of the datasets
+TASKS_PER_USER = 20
+USERS_PER_LEADER = 20
+COMMENTS_PER_TASK = 2
+#First created_date of the generated tasks
+START_DATE = datetime(2015, 1, 1)
+#Words of the titles, descriptions and comments
+VOCABULARY_SIZE = 2000
+
+def users_for(tasks):
+    return max(10, tasks // TASKS_PER_USER)
+
+def leaders_for(tasks):
+    return max(1, users_for(tasks) // USERS_PER_LEADER)
+
+def first_assignee(task_id, users):
+    return (task_id - 1) % users + 1
+
+def second_assignee(task_id, users):
+    '''
+    Second assignee of every third task, None for the others
+    '''
+    if task_id % 3:
+        return None
+    user_id = (task_id * 7) % users + 1
+    return user_id if user_id != first_assignee(task_id, users) else None
+
+def vocabulary(seed):
+    '''
+    The VOCABULARY_SIZE pseudo-words used in the texts of a dataset
+    '''
+    rng = random.Random(seed)
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'pe', 'ja',
+                 'ho', 'ku', 'le', 'ma', 'no', 'ri', 'se', 'to', 'va', 'yu']
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add(''.join(rng.choice(syllables)
+                          for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+def _text(rng, words, count):
+    return ' '.join(rng.choice(words) for _ in range(count))
+
+def _users(tasks, rng):
+    users, leaders = users_for(tasks), leaders_for(tasks)
+    for user_id in range(1, users + 1):
+        if user_id == 1:
+            boss = None
+        elif user_id <= leaders:
+            boss = rng.randint(1, user_id - 1)
+        else:
+            boss = rng.randint(1, leaders)
+        yield dict(id=user_id, nickname='user%d' % user_id,
+                   email='user%d@example.com' % user_id,
+                   role='leader' if user_id <= leaders else 'member',
+                   boss=boss)
+
+def _tasks(tasks, rng, words):
+    for task_id in range(1, tasks + 1):
+        created = START_DATE + timedelta(minutes=task_id)
+        yield dict(id=task_id, title=_text(rng, words, 3),
+                   category=rng.choice(db_api.database.TASK_CATEGORIES),
+                   description=_text(rng, words, 12),
+                   priority=rng.choice(db_api.database.TASK_LEVELS),
+                   status=rng.choice(db_api.database.TASK_LEVELS),
+                   created_date=created.strftime('%Y-%m-%d %H:%M:%S'))
+
+def _comments(tasks, rng, words):
+    comment_id = 0
+    for task_id in range(1, tasks + 1):
+        for n in range(COMMENTS_PER_TASK):
+            comment_id += 1
+            created = START_DATE + timedelta(minutes=task_id, seconds=n + 1)
+            yield dict(comment_id=comment_id, comment=_text(rng, words, 8),
+                       task_id=task_id,
+                       commented_date=created.strftime('%Y-%m-%d %H:%M:%S'))
+
+def _assignments(tasks):
+    users = users_for(tasks)
+    for task_id in range(1, tasks + 1):
+        yield dict(user_id=first_assignee(task_id, users), task_id=task_id)
+        second = second_assignee(task_id, users)
+        if second is not None:
+            yield dict(user_id=second, task_id=task_id)
+
+def generate(path, tasks, seed=0, progress=None):
+    '''
+    Write the dataset of the given number of tasks and seed to path,
+    replacing the file if it exists. progress is called with the name of
+    each step.
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    words = vocabulary(seed)
+    db = db_api.database.ProjectDatabase(path)
+    try:
+        db.create_tables_from_schema()
+        for table, rows in [('users', _users(tasks, rng)),
+                            ('tasks', _tasks(tasks, rng, words)),
+                            ('comments', _comments(tasks, rng, words)),
+                            ('assignments', _assignments(tasks))]:
+            if progress is not None:
+                progress(table)
+            db_api.importer.import_rows(db, table, rows,
+                                        defer_foreign_keys=True)
+        if progress is not None:
+            progress('migrations')
+        db.migrate()
+    finally:
+        db.close()
+
+def dataset(directory, tasks, seed=0, progress=None):
+    '''
+    Path of the dataset of the given number of tasks and seed in directory,
+    generated the first time it is asked for. The file is a template: copy
+    it (see copy) before writing to it.
+    '''
+    path = os.path.join(directory, 'bench_%d_%d.db' % (tasks, seed))
+    if not os.path.exists(path):
+        tmp = path + '.tmp'
+        generate(tmp, tasks, seed, progress)
+        os.rename(tmp, path)
+    return path
+
+def copy(template, path):
+    '''
+    Copy a generated dataset to path, where it can be modified
+    '''
+    shutil.copyfile(template, path)
+    return path
@@ -0,0 +1,358 @@
+'''
+Load generator for the REST API of db_api/resources.py.
+
+A number of worker threads (--concurrency) send a weighted random mix of
+requests for --duration seconds or until --requests have been sent:
+
+ * list_tasks: GET a page of the tasks collection
+ * get_task: GET a task
+ * post_comment: POST a comment to a task
+ * assign_user: POST an assignee to a task
+ * update_task: PUT a task
+
+The requests go to a running server (--url, one keep-alive connection per
+worker) or, without --url, through the Flask test client to a copy of a
+generated dataset (--tasks, see db_bench/datasets.py) so that the whole
+application is measured without the network. The task ids and the
+nicknames used are read from the API before the run.
+
+The report gives per endpoint the number of requests, the throughput, the
+p50/p95/p99 latencies and the error rate (responses with status 400 or
+above and failed connections); --output saves it as JSON.
+
+Run from the root directory:
+
+python -m db_bench.resources_bench_load [--url http://localhost:5000]
+          [--concurrency N] [--duration S] [--requests N] [--tasks N]
+          [--mix list_tasks=4,get_task=3,...] [--seed N] [--output FILE]
+'''
+import argparse, httplib, json, os, platform, random, re, sys, threading, time
+import urlparse
+from timeit import default_timer as timer
+
+import db_api.database
+from db_api import resources
+from db_bench import datasets
+from db_bench.database_api_bench_suite import percentile, PERCENTILES
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_DURATION = 10.0
+DEFAULT_TASKS = 10000
+DEFAULT_DATA_DIR = 'db'
+#Working copy of the dataset used with the test client
+db_path = 'db/project_bench_load.db'
+#Relative weights of the operations in the default mix
+DEFAULT_MIX = [('list_tasks', 4), ('get_task', 3), ('post_comment', 1),
+               ('assign_user', 1), ('update_task', 1)]
+#Number of task ids read from the tasks collection before the run
+DISCOVER_TASKS = 500
+PAGE = 50
+TASK_URL = re.compile(r'/project/api/tasks/(\d+)/')
+
+def _template(**values):
+    return json.dumps({'template': {'data': [
+        {'name': name, 'value': value} for name, value in values.items()]}})
+
+#Each operation returns (method, path, body) for a random task or user
+def list_tasks(rng, tasks, users):
+    return 'GET', '/project/api/tasks/?limit=%d&after=%d' \
+                  % (PAGE, rng.choice(tasks)), None
+
+def get_task(rng, tasks, users):
+    return 'GET', '/project/api/tasks/%d/' % rng.choice(tasks), None
+
+def post_comment(rng, tasks, users):
+    return 'POST', '/project/api/tasks/%d/comments/' % rng.choice(tasks), \
+           _template(comment='Load test comment %d' % rng.randint(0, 10 ** 6))
+
+def assign_user(rng, tasks, users):
+    return 'POST', '/project/api/tasks/%d/assignees/' % rng.choice(tasks), \
+           _template(nickname=rng.choice(users))
+
+def update_task(rng, tasks, users):
+    return 'PUT', '/project/api/tasks/%d/' % rng.choice(tasks), \
+           _template(title='Load test %d' % rng.randint(0, 10 ** 6),
+                     category=rng.choice(db_api.database.TASK_CATEGORIES),
+                     description='Updated by the load test',
+                     priority=rng.choice(db_api.database.TASK_LEVELS),
+                     status=rng.choice(db_api.database.TASK_LEVELS))
+
+OPERATIONS = {'list_tasks': list_tasks, 'get_task': get_task,
+              'post_comment': post_comment, 'assign_user': assign_user,
+              'update_task': update_task}
+
+
+class TestClient(object):
+    '''
+    Sends the requests through the Flask test client of the application
+    '''
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        '''
+        Returns (status, body)
+        '''
+        response = self.client.open(path, method=method, data=body,
+                                    content_type='application/json'
+                                    if body is not None else None)
+        return response.status_code, response.data
+
+    def close(self):
+        pass
+
+
+class HTTPClient(object):
+    '''
+    Sends the requests to a server over a keep-alive HTTP connection,
+    opened again after an error
+    '''
+
+    def __init__(self, url):
+        parts = urlparse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.con = None
+
+    def request(self, method, path, body=None):
+        if self.con is None:
+            self.con = httplib.HTTPConnection(self.host, self.port, timeout=30)
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        try:
+            self.con.request(method, self.prefix + path, body, headers)
+            response = self.con.getresponse()
+            data = response.read()
+        except:
+            self.close()
+            raise
+        if response.getheader('connection', '').lower() == 'close':
+            self.close()
+        return response.status, data
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+
+def discover(client):
+    '''
+    Task ids and nicknames to use in the requests, read from the API
+    '''
+    status, data = client.request('GET', '/project/api/tasks/?limit=%d'
+                                  % DISCOVER_TASKS)
+    if status != 200:
+        raise RuntimeError('GET tasks returned %d' % status)
+    tasks = [int(TASK_URL.search(item['href']).group(1))
+             for item in json.loads(data)['collection']['items']]
+    status, data = client.request('GET', '/project/api/users/')
+    if status != 200:
+        raise RuntimeError('GET users returned %d' % status)
+    users = [d['value'] for item in json.loads(data)['collection']['items']
+             for d in item['data'] if d['name'] == 'nickname']
+    if not tasks or not users:
+        raise RuntimeError('The database has no tasks or no users')
+    return tasks, users
+
+
+class Worker(threading.Thread):
+    '''
+    Sends requests until the deadline or until the shared budget of
+    requests is spent. samples is a list of (operation, seconds, status);
+    status is None for a failed request.
+    '''
+
+    def __init__(self, client, mix, tasks, users, seed, deadline, budget):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.client = client
+        self.choices = [name for name, weight in mix for _ in range(weight)]
+        self.tasks = tasks
+        self.users = users
+        self.rng = random.Random(seed)
+        self.deadline = deadline
+        self.budget = budget
+        self.samples = []
+
+    def run(self):
+        try:
+            while time.time() < self.deadline and self.budget.take():
+                name = self.rng.choice(self.choices)
+                method, path, body = OPERATIONS[name](self.rng, self.tasks,
+                                                      self.users)
+                start = timer()
+                try:
+                    status = self.client.request(method, path, body)[0]
+                except Exception:
+                    status = None
+                self.samples.append((name, timer() - start, status))
+        finally:
+            self.client.close()
+
+
+class Budget(object):
+    '''
+    Number of requests left for all the workers, None for no limit
+    '''
+
+    def __init__(self, requests):
+        self.left = requests
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.left is None:
+            return True
+        with self.lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+def summarize(samples, elapsed):
+    '''
+    Dict with requests, errors, error_rate, requests_per_second, mean_ms,
+    max_ms, the p<n>_ms of PERCENTILES and statuses (count by status,
+    "failed" for connection errors) of a list of samples
+    '''
+    latencies = sorted(seconds for name, seconds, status in samples)
+    statuses = {}
+    errors = 0
+    for name, seconds, status in samples:
+        key = str(status) if status is not None else 'failed'
+        statuses[key] = statuses.get(key, 0) + 1
+        if status is None or status >= 400:
+            errors += 1
+    result = dict(requests=len(samples), errors=errors,
+                  error_rate=float(errors) / len(samples),
+                  requests_per_second=len(samples) / elapsed,
+                  mean_ms=sum(latencies) * 1000 / len(latencies),
+                  max_ms=latencies[-1] * 1000, statuses=statuses)
+    for p in PERCENTILES:
+        result['p%d_ms' % p] = percentile(latencies, p) * 1000
+    return result
+
+def run(make_client, mix, concurrency, duration, requests, seed):
+    '''
+    Run the load and return (elapsed, {operation: summary, 'all': summary})
+    '''
+    client = make_client()
+    try:
+        tasks, users = discover(client)
+    finally:
+        client.close()
+    budget = Budget(requests)
+    deadline = time.time() + duration if duration else float('inf')
+    workers = [Worker(make_client(), mix, tasks, users, seed + n, deadline,
+                      budget)
+               for n in range(concurrency)]
+    start = timer()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(0.5)
+    elapsed = timer() - start
+    samples = [sample for worker in workers for sample in worker.samples]
+    results = {}
+    for name, weight in mix:
+        selected = [sample for sample in samples if sample[0] == name]
+        if selected:
+            results[name] = summarize(selected, elapsed)
+    if samples:
+        results['all'] = summarize(samples, elapsed)
+    return elapsed, results
+
+def parse_mix(value):
+    '''
+    Parse a mix given as name=weight,name=weight
+    '''
+    mix = []
+    for part in value.split(','):
+        name, weight = part.split('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError('Unknown operation %s' % name)
+        mix.append((name, int(weight)))
+    return mix
+
+def main(argv=None, out=sys.stdout):
+    parser = argparse.ArgumentParser(
+        description='Send a mix of requests to the project API and report '
+                    'throughput, latency and errors per endpoint.')
+    parser.add_argument('--url', help='base URL of a running server; '
+                        'without it the Flask test client is used')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='worker threads (default %(default)s)')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION,
+                        help='seconds to run, 0 for no limit '
+                             '(default %(default)s)')
+    parser.add_argument('--requests', type=int,
+                        help='stop after this number of requests')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='weights of the operations, e.g. '
+                             'list_tasks=4,get_task=3,post_comment=1')
+    parser.add_argument('--tasks', type=int, default=DEFAULT_TASKS,
+                        help='size of the generated dataset used with the '
+                             'test client (default %(default)s)')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR,
+                        help='directory of the generated datasets '
+                             '(default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the data and of the requests '
+                             '(default %(default)s)')
+    parser.add_argument('--output', help='save the results as JSON')
+    args = parser.parse_args(argv)
+    if not args.duration and not args.requests:
+        parser.error('give --duration or --requests')
+
+    db = None
+    if args.url:
+        make_client = lambda: HTTPClient(args.url)
+    else:
+        template = datasets.dataset(args.data_dir, args.tasks, args.seed)
+        db = db_api.database.ProjectDatabase(
+            datasets.copy(template, db_path), pool_size=args.concurrency)
+        resources.app.config['DATABASE'] = db
+        #Errors are counted as 500 responses instead of raised
+        resources.app.debug = False
+        make_client = lambda: TestClient(resources.app)
+    try:
+        elapsed, results = run(make_client, args.mix, args.concurrency,
+                               args.duration, args.requests, args.seed)
+    finally:
+        if db is not None:
+            db.close()
+            os.remove(db_path)
+
+    out.write('%d workers, %.1f s, target %s\n'
+              % (args.concurrency, elapsed, args.url or 'test client'))
+    out.write('%-14s %8s %9s %9s %9s %9s %8s\n'
+              % ('endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms',
+                 'p99 ms', 'errors'))
+    for name in [name for name, weight in args.mix] + ['all']:
+        if name not in results:
+            continue
+        result = results[name]
+        out.write('%-14s %8d %9.1f %9.3f %9.3f %9.3f %7.2f%%\n'
+                  % (name, result['requests'], result['requests_per_second'],
+                     result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                     result['error_rate'] * 100))
+    if args.output:
+        report = {'meta': {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                           'target': args.url or 'test client',
+                           'tasks': None if args.url else args.tasks,
+                           'concurrency': args.concurrency,
+                           'seconds': elapsed,
+                           'mix': dict(args.mix),
+                           'seed': args.seed,
+                           'python': platform.python_version(),
+                           'platform': platform.platform()},
+                  'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
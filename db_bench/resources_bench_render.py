@@ -0,0 +1,74 @@
+'''
+Microbenchmark for rendering the tasks collection.
+
+Compares building every URL with url_for and serializing the whole
+envelope (the way the resources used to render collections) against the
+URL templates and pre-encoded fragments of db_api/rendering.py. No
+database is used, only synthetic task dicts.
+
+Run from the root directory:
+
+python -m db_bench.resources_bench_render [items] [rounds]
+'''
+import json, sys, time
+
+from flask import url_for
+
+from db_api import resources
+from db_api.resources import app, Tasks, TASK_TEMPLATE, URLS, LINKS
+from db_api import rendering
+
+def make_tasks(count):
+    return [dict(task_id=i, title='Task %d' % i, category='bug',
+                 description='Description %d' % i, priority=i % 4 + 1,
+                 status=i % 4 + 1, date='2015-03-01 12:00:00')
+            for i in range(1, count + 1)]
+
+def render_url_for(tasks):
+    envelope = {}
+    collection = {}
+    envelope["collection"] = collection
+    collection['version'] = "1.0"
+    collection['href'] = url_for('tasks')
+    collection['links'] = [{"href" : url_for('users'), "rel" : "users-all", "prompt" : "Users in the system"}]
+    collection['template'] = json.loads(TASK_TEMPLATE)
+    items = []
+    for task in tasks:
+        _task = task['task_id']
+        item = {}
+        item['href'] = url_for('task', taskid=_task)
+        item['data'] = [{'name':'title', 'value':task['title']},
+                        {'name':'category', 'value':task['category']},
+                        {'name':'status', 'value':task['status']},
+                        {'name':'date', 'value':task['date']}]
+        item['links'] = [{"href" : url_for('comments', taskid=_task), "rel" : "Comments", "prompt" : "Comments for this task"},
+                         {"href" : url_for('assignees', taskid=_task), "rel" : "Assignees", "prompt" : "Assignees for this task"}]
+        items.append(item)
+    collection['items'] = items
+    return json.dumps(envelope)
+
+def render_templates(tasks):
+    head = rendering.collection_head(URLS.url('tasks'), LINKS['tasks'],
+                                     TASK_TEMPLATE)
+    item = Tasks()._item
+    return ''.join(rendering.iter_collection(head,
+                                             (item(task) for task in tasks),
+                                             resources.STREAM_CHUNK_ITEMS))
+
+def main(count=1000, rounds=20):
+    tasks = make_tasks(count)
+    with app.test_request_context('/project/api/tasks/'):
+        resources.compile_rendering()
+        #Both renderings must produce the same document
+        assert json.loads(render_url_for(tasks)) == \
+               json.loads(render_templates(tasks))
+        for name, render in [('url_for', render_url_for),
+                             ('templates', render_templates)]:
+            start = time.time()
+            for _ in range(rounds):
+                render(tasks)
+            elapsed = time.time() - start
+            print '%-10s %10.0f items/s' % (name, count * rounds / elapsed)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
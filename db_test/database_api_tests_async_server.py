@@ -0,0 +1,142 @@
+import socket, threading, time, unittest
+
+from db_api.async_server import AsyncWSGIServer
+
+#Set to answer the requests to /watch
+changed = threading.Event()
+
+def echo_app(environ, start_response):
+    '''
+    WSGI application answering with the method, the path, the query and
+    the body of the request
+    '''
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    body = '%s %s %s %s' % (environ['REQUEST_METHOD'], environ['PATH_INFO'],
+                            environ['QUERY_STRING'],
+                            environ['wsgi.input'].read(length))
+    if environ['PATH_INFO'] == '/slow':
+        time.sleep(0.2)
+    elif environ['PATH_INFO'] == '/watch':
+        changed.wait(5)
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+class AsyncServerTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def setUp(self):
+        changed.clear()
+        self.server = AsyncWSGIServer('127.0.0.1', 0, echo_app, threads=2,
+                                      long_paths=['/watch'])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        changed.set()
+        self.server.shutdown()
+        self.thread.join()
+
+    def _connect(self):
+        sock = socket.create_connection((self.server.host, self.server.port))
+        sock.settimeout(5)
+        return sock
+
+    def _read_response(self, sock):
+        data = ''
+        while '\r\n\r\n' not in data:
+            data += sock.recv(4096)
+        head, body = data.split('\r\n\r\n', 1)
+        length = int([line.split(':')[1] for line in head.split('\r\n')
+                      if line.lower().startswith('content-length')][0])
+        while len(body) < length:
+            body += sock.recv(4096)
+        return head, body
+
+    def test_keep_alive(self):
+        '''
+        Test that two requests are answered on the same connection
+        '''
+        print '('+self.test_keep_alive.__name__+')', \
+              self.test_keep_alive.__doc__
+        sock = self._connect()
+        sock.sendall('GET /a?x=1 HTTP/1.1\r\nHost: test\r\n\r\n')
+        head, body = self._read_response(sock)
+        self.assertTrue(head.startswith('HTTP/1.1 200 OK'))
+        self.assertEquals(body, 'GET /a x=1 ')
+        sock.sendall('POST /b HTTP/1.1\r\nHost: test\r\n'
+                     'Content-Length: 5\r\n\r\nhello')
+        head, body = self._read_response(sock)
+        self.assertEquals(body, 'POST /b  hello')
+        sock.close()
+
+    def test_pipelined_order(self):
+        '''
+        Test that pipelined requests are answered in order
+        '''
+        print '('+self.test_pipelined_order.__name__+')', \
+              self.test_pipelined_order.__doc__
+        sock = self._connect()
+        sock.sendall('GET /slow HTTP/1.1\r\nHost: test\r\n\r\n'
+                     'GET /fast HTTP/1.1\r\nHost: test\r\n\r\n')
+        self.assertEquals(self._read_response(sock)[1], 'GET /slow  ')
+        self.assertEquals(self._read_response(sock)[1], 'GET /fast  ')
+        sock.close()
+
+    def test_stalled_clients(self):
+        '''
+        Test that clients that do not finish their request hold no thread
+        '''
+        print '('+self.test_stalled_clients.__name__+')', \
+              self.test_stalled_clients.__doc__
+        stalled = []
+        for _ in range(10):
+            sock = self._connect()
+            sock.sendall('GET /stalled HTTP/1.1\r\n')
+            stalled.append(sock)
+        sock = self._connect()
+        sock.sendall('GET /ok HTTP/1.1\r\nHost: test\r\n\r\n')
+        self.assertEquals(self._read_response(sock)[1], 'GET /ok  ')
+        for s in stalled + [sock]:
+            s.close()
+
+    def test_long_requests(self):
+        '''
+        Test that requests waiting for changes do not hold the executor threads
+        '''
+        print '('+self.test_long_requests.__name__+')', \
+              self.test_long_requests.__doc__
+        watchers = []
+        for _ in range(5):
+            sock = self._connect()
+            sock.sendall('GET /watch HTTP/1.1\r\nHost: test\r\n\r\n')
+            watchers.append(sock)
+        sock = self._connect()
+        sock.sendall('GET /ok HTTP/1.1\r\nHost: test\r\n\r\n')
+        self.assertEquals(self._read_response(sock)[1], 'GET /ok  ')
+        self.assertEquals(self.server.long_requests, 5)
+        changed.set()
+        for watcher in watchers:
+            self.assertEquals(self._read_response(watcher)[1], 'GET /watch  ')
+            watcher.close()
+        sock.close()
+
+    def test_bad_request(self):
+        '''
+        Test that a malformed request is answered with 400 and closed
+        '''
+        print '('+self.test_bad_request.__name__+')', \
+              self.test_bad_request.__doc__
+        sock = self._connect()
+        sock.sendall('garbage\r\n\r\n')
+        head, body = self._read_response(sock)
+        self.assertTrue(head.startswith('HTTP/1.1 400'))
+        self.assertEquals(sock.recv(10), '')
+        sock.close()
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
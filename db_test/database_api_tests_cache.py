@@ -0,0 +1,109 @@
+import sqlite3, time, unittest
+
+import db_api.database
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+class CacheDbAPITestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def test_hits_and_misses(self):
+        '''
+        Test that repeated lookups are served from the cache
+        '''
+        print '('+self.test_hits_and_misses.__name__+')', \
+              self.test_hits_and_misses.__doc__
+        before = db.get_cache_stats()
+        self.assertEquals(db.get_user_id('Seppo'), 1)
+        self.assertEquals(db.get_user_id('Seppo'), 1)
+        self.assertEquals(db.get_task('1')['task_id'], 1)
+        self.assertEquals(db.get_task(1)['task_id'], 1)
+        after = db.get_cache_stats()
+        self.assertEquals(after['misses'] - before['misses'], 2)
+        self.assertEquals(after['hits'] - before['hits'], 2)
+
+    def test_cached_task_is_a_copy(self):
+        '''
+        Test that modifying a returned task does not modify the cache
+        '''
+        print '('+self.test_cached_task_is_a_copy.__name__+')', \
+              self.test_cached_task_is_a_copy.__doc__
+        db.get_task(1)['title'] = 'Changed'
+        self.assertNotEquals(db.get_task(1)['title'], 'Changed')
+
+    def test_write_invalidation(self):
+        '''
+        Test that the write methods invalidate their cache entries
+        '''
+        print '('+self.test_write_invalidation.__name__+')', \
+              self.test_write_invalidation.__doc__
+        db.get_task(1)
+        db.update_title(1, 'New title')
+        self.assertEquals(db.get_task(1)['title'], 'New title')
+        db.update_task('1', status=3)
+        self.assertEquals(db.get_task(1)['status'], 3)
+        db.remove_task(1)
+        self.assertFalse(db.get_task(1))
+
+        db.get_user_id('Teppo')
+        db.update_username('Teppo', 'Tepi')
+        self.assertFalse(db.get_user_id('Teppo'))
+        self.assertEquals(db.get_user_id('Tepi'), 2)
+        db.delete_user(2)
+        self.assertFalse(db.get_user_id('Tepi'))
+
+    def test_external_write(self):
+        '''
+        Test that a write from another connection clears the cache
+        '''
+        print '('+self.test_external_write.__name__+')', \
+              self.test_external_write.__doc__
+        checked = db_api.database.ProjectDatabase(db_path,
+                                                  version_check_interval=0)
+        try:
+            checked.get_task(2)
+            con = sqlite3.connect(db_path)
+            with con:
+                con.execute("UPDATE tasks SET title='External' WHERE id=2")
+            con.close()
+            self.assertEquals(checked.get_task(2)['title'], 'External')
+        finally:
+            checked.close()
+
+    def test_version_check_interval(self):
+        '''
+        Test that an external write is seen once the check interval has passed
+        '''
+        print '('+self.test_version_check_interval.__name__+')', \
+              self.test_version_check_interval.__doc__
+        throttled = db_api.database.ProjectDatabase(db_path,
+                                                    version_check_interval=0.2)
+        try:
+            self.assertEquals(throttled.get_task(1)['status'], 1)
+            con = sqlite3.connect(db_path)
+            with con:
+                con.execute('UPDATE tasks SET status=2 WHERE id=1')
+            con.close()
+            #Served from the cache without reading data_version
+            self.assertEquals(throttled.get_task(1)['status'], 1)
+            time.sleep(0.25)
+            self.assertEquals(throttled.get_task(1)['status'], 2)
+        finally:
+            throttled.close()
+
+    def test_stale_put(self):
+        '''
+        Test that a value read before an invalidation is not cached
+        '''
+        print '('+self.test_stale_put.__name__+')', \
+              self.test_stale_put.__doc__
+        generation = db.cache.generation
+        db.cache.invalidate('task', 1)
+        db.cache.put('task', 1, {'title': 'Stale'}, generation)
+        self.assertEquals(db.cache.get('task', 1), (False, None))
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
@@ -0,0 +1,113 @@
+import threading, time, unittest
+
+from db_api.feed import ChangeNotifier
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+def _events(changes):
+    return [(c['kind'], c['action'], c['task_id'], c['item_id'])
+            for c in changes]
+
+class ChangesDbAPITestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def test_initial_data_not_logged(self):
+        '''
+        Test that the log starts empty after loading the initial values
+        '''
+        print '('+self.test_initial_data_not_logged.__name__+')', \
+              self.test_initial_data_not_logged.__doc__
+        self.assertEquals(db.get_changes(), [])
+        self.assertEquals(db.get_change_bounds(), (1, 0))
+
+    def test_task_changes(self):
+        '''
+        Test the events of task, comment and assignment writes
+        '''
+        print '('+self.test_task_changes.__name__+')', \
+              self.test_task_changes.__doc__
+        db.add_task('Logged', 'bug', 'Change log', 1, 1)
+        db.update_task(3, title='Logged again', status=2)
+        db.add_comment('Logged comment', 3)
+        db.assign_to_task(3, 2)
+        db.delete_comment(3)
+        db.remove_assignee(3, 2)
+        self.assertEquals(_events(db.get_changes()), [
+            ('task', 'created', 3, None),
+            ('task', 'updated', 3, None),
+            ('comment', 'created', 3, 3),
+            ('assignment', 'created', 3, 2),
+            ('comment', 'deleted', 3, 3),
+            ('assignment', 'deleted', 3, 2)])
+        changes = db.get_changes(after_id=3, limit=1)
+        self.assertEquals(changes[0]['event_id'], 4)
+        self.assertEquals(changes[0]['nickname'], 'Teppo')
+
+    def test_cascade_logged(self):
+        '''
+        Test that removing a task logs the deletion of its comments and assignments
+        '''
+        print '('+self.test_cascade_logged.__name__+')', \
+              self.test_cascade_logged.__doc__
+        db.remove_task(2)
+        events = _events(db.get_changes())
+        self.assertIn(('comment', 'deleted', 2, 2), events)
+        self.assertEquals(events[-1], ('task', 'deleted', 2, None))
+
+    def test_trim_changes(self):
+        '''
+        Test that trim_changes keeps the last events and the bounds show the gap
+        '''
+        print '('+self.test_trim_changes.__name__+')', \
+              self.test_trim_changes.__doc__
+        for i in range(5):
+            db.update_title(1, 'Title %d' % i)
+        self.assertEquals(db.trim_changes(2), 3)
+        self.assertEquals(db.get_change_bounds(), (4, 5))
+        self.assertEquals([c['event_id'] for c in db.get_changes()], [4, 5])
+        self.assertEquals(db.trim_changes(0), 2)
+        self.assertEquals(db.get_change_bounds(), (6, 5))
+
+    def test_notifier(self):
+        '''
+        Test that ChangeNotifier wakes up the waiting threads after a write
+        '''
+        print '('+self.test_notifier.__name__+')', \
+              self.test_notifier.__doc__
+        notifier = ChangeNotifier(lambda: db.get_change_bounds()[1], 0.05)
+        try:
+            self.assertEquals(notifier.wait(-1, 1), 0)
+            results = []
+            waiter = threading.Thread(
+                target=lambda: results.append(notifier.wait(0, 5)))
+            start = time.time()
+            waiter.start()
+            db.update_title(1, 'Wake up')
+            waiter.join()
+            self.assertEquals(results, [1])
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            notifier.stop()
+        #Let the polling thread finish before the database is removed
+        time.sleep(0.1)
+
+    def test_max_watchers(self):
+        '''
+        Test that ChangeNotifier counts at most max_watchers watchers
+        '''
+        print '('+self.test_max_watchers.__name__+')', \
+              self.test_max_watchers.__doc__
+        notifier = ChangeNotifier(lambda: db.get_change_bounds()[1],
+                                  max_watchers=2)
+        self.assertTrue(notifier.acquire())
+        self.assertTrue(notifier.acquire())
+        self.assertFalse(notifier.acquire())
+        self.assertEquals(notifier.watchers, 2)
+        notifier.release()
+        self.assertTrue(notifier.acquire())
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
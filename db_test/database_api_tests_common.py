@@ -1,10 +1,48 @@
-import unittest, os
+import unittest, os, shutil, sqlite3
 
 import db_api.database
 
 #Path to the database file, different from the deployment db
 db_path = 'db/project_test.db'
 db = db_api.database.ProjectDatabase(db_path)
+#Seeded database built once per test run and copied before each test
+template_path = 'db/project_test_template.db'
+#Copy of the template used by RollbackTestCase
+rollback_path = 'db/project_test_rollback.db'
+_template_built = False
+_rollback_db = None
+
+def template():
+    '''
+    Build the template database with the initial values (schema, data dump
+    and migrations) the first time it is called in the test run and return
+    its path. It is built again in every run, so it follows the changes to
+    the schema, the dump and the migrations.
+    '''
+    global _template_built
+    if not _template_built:
+        if os.path.exists(template_path):
+            os.remove(template_path)
+        builder = db_api.database.ProjectDatabase(template_path)
+        builder.load_init_values()
+        builder.close()
+        _template_built = True
+    return template_path
+
+def rollback_db():
+    '''
+    The ProjectDatabase of RollbackTestCase: one connection, opened on the
+    first call, to a copy of the template
+    '''
+    global _rollback_db
+    if _rollback_db is None:
+        shutil.copyfile(template(), rollback_path)
+        con = sqlite3.connect(rollback_path)
+        for pragma in db_api.database.CONNECTION_PRAGMAS:
+            con.execute(pragma)
+        _rollback_db = db_api.database.ProjectDatabase(rollback_path,
+                                                       connection=con)
+    return _rollback_db
 
 class BaseTestCase(unittest.TestCase):
     '''
@@ -15,17 +53,58 @@ class BaseTestCase(unittest.TestCase):
     def setUp(self):
         '''
         Clean the database (in SQLite you can remove the whole database file)
-        and create a new one for loading the inital values.
+        and create a new one with the inital values.
         '''
         #Be sure that there is no database.
         #This specially is useful if the clean process was not success.
         if os.path.exists(db_path):
             os.remove(db_path)
-        #This method load the initial values from forum_data_dump.sql
-        #It creates the database if it does not exist.
-        db.load_init_values()
+        #Copy of the database built by load_init_values, which is only run
+        #once per test run
+        shutil.copyfile(template(), db_path)
 
     def tearDown(self):
         db.clean()
         pass
 
+    def assertUsesIndexes(self, method, *args, **kwargs):
+        '''
+        Call method (a method of db) with profiling enabled and fail if one
+        of its statements scans a whole TASKS, COMMENTS, ASSIGNED_TO or
+        USERS table. Returns the result of the call.
+        '''
+        #A cached lookup would not run any statement
+        db.cache.clear()
+        profiler = db.enable_profiling()
+        try:
+            result = method(*args, **kwargs)
+        finally:
+            db.disable_profiling()
+        self.assertTrue(profiler.statements,
+                        '%s ran no statement' % method.__name__)
+        scans = profiler.scans()
+        if scans:
+            self.fail('%s scans a table:\n%s' % (method.__name__, '\n'.join(
+                '%s\n    %s' % (stats.sql, '\n    '.join(stats.plan))
+                for stats in scans)))
+        return result
+
+
+class RollbackTestCase(BaseTestCase):
+    '''
+    Base class for the tests that only use the methods of ProjectDatabase.
+    self.db shares one connection (see rollback_db) between all the tests
+    and every test runs in a transaction that tearDown rolls back, so the
+    database is neither copied nor rebuilt between tests. The tests must not
+    call methods that run executescript (migrate, load_init_values,
+    rebuild_task_stats): the script commits the transaction.
+    '''
+
+    def setUp(self):
+        self.db = rollback_db()
+        self.db.pool.con.execute('BEGIN')
+
+    def tearDown(self):
+        self.db.pool.con.execute('ROLLBACK')
+        #The cache may hold values written by the test
+        self.db.cache.clear()
@@ -0,0 +1,235 @@
+import os, sqlite3, tempfile, unittest
+
+import db_api.importer
+from db_api.importer import import_file, import_rows, DataImportError
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+class ImporterTestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def _write(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_import_ndjson(self):
+        '''
+        Test importing tasks from NDJSON in several batches
+        '''
+        print '('+self.test_import_ndjson.__name__+')', \
+              self.test_import_ndjson.__doc__
+        lines = ['{"title": "Imported %d", "category": "bug", "description": "", '
+                 '"priority": 1, "status": 2}' % i for i in range(25)]
+        path = self._write('.ndjson', '\n'.join(lines) + '\n\n')
+        counts = []
+        stats = import_file(db, 'tasks', path, batch_size=10,
+                            progress=counts.append)
+        self.assertEquals(stats['rows'], 25)
+        self.assertEquals(counts, [10, 20, 25])
+        self.assertEquals(len(db.get_tasks()), 27)
+        self.assertEquals(db.get_task(27)['title'], 'Imported 24')
+
+    def test_import_csv(self):
+        '''
+        Test importing users and assignments from CSV
+        '''
+        print '('+self.test_import_csv.__name__+')', \
+              self.test_import_csv.__doc__
+        users = self._write('.csv', 'nickname,email,role,boss\n'
+                                    'Ismo,ismo@jippii.fi,member,1\n'
+                                    'Jaana,jaana@jippii.fi,leader,\n')
+        assignments = self._write('.csv', 'user_id,task_id\n5,2\n6,2\n')
+        self.assertEquals(import_file(db, 'users', users)['rows'], 2)
+        self.assertEquals(import_file(db, 'assignments', assignments)['rows'], 2)
+        self.assertEquals(db.get_assigned_users(2), [{'user':5}, {'user':6}])
+        self.assertEquals(db.get_user_id('Jaana'), 6)
+
+    def test_deferred_checks(self):
+        '''
+        Test deferred foreign keys and index rebuild
+        '''
+        print '('+self.test_deferred_checks.__name__+')', \
+              self.test_deferred_checks.__doc__
+        rows = [{'comment': 'Deferred', 'task_id': 1}] * 5
+        stats = import_rows(db, 'comments', rows, batch_size=2,
+                            defer_foreign_keys=True, defer_indexes=True)
+        self.assertEquals(stats['rows'], 5)
+        self.assertEquals(len(db.get_comments(1)), 6)
+        with db.connection() as con:
+            index = con.execute("SELECT name FROM sqlite_master WHERE name='comments_task_id'").fetchone()
+            foreign_keys = con.execute('PRAGMA foreign_keys').fetchone()[0]
+        self.assertIsNotNone(index)
+        self.assertEquals(foreign_keys, 1)
+
+        #Rows pointing to a task that does not exist are reported and
+        #nothing is imported, also from the batches before the orphan
+        rows = [{'comment': 'Kept?', 'task_id': 1}] * 3 + \
+               [{'comment': 'Orphan', 'task_id': 99}]
+        self.assertRaises(DataImportError, import_rows, db, 'comments', rows,
+                          batch_size=2, defer_foreign_keys=True)
+        self.assertEquals(len(db.get_comments(1)), 6)
+        with db.connection() as con:
+            orphans = con.execute('SELECT count(*) FROM comments WHERE task_id=99').fetchone()[0]
+            foreign_keys = con.execute('PRAGMA foreign_keys').fetchone()[0]
+        self.assertEquals(orphans, 0)
+        self.assertEquals(foreign_keys, 1)
+
+    def test_failed_batch(self):
+        '''
+        Test that the rows of a failed batch are rolled back and the previous batches kept
+        '''
+        print '('+self.test_failed_batch.__name__+')', \
+              self.test_failed_batch.__doc__
+        rows = [{'title': 'Batch %d' % i, 'category': 'bug', 'priority': 1,
+                 'status': 1} for i in range(4)]
+        #The second row of the second batch breaks the CHECK of priority
+        rows[3]['priority'] = 9
+        self.assertRaises(Exception, import_rows, db, 'tasks', rows,
+                          batch_size=2)
+        titles = [task['title'] for task in db.get_tasks()]
+        self.assertIn('Batch 1', titles)
+        self.assertNotIn('Batch 2', titles)
+
+    def test_deferred_stats(self):
+        '''
+        Test that the task statistics are recounted after a deferred load
+        '''
+        print '('+self.test_deferred_stats.__name__+')', \
+              self.test_deferred_stats.__doc__
+        #An assignment stored before its task, as by a connection without
+        #foreign keys: its trigger found no task to count
+        con = sqlite3.connect(db_path)
+        with con:
+            con.execute('INSERT INTO assigned_to(user_id, task_id) VALUES (3, 10)')
+        con.close()
+        import_rows(db, 'tasks', [{'id': 10, 'title': 'Late', 'category': 'bug',
+                                   'priority': 1, 'status': 4}],
+                    defer_foreign_keys=True)
+        stats = db.get_task_stats()
+        self.assertEquals(stats['status'][4], 1)
+        self.assertEquals([assignee['status'] for assignee in stats['assignees']
+                           if assignee['user'] == 3], [{1: 1, 4: 1}])
+
+    def test_boss_after_member(self):
+        '''
+        Test that the team hierarchy is complete when a user is imported before their boss
+        '''
+        print '('+self.test_boss_after_member.__name__+')', \
+              self.test_boss_after_member.__doc__
+        import_rows(db, 'users',
+                    [{'id': 10, 'nickname': 'Ismo', 'email': 'ismo@jippii.fi',
+                      'role': 'member', 'boss': 11},
+                     {'id': 11, 'nickname': 'Jaana', 'email': 'jaana@jippii.fi',
+                      'role': 'leader', 'boss': 1}],
+                    defer_foreign_keys=True)
+        self.assertEquals(db.get_team(11, None),
+                          [{'nickname': 'Jaana'}, {'nickname': 'Ismo'}])
+        self.assertEquals([boss['user_id'] for boss in db.get_chain_of_command(10)],
+                          [11, 1])
+        self.assertIn(10, [member['user_id'] for member in db.get_hierarchy(1)])
+        #The cycle check sees the imported users
+        self.assertFalse(db.add_to_team(1, 10))
+
+    def _triggers(self):
+        with db.connection() as con:
+            return con.execute("SELECT name, sql FROM sqlite_master \
+                                    WHERE type='trigger' ORDER BY name").fetchall()
+
+    def test_bulk(self):
+        '''
+        Test that a bulk load fills the tables maintained by the triggers and keeps the triggers
+        '''
+        print '('+self.test_bulk.__name__+')', \
+              self.test_bulk.__doc__
+        triggers = self._triggers()
+        versions = db.get_table_versions(['TASKS', 'COMMENTS'])
+        last_change = db.get_change_bounds()[1]
+        last_seq = db.get_tasks_since(0)[-1]['seq']
+        tasks = [{'id': 10 + i, 'title': 'Bulk %d' % i, 'category': 'bug',
+                  'description': 'zebra', 'priority': 1, 'status': 4}
+                 for i in range(5)]
+        self.assertEquals(import_rows(db, 'tasks', tasks, batch_size=2,
+                                      bulk=True)['rows'], 5)
+        self.assertEquals(import_rows(db, 'comments',
+                                      [{'comment': 'giraffe', 'task_id': 12}],
+                                      bulk=True)['rows'], 1)
+        self.assertEquals(self._triggers(), triggers)
+        #One version per load, not per row
+        new_versions = db.get_table_versions(['TASKS', 'COMMENTS'])
+        self.assertEquals(new_versions['TASKS'][0], versions['TASKS'][0] + 1)
+        self.assertEquals(new_versions['COMMENTS'][0],
+                          versions['COMMENTS'][0] + 1)
+        self.assertEquals([(change['kind'], change['task_id'])
+                           for change in db.get_changes(last_change)],
+                          [('task', 10 + i) for i in range(5)] +
+                          [('comment', 12)])
+        self.assertEquals([task['task_id'] for task in db.get_tasks_since(last_seq)],
+                          range(10, 15))
+        self.assertEquals(len(db.search_tasks('zebra')), 5)
+        self.assertEquals([task['task_id'] for task in db.search_tasks('giraffe')],
+                          [12])
+        self.assertEquals(db.get_task_stats()['status'][4], 5)
+        #The triggers work again for the next load
+        import_rows(db, 'comments', [{'comment': 'okapi', 'task_id': 13}])
+        self.assertEquals([task['task_id'] for task in db.search_tasks('okapi')],
+                          [13])
+
+    def test_bulk_failure(self):
+        '''
+        Test that a failed bulk load keeps nothing and leaves the triggers in place
+        '''
+        print '('+self.test_bulk_failure.__name__+')', \
+              self.test_bulk_failure.__doc__
+        triggers = self._triggers()
+        rows = [{'id': 10 + i, 'title': 'Bulk %d' % i, 'category': 'bug',
+                 'priority': 1, 'status': 1} for i in range(4)]
+        #Task 2 already exists
+        rows[3]['id'] = 2
+        self.assertRaises(sqlite3.IntegrityError, import_rows, db, 'tasks',
+                          rows, batch_size=2, bulk=True)
+        self.assertEquals(self._triggers(), triggers)
+        self.assertFalse(db.get_task(10))
+        #The connections commit again after every batch
+        rows[3]['priority'] = 9
+        self.assertRaises(Exception, import_rows, db, 'tasks', rows,
+                          batch_size=2)
+        self.assertTrue(db.get_task(11))
+        self.assertFalse(db.get_task(12))
+
+    def test_main_errors(self):
+        '''
+        Test that the command line reports constraint violations without a traceback
+        '''
+        print '('+self.test_main_errors.__name__+')', \
+              self.test_main_errors.__doc__
+        path = self._write('.ndjson', '{"id": 2, "title": "Again", '
+                                      '"category": "bug", "priority": 1, '
+                                      '"status": 1}\n')
+        self.assertEquals(db_api.importer.main(['tasks', path, '--db', db_path]), 1)
+        self.assertEquals(db_api.importer.main(['tasks', path, '--db', db_path,
+                                                '--bulk']), 1)
+
+    def test_unknown_columns(self):
+        '''
+        Test that unknown tables and columns are rejected
+        '''
+        print '('+self.test_unknown_columns.__name__+')', \
+              self.test_unknown_columns.__doc__
+        self.assertRaises(DataImportError, import_rows, db, 'nothere', [{}])
+        self.assertRaises(DataImportError, import_rows, db, 'users',
+                          [{'nickname': 'Ismo', 'password': 'x'}])
+        #Also in a row after the first one
+        self.assertRaises(DataImportError, import_rows, db, 'users',
+                          [{'nickname': 'Ismo', 'email': 'ismo@jippii.fi'},
+                           {'nickname': 'Jaana', 'email': 'jaana@jippii.fi',
+                            'role': 'leader'}])
+        self.assertFalse(db.get_user_id('Ismo'))
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
@@ -0,0 +1,121 @@
+import threading, unittest
+
+import db_api.database
+from db_api.metrics import Metrics, InstrumentedDatabase
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+class MetricsDbAPITestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def test_thread_aggregation(self):
+        '''
+        Test that the stats written by several threads are added up
+        '''
+        print '('+self.test_thread_aggregation.__name__+')', \
+              self.test_thread_aggregation.__doc__
+        metrics = Metrics()
+        labels = (('endpoint', 'tasks'),)
+        def work():
+            stats = metrics.stats()
+            for i in range(100):
+                stats.inc('project_db_calls_total', labels)
+                stats.observe('project_http_request_db_calls', labels, i % 4)
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counters, histograms = metrics.collect()
+        self.assertEquals(counters[('project_db_calls_total', labels)], 400)
+        buckets, total, count = histograms[('project_http_request_db_calls', labels)]
+        #Cumulative buckets 0, 1, 2, 3, 5...
+        self.assertEquals(buckets[:5], [100, 200, 300, 400, 400])
+        self.assertEquals(buckets[-1], 400)
+        self.assertEquals((total, count), (600, 400))
+
+    def test_render(self):
+        '''
+        Test the Prometheus text format of counters and histograms
+        '''
+        print '('+self.test_render.__name__+')', \
+              self.test_render.__doc__
+        metrics = Metrics()
+        stats = metrics.stats()
+        stats.inc('project_http_requests_total',
+                  (('endpoint', 'task'), ('method', 'GET'), ('status', 200)))
+        stats.observe('project_http_request_duration_seconds',
+                      (('endpoint', 'task'), ('method', 'GET')), 0.003)
+        text = metrics.render()
+        self.assertIn('# TYPE project_http_requests_total counter\n', text)
+        self.assertIn('project_http_requests_total{endpoint="task",method="GET",'
+                      'status="200"} 1\n', text)
+        self.assertIn('project_http_request_duration_seconds_bucket{endpoint="task",'
+                      'method="GET",le="0.0025"} 0\n', text)
+        self.assertIn('project_http_request_duration_seconds_bucket{endpoint="task",'
+                      'method="GET",le="0.005"} 1\n', text)
+        self.assertIn('project_http_request_duration_seconds_bucket{endpoint="task",'
+                      'method="GET",le="+Inf"} 1\n', text)
+        self.assertIn('project_http_request_duration_seconds_count{endpoint="task",'
+                      'method="GET"} 1\n', text)
+
+    def test_instrumented_database(self):
+        '''
+        Test that InstrumentedDatabase counts the calls, rows and errors of each method
+        '''
+        print '('+self.test_instrumented_database.__name__+')', \
+              self.test_instrumented_database.__doc__
+        metrics = Metrics()
+        instrumented = InstrumentedDatabase(db, metrics)
+        self.assertEquals(len(instrumented.get_tasks()), 2)
+        self.assertEquals(len(list(instrumented.iter_comments(2))), 1)
+        self.assertTrue(instrumented.get_task(1))
+        self.assertRaises(TypeError, instrumented.get_task)
+        self.assertEquals(instrumented.db_path, db_path)
+        self.assertEquals(instrumented.calls, 4)
+        counters, histograms = metrics.collect()
+        def value(name, method):
+            return counters.get((name, (('method', method),)), 0)
+        self.assertEquals(value('project_db_calls_total', 'get_task'), 2)
+        self.assertEquals(value('project_db_errors_total', 'get_task'), 1)
+        self.assertEquals(value('project_db_rows_total', 'get_tasks'), 2)
+        self.assertEquals(value('project_db_rows_total', 'iter_comments'), 1)
+        self.assertEquals(value('project_db_rows_total', 'get_task'), 1)
+        self.assertTrue(value('project_db_seconds_total', 'get_tasks') > 0)
+
+    def test_statements(self):
+        '''
+        Test that the statements of each method and their rows are counted at the cursor level
+        '''
+        print '('+self.test_statements.__name__+')', \
+              self.test_statements.__doc__
+        metrics = Metrics()
+        database = db_api.database.ProjectDatabase(db_path)
+        try:
+            instrumented = InstrumentedDatabase(database, metrics)
+            self.assertIs(database.pool.profiler, metrics.statements)
+            self.assertEquals(len(instrumented.get_tasks()), 2)
+            self.assertEquals(len(list(instrumented.iter_users())), 4)
+            self.assertTrue(instrumented.update_task(1, status=2))
+            #Not instrumented
+            database.get_users()
+        finally:
+            database.close()
+        counters, histograms = metrics.collect()
+        def value(name, method):
+            return counters.get((name, (('method', method),)), 0)
+        self.assertEquals(value('project_db_statements_total', 'get_tasks'), 1)
+        self.assertEquals(value('project_db_statement_rows_total', 'get_tasks'), 2)
+        self.assertEquals(value('project_db_statements_total', 'iter_users'), 1)
+        self.assertEquals(value('project_db_statement_rows_total', 'iter_users'), 4)
+        self.assertEquals(value('project_db_statement_rows_total', 'update_task'), 1)
+        self.assertTrue(value('project_db_statement_seconds_total', 'get_tasks') > 0)
+        self.assertEquals(value('project_db_statements_total', 'get_users'), 0)
+        self.assertIn('project_db_statements_total{method="get_tasks"} 1\n',
+                      metrics.render())
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
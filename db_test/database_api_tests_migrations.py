@@ -0,0 +1,87 @@
+import sqlite3, unittest
+
+import db_api.database
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+class MigrationsDbAPITestCase(BaseTestCase):
+
+    indexes = ['comments_task_id', 'assigned_to_task_user',
+               'assigned_to_user', 'users_boss']
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def _index_names(self):
+        with db.connection() as con:
+            rows = con.execute("SELECT name FROM sqlite_master WHERE type='index'")
+            return [row[0] for row in rows]
+
+    def test_schema_version(self):
+        '''
+        Test that load_init_values leaves the database at the last version
+        '''
+        print '('+self.test_schema_version.__name__+')', \
+              self.test_schema_version.__doc__
+        self.assertEquals(db.get_schema_version(),
+                          len(db_api.database.MIGRATIONS))
+        for index in self.indexes:
+            self.assertIn(index, self._index_names())
+
+    def test_migrate_old_database(self):
+        '''
+        Test that a database created without migrations is upgraded in place
+        '''
+        print '('+self.test_migrate_old_database.__name__+')', \
+              self.test_migrate_old_database.__doc__
+        with db.connection() as con:
+            for index in self.indexes:
+                con.execute('DROP INDEX %s' % index)
+            con.execute('PRAGMA user_version = 0')
+        version = db.migrate()
+        self.assertEquals(version, len(db_api.database.MIGRATIONS))
+        for index in self.indexes:
+            self.assertIn(index, self._index_names())
+        #Data is kept
+        self.assertEquals(len(db.get_users()), 4)
+        #Running it again does nothing
+        self.assertEquals(db.migrate(), version)
+
+    def test_table_versions(self):
+        '''
+        Test that writes bump the change version of their table only
+        '''
+        print '('+self.test_table_versions.__name__+')', \
+              self.test_table_versions.__doc__
+        tables = ['TASKS', 'USERS', 'COMMENTS', 'ASSIGNED_TO']
+        before = db.get_table_versions(tables)
+        self.assertEquals(sorted(before), sorted(tables))
+        db.update_title(1, 'Versioned')
+        db.add_comment('Versioned', 1)
+        after = db.get_table_versions(tables)
+        self.assertEquals(after['TASKS'][0], before['TASKS'][0] + 1)
+        self.assertEquals(after['COMMENTS'][0], before['COMMENTS'][0] + 1)
+        self.assertEquals(after['USERS'], before['USERS'])
+        self.assertTrue(after['TASKS'][1] >= before['TASKS'][1])
+
+    def test_failed_migration(self):
+        '''
+        Test that a failing step is rolled back and keeps the old version
+        '''
+        print '('+self.test_failed_migration.__name__+')', \
+              self.test_failed_migration.__doc__
+        version = db.get_schema_version()
+        db_api.database.MIGRATIONS.append(
+            'CREATE TABLE broken(id INTEGER); INSERT INTO nothere VALUES (1);')
+        try:
+            self.assertRaises(sqlite3.OperationalError, db.migrate)
+        finally:
+            db_api.database.MIGRATIONS.pop()
+        self.assertEquals(db.get_schema_version(), version)
+        with db.connection() as con:
+            tables = con.execute("SELECT name FROM sqlite_master WHERE name='broken'").fetchall()
+        self.assertEquals(tables, [])
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
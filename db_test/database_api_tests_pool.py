@@ -0,0 +1,117 @@
+import sqlite3, threading, unittest
+
+import db_api.database
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+class PoolDbAPITestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def test_connection_reused(self):
+        '''
+        Test that consecutive calls reuse the same pooled connection
+        '''
+        print '('+self.test_connection_reused.__name__+')', \
+              self.test_connection_reused.__doc__
+        with db.connection() as con:
+            first = con
+        with db.connection() as con:
+            self.assertIs(con, first)
+
+    def test_foreign_keys_on(self):
+        '''
+        Test that the pooled connections have foreign keys enabled
+        '''
+        print '('+self.test_foreign_keys_on.__name__+')', \
+              self.test_foreign_keys_on.__doc__
+        with db.connection() as con:
+            row = con.execute('PRAGMA foreign_keys').fetchone()
+        self.assertEquals(row[0], 1)
+
+    def test_factories_restored(self):
+        '''
+        Test that row_factory changed by a method does not leak to the next one
+        '''
+        print '('+self.test_factories_restored.__name__+')', \
+              self.test_factories_restored.__doc__
+        db.get_user(1)
+        with db.connection() as con:
+            self.assertIsNone(con.row_factory)
+
+    def test_rollback_on_error(self):
+        '''
+        Test that a failing block is rolled back before the connection is reused
+        '''
+        print '('+self.test_rollback_on_error.__name__+')', \
+              self.test_rollback_on_error.__doc__
+        try:
+            with db.connection() as con:
+                con.execute("UPDATE tasks SET title='Broken' WHERE id=1")
+                raise sqlite3.IntegrityError()
+        except sqlite3.IntegrityError:
+            pass
+        self.assertNotEquals(db.get_task(1)['title'], 'Broken')
+
+    def test_pool_size(self):
+        '''
+        Test that threads never open more connections than the pool size
+        '''
+        print '('+self.test_pool_size.__name__+')', \
+              self.test_pool_size.__doc__
+        errors = []
+        def worker():
+            try:
+                for _ in range(20):
+                    db.get_tasks()
+                    db.get_user_id('Seppo')
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(errors, [])
+        self.assertTrue(db.pool._opened <= db.pool.size)
+
+    def test_close(self):
+        '''
+        Test that close() releases the connections and the pool is usable after
+        '''
+        print '('+self.test_close.__name__+')', \
+              self.test_close.__doc__
+        db.get_users()
+        db.close()
+        self.assertEquals(db.pool._opened, 0)
+        self.assertEquals(len(db.get_users()), 4)
+
+    def test_injected_connection(self):
+        '''
+        Test that with an injected connection the calls stay in the transaction of the caller
+        '''
+        print '('+self.test_injected_connection.__name__+')', \
+              self.test_injected_connection.__doc__
+        con = sqlite3.connect(db_path)
+        injected = db_api.database.ProjectDatabase(db_path, connection=con)
+        con.execute('BEGIN')
+        self.assertTrue(injected.add_user('Ismo', 'ismo@jippii.fi', 'member', 1))
+        #A failed call only rolls back its own savepoint
+        with self.assertRaises(ValueError):
+            with injected.connection() as c:
+                c.execute("DELETE FROM USERS WHERE nickname = 'Teppo'")
+                raise ValueError()
+        self.assertEquals(len(injected.get_users()), 5)
+        #The other connections do not see the uncommitted changes
+        self.assertEquals(len(db.get_users()), 4)
+        con.execute('ROLLBACK')
+        self.assertEquals(len(injected.get_users()), 4)
+        #The connection belongs to the caller
+        injected.close()
+        self.assertEquals(con.execute('SELECT count(*) FROM USERS').fetchone()[0], 4)
+        con.close()
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
@@ -0,0 +1,76 @@
+import logging, unittest
+
+from db_api.profiling import QueryProfiler, shape
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+class QueryPlansDbAPITestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+        #The scans found by test_missing_index are expected
+        logging.getLogger('db_api.profiling').setLevel(logging.ERROR)
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.getLogger('db_api.profiling').setLevel(logging.NOTSET)
+
+    def test_hot_queries(self):
+        '''
+        Test that the lookups of tasks, comments, assignees and teams use an index
+        '''
+        print '('+self.test_hot_queries.__name__+')', \
+              self.test_hot_queries.__doc__
+        self.assertEquals(self.assertUsesIndexes(db.get_task, 1)['task_id'], 1)
+        self.assertEquals(len(self.assertUsesIndexes(db.get_comments, 2)), 1)
+        self.assertUsesIndexes(db.get_assigned_users, 1)
+        self.assertUsesIndexes(db.get_assignees, 1)
+        self.assertUsesIndexes(db.get_user_id, 'Teppo')
+        self.assertUsesIndexes(db.get_team, 1)
+        self.assertUsesIndexes(db.get_hierarchy, 1, None)
+        self.assertUsesIndexes(db.get_chain_of_command, 2)
+        self.assertUsesIndexes(db.get_tasks, limit=10, after_id=1)
+        self.assertUsesIndexes(db.get_tasks, status=1, limit=10)
+
+    def test_missing_index(self):
+        '''
+        Test that the helper fails when a hot query loses its index
+        '''
+        print '('+self.test_missing_index.__name__+')', \
+              self.test_missing_index.__doc__
+        with db.connection() as con:
+            con.execute('DROP INDEX comments_task_id')
+        with self.assertRaises(AssertionError) as cm:
+            self.assertUsesIndexes(db.get_comments, 2)
+        self.assertIn('FROM comments WHERE task_id=?', str(cm.exception))
+        self.assertIn('SCAN', str(cm.exception))
+
+    def test_profiler(self):
+        '''
+        Test the statement counts, the recent statements and the statement shapes
+        '''
+        print '('+self.test_profiler.__name__+')', \
+              self.test_profiler.__doc__
+        self.assertEquals(shape('SELECT *\n  FROM tasks WHERE id IN (?, ?,?)'),
+                          'SELECT * FROM tasks WHERE id IN (?)')
+        profiler = db.enable_profiling(QueryProfiler(db_path, recent=2))
+        try:
+            for task_id in (1, 2, 1):
+                db.cache.clear()
+                db.get_task(task_id)
+            self.assertTrue(db.add_comment('Traced', 1))
+        finally:
+            self.assertIs(db.disable_profiling(), profiler)
+        self.assertIsNone(db.pool.profiler)
+        stats = profiler.statements['SELECT * FROM tasks WHERE id=?']
+        self.assertEquals(stats.count, 3)
+        self.assertTrue(stats.plan)
+        self.assertEquals(stats.scans, [])
+        self.assertEquals(len(profiler.recent), 2)
+        self.assertIn('SELECT * FROM tasks WHERE id=?', profiler.report())
+        #The EXPLAIN of the INSERT did not commit the open transaction
+        self.assertEquals(len(db.get_comments(1)), 2)
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
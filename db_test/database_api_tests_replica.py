@@ -0,0 +1,105 @@
+import time, unittest
+
+import db_api.database
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+def reads(database):
+    return [database.get_users(), database.get_user(1), database.get_task(1),
+            database.get_tasks(), database.get_tasks(status=1, limit=1),
+            database.get_comments(2), database.get_assignees(1),
+            database.get_assigned_users(1), database.get_team(1),
+            database.get_chain_of_command(2), database.get_user_id('Teppo'),
+            database.get_task_stats(), database.get_changes(),
+            database.get_change_bounds(),
+            database.get_table_versions(['USERS', 'TASKS']),
+            database.get_comments_since(2, 0)]
+
+class ReplicaDbAPITestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def setUp(self):
+        super(ReplicaDbAPITestCase, self).setUp()
+        self.replicated = db_api.database.ProjectDatabase(
+            db_path, read_replica=True, read_your_writes=True)
+
+    def tearDown(self):
+        self.replicated.close()
+        super(ReplicaDbAPITestCase, self).tearDown()
+
+    def test_same_reads(self):
+        '''
+        Test that the replica returns what the database file returns, also after writes
+        '''
+        print '('+self.test_same_reads.__name__+')', \
+              self.test_same_reads.__doc__
+        self.assertEquals(reads(self.replicated), reads(db))
+        self.assertTrue(db.add_comment('Replicated', 2))
+        self.assertTrue(db.assign_to_task_by_nickname(2, 'Reijo'))
+        self.assertTrue(db.update_status(1, 3))
+        db.trim_changes(1)
+        self.assertEquals(reads(self.replicated), reads(db))
+
+    def test_read_your_writes(self):
+        '''
+        Test that with read_your_writes a write is seen by the next read
+        '''
+        print '('+self.test_read_your_writes.__name__+')', \
+              self.test_read_your_writes.__doc__
+        self.assertEquals(len(self.replicated.get_comments(1)), 1)
+        refreshes = self.replicated.replica.refreshes
+        self.assertTrue(self.replicated.add_comment('Mine', 1))
+        self.assertEquals(len(self.replicated.get_comments(1)), 2)
+        self.assertEquals(self.replicated.get_task(1)['status'], 1)
+        self.assertTrue(db.update_status(1, 2))
+        #The cached task was dropped by the refresh
+        self.assertEquals(self.replicated.get_task(1)['status'], 2)
+        self.assertEquals(self.replicated.replica.refreshes, refreshes + 2)
+        #No write, no refresh
+        self.replicated.get_users()
+        self.assertEquals(self.replicated.replica.refreshes, refreshes + 2)
+
+    def test_max_lag(self):
+        '''
+        Test that without read_your_writes the replica lags until it is refreshed
+        '''
+        print '('+self.test_max_lag.__name__+')', \
+              self.test_max_lag.__doc__
+        lagging = db_api.database.ProjectDatabase(db_path, read_replica=True,
+                                                  replica_max_lag=3600)
+        try:
+            self.assertEquals(len(lagging.get_users()), 4)
+            self.assertTrue(lagging.add_user('Ismo', 'ismo@jippii.fi', 'member', 1))
+            self.assertEquals(len(lagging.get_users()), 4)
+            #The iter_* methods read the file
+            self.assertEquals(len(list(lagging.iter_users())), 5)
+            lagging.replica.refresh()
+            self.assertEquals(len(lagging.get_users()), 5)
+            self.assertEquals(lagging.get_team(1), db.get_team(1))
+        finally:
+            lagging.close()
+
+    def test_cached_lag(self):
+        '''
+        Test that a value cached from a lagging replica is dropped once the lag has passed
+        '''
+        print '('+self.test_cached_lag.__name__+')', \
+              self.test_cached_lag.__doc__
+        lagging = db_api.database.ProjectDatabase(db_path, read_replica=True,
+                                                  replica_max_lag=0.2)
+        try:
+            self.assertEquals(lagging.get_task(1)['status'], 1)
+            self.assertTrue(lagging.update_status(1, 2))
+            #Read from the copy before it is refreshed, and cached
+            self.assertEquals(lagging.get_task(1)['status'], 1)
+            time.sleep(0.25)
+            self.assertEquals(lagging.get_task(1)['status'], 2)
+            self.assertEquals(lagging.get_task(1)['status'], 2)
+        finally:
+            lagging.close()
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
@@ -0,0 +1,62 @@
+import json, unittest
+
+from db_api import resources
+from .database_api_tests_common import BaseTestCase, db
+
+class ResourcesTestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def setUp(self):
+        super(ResourcesTestCase, self).setUp()
+        self.database = resources.app.config['DATABASE']
+        resources.app.config['DATABASE'] = db
+        self.client = resources.app.test_client()
+
+    def tearDown(self):
+        resources.app.config['DATABASE'] = self.database
+        super(ResourcesTestCase, self).tearDown()
+
+    def _add_member(self, leaderid, nickname):
+        body = {'template': {'data': [{'name': 'nickname',
+                                       'value': nickname}]}}
+        return self.client.post('/project/api/users/team/%s/' % leaderid,
+                                data=json.dumps(body),
+                                content_type='application/json')
+
+    def test_add_team_member(self):
+        '''
+        Test that a team member is added with 201 and that an unknown
+        nickname is answered with 404
+        '''
+        print '('+self.test_add_team_member.__name__+')', \
+              self.test_add_team_member.__doc__
+        response = self._add_member(2, 'Reijo')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(db.get_chain_of_command(3)[0]['nickname'], 'Teppo')
+        response = self._add_member(2, 'Nobody')
+        self.assertEquals(response.status_code, 404)
+        self.assertEquals(json.loads(response.data)['title'], 'Unknown user')
+
+    def test_add_team_member_cycle(self):
+        '''
+        Test that adding a user to the team of one of their subordinates is
+        answered with 409 and leaves the hierarchy as it was
+        '''
+        print '('+self.test_add_team_member_cycle.__name__+')', \
+              self.test_add_team_member_cycle.__doc__
+        self.assertEquals(self._add_member(2, 'Reijo').status_code, 201)
+        #Teppo (2) is now above Reijo (3)
+        response = self._add_member(3, 'Teppo')
+        self.assertEquals(response.status_code, 409)
+        self.assertEquals(json.loads(response.data)['title'], 'Team cycle')
+        self.assertEquals([m['nickname'] for m in db.get_chain_of_command(3)],
+                          ['Teppo', 'Seppo'])
+        self.assertEquals([m['nickname'] for m in db.get_chain_of_command(2)],
+                          ['Seppo'])
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
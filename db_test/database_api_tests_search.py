@@ -0,0 +1,114 @@
+import sqlite3, unittest
+
+from db_api.importer import import_rows
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+def _ids(results):
+    return [task['task_id'] for task in results]
+
+class SearchDbAPITestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def test_search_columns(self):
+        '''
+        Test that search_tasks finds the words of titles, descriptions and comments
+        '''
+        print '('+self.test_search_columns.__name__+')', \
+              self.test_search_columns.__doc__
+        self.assertEquals(_ids(db.search_tasks('help')), [1])
+        self.assertEquals(_ids(db.search_tasks('servulle')), [2])
+        self.assertEquals(_ids(db.search_tasks('Teppo')), [1])
+        self.assertEquals(_ids(db.search_tasks('help button')), [1])
+        self.assertEquals(db.search_tasks('help servulle'), [])
+
+    def test_search_result(self):
+        '''
+        Test the task fields, the rank and the snippet of the results
+        '''
+        print '('+self.test_search_result.__name__+')', \
+              self.test_search_result.__doc__
+        result = db.search_tasks('connection')[0]
+        task = db.get_task(2)
+        for key in ['title', 'category', 'description', 'priority', 'status']:
+            self.assertEquals(result[key], task[key])
+        self.assertIn('<b>Connection</b>', result['snippet'])
+        self.assertIsInstance(result['rank'], float)
+
+    def test_search_ranking(self):
+        '''
+        Test that title matches rank above description and comment matches
+        '''
+        print '('+self.test_search_ranking.__name__+')', \
+              self.test_search_ranking.__doc__
+        db.add_task('Deploy script', 'backend', 'Nothing here', 1, 1)
+        db.add_task('Cleanup', 'backend', 'Deploy when ready', 1, 1)
+        db.add_comment('Deploy it today', 1)
+        self.assertEquals(_ids(db.search_tasks('deploy')), [3, 4, 1])
+        self.assertEquals(_ids(db.search_tasks('deploy', limit=1)), [3])
+
+    def test_search_prefix(self):
+        '''
+        Test prefix queries and that FTS5 syntax in the query does not fail
+        '''
+        print '('+self.test_search_prefix.__name__+')', \
+              self.test_search_prefix.__doc__
+        self.assertEquals(_ids(db.search_tasks('butt*')), [1])
+        self.assertEquals(db.search_tasks('butt'), [])
+        self.assertEquals(db.search_tasks('"bad url" OR (NEAR'), [])
+        self.assertEquals(_ids(db.search_tasks('"bad" url')), [2])
+
+    def test_search_sync(self):
+        '''
+        Test that the index follows task and comment writes
+        '''
+        print '('+self.test_search_sync.__name__+')', \
+              self.test_search_sync.__doc__
+        self.assertTrue(db.update_title(1, 'Add tooltip'))
+        self.assertEquals(db.search_tasks('help'), [])
+        self.assertEquals(_ids(db.search_tasks('tooltip')), [1])
+        self.assertTrue(db.update_task(2, description='Timeout on login'))
+        self.assertEquals(_ids(db.search_tasks('login')), [2])
+
+        db.add_comment('Needs a tooltip too', 2)
+        self.assertEquals(sorted(_ids(db.search_tasks('tooltip'))), [1, 2])
+        db.delete_comment(3)
+        self.assertEquals(_ids(db.search_tasks('tooltip')), [1])
+
+        self.assertTrue(db.remove_task(1))
+        self.assertEquals(db.search_tasks('tooltip'), [])
+        self.assertEquals(db.search_tasks('Teppo'), [])
+
+    def test_search_comments_first(self):
+        '''
+        Test that comments stored before their task are indexed with the task
+        '''
+        print '('+self.test_search_comments_first.__name__+')', \
+              self.test_search_comments_first.__doc__
+        #Foreign keys are not enforced by a plain connection
+        con = sqlite3.connect(db_path)
+        with con:
+            con.execute("INSERT INTO comments(comment, task_id) VALUES ('Imported early', 10)")
+        con.close()
+        self.assertEquals(db.search_tasks('early'), [])
+        import_rows(db, 'tasks', [{'id': 10, 'title': 'Late task',
+                                   'category': 'bug', 'priority': 1,
+                                   'status': 1}])
+        self.assertEquals(_ids(db.search_tasks('early')), [10])
+
+    def test_search_wrong_input(self):
+        '''
+        Test that search_tasks returns False for empty queries and wrong limits
+        '''
+        print '('+self.test_search_wrong_input.__name__+')', \
+              self.test_search_wrong_input.__doc__
+        self.assertFalse(db.search_tasks(''))
+        self.assertFalse(db.search_tasks(' * '))
+        self.assertFalse(db.search_tasks('help', limit=0))
+        self.assertFalse(db.search_tasks('help', limit='1'))
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+def _workload(stats):
+    return [(a['user'], a['tasks'], a['status']) for a in stats['assignees']]
+
+class StatsDbAPITestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def test_initial_stats(self):
+        '''
+        Test the counts of the initial data
+        '''
+        print '('+self.test_initial_stats.__name__+')', \
+              self.test_initial_stats.__doc__
+        stats = db.get_task_stats()
+        self.assertEquals(stats['total'], 2)
+        self.assertEquals(stats['status'], {1: 2, 2: 0, 3: 0, 4: 0})
+        self.assertEquals(stats['category'],
+                          {'frontend': 1, 'backend': 0, 'UX': 0, 'bug': 1})
+        self.assertEquals(stats['priority'], {1: 0, 2: 1, 3: 1, 4: 0})
+        self.assertEquals(_workload(stats), [(1, 1, {1: 1}), (2, 1, {1: 1}),
+                                             (3, 1, {1: 1}), (4, 1, {1: 1})])
+        self.assertEquals(stats['assignees'][0]['nickname'], 'Seppo')
+
+    def test_task_writes(self):
+        '''
+        Test that the counts follow added, updated and removed tasks
+        '''
+        print '('+self.test_task_writes.__name__+')', \
+              self.test_task_writes.__doc__
+        db.add_task('Counted', 'UX', 'Stats', 4, 2)
+        db.update_task(2, category='UX', priority=1, status=3)
+        db.update_title(1, 'Not counted')
+        stats = db.get_task_stats()
+        self.assertEquals(stats['total'], 3)
+        self.assertEquals(stats['status'], {1: 1, 2: 1, 3: 1, 4: 0})
+        self.assertEquals(stats['category'],
+                          {'frontend': 1, 'backend': 0, 'UX': 2, 'bug': 0})
+        self.assertEquals(stats['priority'], {1: 1, 2: 1, 3: 0, 4: 1})
+        db.remove_task(3)
+        db.remove_task(1)
+        stats = db.get_task_stats()
+        self.assertEquals(stats['total'], 1)
+        self.assertEquals(stats['status'], {1: 0, 2: 0, 3: 1, 4: 0})
+
+    def test_assignee_writes(self):
+        '''
+        Test the workload after assignments and status changes
+        '''
+        print '('+self.test_assignee_writes.__name__+')', \
+              self.test_assignee_writes.__doc__
+        db.assign_to_task(2, 2)
+        db.update_status(1, 4)
+        db.remove_assignee(1, 1)
+        self.assertEquals(_workload(db.get_task_stats()),
+                          [(2, 2, {1: 1, 4: 1}), (3, 1, {4: 1}), (4, 1, {4: 1})])
+        #Removing a task or a user removes their assignments
+        db.remove_task(1)
+        db.delete_user(2)
+        self.assertEquals(_workload(db.get_task_stats()), [])
+
+    def test_rebuild(self):
+        '''
+        Test that rebuild_task_stats gives the counts kept by the triggers
+        '''
+        print '('+self.test_rebuild.__name__+')', \
+              self.test_rebuild.__doc__
+        db.add_task('Rebuilt', 'backend', 'Stats', 2, 2)
+        db.assign_to_task(3, 3)
+        db.update_status(2, 4)
+        stats = db.get_task_stats()
+        self.assertTrue(db.rebuild_task_stats())
+        self.assertEquals(db.get_task_stats(), stats)
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+from .database_api_tests_common import BaseTestCase, db, db_path
+
+def _last_seq(rows):
+    return rows[-1]['seq']
+
+class SyncDbAPITestCase(BaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def test_full_sync(self):
+        '''
+        Test that since=0 returns every row of the initial data
+        '''
+        print '('+self.test_full_sync.__name__+')', \
+              self.test_full_sync.__doc__
+        tasks = db.get_tasks_since(0)
+        self.assertEquals([t['task_id'] for t in tasks], [1, 2])
+        self.assertEquals(tasks[0]['title'], 'Add help button')
+        self.assertFalse(tasks[0]['deleted'])
+        self.assertEquals(sorted(u['nickname'] for u in db.get_users_since(0)),
+                          ['Kyllikki', 'Reijo', 'Seppo', 'Teppo'])
+        self.assertEquals([c['comment_id'] for c in db.get_comments_since(2, 0)], [2])
+        self.assertEquals(len(db.get_assignees_since(1, 0)), 4)
+        self.assertEquals(db.get_assignees_since(2, 0), [])
+
+    def test_tasks_since(self):
+        '''
+        Test that only the tasks written after since are returned, deleted ones as tombstones
+        '''
+        print '('+self.test_tasks_since.__name__+')', \
+              self.test_tasks_since.__doc__
+        since = _last_seq(db.get_tasks_since(0))
+        self.assertEquals(db.get_tasks_since(since), [])
+
+        db.update_priority(2, 4)
+        db.add_task('Synced', 'UX', 'Delta', 1, 1)
+        db.remove_task(1)
+        tasks = db.get_tasks_since(since)
+        self.assertEquals([(t['task_id'], t['deleted']) for t in tasks],
+                          [(2, False), (3, False), (1, True)])
+        self.assertEquals(tasks[0]['priority'], 4)
+        self.assertEquals(sorted(tasks[2]), ['deleted', 'seq', 'task_id'])
+        self.assertTrue(tasks[0]['seq'] < tasks[1]['seq'] < tasks[2]['seq'])
+
+        #A row written again moves to the end of the sequence
+        db.update_title(2, 'Again')
+        tasks = db.get_tasks_since(since)
+        self.assertEquals([t['task_id'] for t in tasks], [3, 1, 2])
+        self.assertEquals([t['task_id'] for t in db.get_tasks_since(since, limit=1)], [3])
+
+    def test_users_since(self):
+        '''
+        Test renamed and deleted users
+        '''
+        print '('+self.test_users_since.__name__+')', \
+              self.test_users_since.__doc__
+        since = _last_seq(db.get_users_since(0))
+        db.update_username('Kyllikki', 'Kylli')
+        db.delete_user(4)
+        users = db.get_users_since(since)
+        self.assertEquals(len(users), 1)
+        self.assertEquals((users[0]['user_id'], users[0]['nickname'],
+                           users[0]['deleted']), (4, 'Kylli', True))
+
+    def test_comments_and_assignees_since(self):
+        '''
+        Test the comments and the assignees of a task written after since
+        '''
+        print '('+self.test_comments_and_assignees_since.__name__+')', \
+              self.test_comments_and_assignees_since.__doc__
+        since = max(_last_seq(db.get_comments_since(2, 0)),
+                    _last_seq(db.get_assignees_since(1, 0)))
+        db.add_comment('New one', 2)
+        db.delete_comment(2)
+        db.assign_to_task(2, 3)
+        db.remove_assignee(1, 2)
+        self.assertEquals([(c['comment_id'], c['deleted'])
+                           for c in db.get_comments_since(2, since)],
+                          [(3, False), (2, True)])
+        self.assertEquals(db.get_comments_since(1, since), [])
+        self.assertEquals([(a['user'], a['nickname'], a['deleted'])
+                           for a in db.get_assignees_since(2, since)],
+                          [(3, 'Reijo', False)])
+        self.assertEquals([(a['user'], a['deleted'])
+                           for a in db.get_assignees_since(1, since)],
+                          [(2, True)])
+
+if __name__ == '__main__':
+    print 'Start running tests'
+    unittest.main()
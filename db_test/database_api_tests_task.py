@@ -1,5 +1,5 @@
 import sqlite3, unittest
-from .database_api_tests_common import BaseTestCase, db, db_path
+from .database_api_tests_common import BaseTestCase, RollbackTestCase, db
 
 
 task = {'task_id':1, 'title':'Add help button', 'category':'frontend', 'description':'Tallanen nappi puuttuu, lisaa asap!', 'priority':2, 'status':1}
@@ -8,7 +8,7 @@ task2 = {'task_id':2, 'title':'Connection bug', 'category':'bug', 'description':
 comment1 = {'comment':'I will do this. -Teppo', 'task_id':1}
 comment2 = {'comment_id':2,'comment':'Who can start on this one??? -Seppo', 'task_id':2}
 
-class TasksDbAPITestCase(BaseTestCase):
+class TasksDbAPITestCase(RollbackTestCase):
 
     @classmethod
     def setUpClass(cls):
@@ -22,10 +22,10 @@ class TasksDbAPITestCase(BaseTestCase):
         self.test_update_title.__doc__
         
         
-        update = db.update_title(1,"New title!!")
+        update = self.db.update_title(1,"New title!!")
         self.assertTrue(update)
         
-        update = db.update_title(60, "Can't do this")
+        update = self.db.update_title(60, "Can't do this")
         self.assertFalse(update)
     
 
@@ -34,10 +34,10 @@ class TasksDbAPITestCase(BaseTestCase):
         print '('+self.test_update_description.__name__+')',\
         self.test_update_description.__doc__
 
-        update = db.update_description(1,"New desc!!")
+        update = self.db.update_description(1,"New desc!!")
         self.assertTrue(update)
         
-        update = db.update_description(60, "Can't do this")
+        update = self.db.update_description(60, "Can't do this")
         self.assertFalse(update)
         
     def test_update_category(self):
@@ -45,13 +45,13 @@ class TasksDbAPITestCase(BaseTestCase):
         print '('+self.test_update_category.__name__+')',\
         self.test_update_category.__doc__
         
-        update = db.update_category(1,"bug")
+        update = self.db.update_category(1,"bug")
         self.assertTrue(update)
         
-        update = db.update_category(1, "thisdoesnotexist")
+        update = self.db.update_category(1, "thisdoesnotexist")
         self.assertFalse(update)
         
-        update = db.update_category(666, "bug")
+        update = self.db.update_category(666, "bug")
         self.assertFalse(update)
         
         
@@ -60,12 +60,12 @@ class TasksDbAPITestCase(BaseTestCase):
         print '('+self.test_remove_assignee.__name__+')',\
         self.test_remove_assignee.__doc__
         
-        db.assign_to_task(1,3)
+        self.db.assign_to_task(1,3)
         
-        remove1 = db.remove_assignee(1,5)
+        remove1 = self.db.remove_assignee(1,5)
         self.assertFalse(remove1)
         
-        remove2 = db.remove_assignee(1,3)
+        remove2 = self.db.remove_assignee(1,3)
         self.assertTrue(remove2)
         
         
@@ -73,32 +73,56 @@ class TasksDbAPITestCase(BaseTestCase):
         '''Assign to task'''
         print '('+self.test_assign_to_task.__name__+')',\
         self.test_assign_to_task.__doc__
-        assign = db.assign_to_task(1,2)
+        assign = self.db.assign_to_task(1,2)
         self.assertTrue(assign)
         
-        #assign = db.assign_to_task(4,2)
+        #assign = self.db.assign_to_task(4,2)
         #self.assertTrue(assign)
         
+    def test_get_assignees(self):
+        '''Get assignees of task 1 with their nicknames'''
+        print '('+self.test_get_assignees.__name__+')',\
+        self.test_get_assignees.__doc__
+
+        assignees = self.db.get_assignees(1)
+        self.assertEquals([a['user'] for a in assignees], [1, 2, 3, 4])
+        self.assertEquals(assignees[1]['nickname'], 'Teppo')
+        self.assertEquals(assignees[1]['role'], 'member')
+        self.assertEquals(self.db.get_assignees(2), [])
+
+    def test_assign_by_nickname(self):
+        '''Assign and remove assignee by nickname, also nickname that does not exist'''
+        print '('+self.test_assign_by_nickname.__name__+')',\
+        self.test_assign_by_nickname.__doc__
+
+        self.assertTrue(self.db.assign_to_task_by_nickname(2, 'Reijo'))
+        self.assertEquals(self.db.get_assigned_users(2), [{'user':3}])
+        self.assertFalse(self.db.assign_to_task_by_nickname(2, 'Nobody'))
+
+        self.assertTrue(self.db.remove_assignee_by_nickname(2, 'Reijo'))
+        self.assertFalse(self.db.remove_assignee_by_nickname(2, 'Reijo'))
+        self.assertFalse(self.db.remove_assignee_by_nickname(2, 'Nobody'))
+
     def test_add_comment(self):
         '''Add new comment'''
         print '('+self.test_add_comment.__name__+')',\
         self.test_add_comment.__doc__
     
     
-        comment = db.add_comment("Test comment", 1)
+        comment = self.db.add_comment("Test comment", 1)
         self.assertTrue(comment)
         
-        new_comment = db.get_comments(1)
+        new_comment = self.db.get_comments(1)
         self.assertEquals(new_comment[1]['comment_id'], 3)
         
-        db.delete_comment(3)
+        self.db.delete_comment(3)
         
     def test_get_comments(self):
         '''Get comments from task_id 2'''
         print '('+self.test_get_comments.__name__+')',\
         self.test_get_comments.__doc__
         
-        comments = db.get_comments(2)
+        comments = self.db.get_comments(2)
         
         self.assertEquals(comments[0]['comment'], comment2['comment'])
         self.assertEquals(comments[0]['comment_id'], comment2['comment_id'])
@@ -108,12 +132,12 @@ class TasksDbAPITestCase(BaseTestCase):
         print '('+self.test_delete_comment.__name__+')',\
         self.test_add_task.__doc__
         
-        db.add_comment("Test",1)
+        self.db.add_comment("Test",1)
         
-        delete = db.delete_comment(3)
+        delete = self.db.delete_comment(3)
         self.assertTrue(delete)
         
-        delete = db.delete_comment(18)
+        delete = self.db.delete_comment(18)
         self.assertFalse(delete)
         
         
@@ -122,7 +146,7 @@ class TasksDbAPITestCase(BaseTestCase):
         print '('+self.test_get_tasks.__name__+')',\
         self.test_get_tasks.__doc__
         
-        new_task = db.get_tasks()
+        new_task = self.db.get_tasks()
         
         self.assertEquals(new_task[0]['task_id'],task['task_id'])
         self.assertEquals(new_task[0]['title'],task['title'])
@@ -136,13 +160,74 @@ class TasksDbAPITestCase(BaseTestCase):
         self.assertEquals(new_task[1]['priority'],task2['priority'])
         self.assertEquals(new_task[1]['status'],task2['status'])
         
-        
+    def test_get_tasks_paginated(self):
+        '''Get tasks one page at a time, forwards and backwards'''
+        print '('+self.test_get_tasks_paginated.__name__+')',\
+        self.test_get_tasks_paginated.__doc__
+
+        for i in range(5):
+            self.db.add_task("Task %d" % i, "bug", "Paginated", 1, 1)
+
+        page = self.db.get_tasks(limit=3)
+        self.assertEquals([t['task_id'] for t in page], [1, 2, 3])
+        page = self.db.get_tasks(limit=3, after_id=3)
+        self.assertEquals([t['task_id'] for t in page], [4, 5, 6])
+        page = self.db.get_tasks(limit=3, after_id=6)
+        self.assertEquals([t['task_id'] for t in page], [7])
+        page = self.db.get_tasks(limit=3, before_id=6)
+        self.assertEquals([t['task_id'] for t in page], [3, 4, 5])
+        page = self.db.get_tasks(limit=3, before_id=1)
+        self.assertEquals(page, [])
+
+    def test_get_tasks_filtered(self):
+        '''Get tasks filtered by status, category, priority and creation date'''
+        print '('+self.test_get_tasks_filtered.__name__+')',\
+        self.test_get_tasks_filtered.__doc__
+
+        self.db.add_task("Open bug", "bug", "Filtered", 4, 2)
+        self.db.add_task("Closed UX", "UX", "Filtered", 1, 4)
+        ids = lambda tasks: [t['task_id'] for t in tasks]
+
+        self.assertEquals(ids(self.db.get_tasks(category='bug')), [2, 3])
+        self.assertEquals(ids(self.db.get_tasks(status=[1, 2])), [1, 2, 3])
+        self.assertEquals(ids(self.db.get_tasks(category='bug', status=2)), [3])
+        self.assertEquals(ids(self.db.get_tasks(priority=[1, 2])), [1, 4])
+        self.assertEquals(ids(self.db.get_tasks(created_after='2000-01-01')), [1, 2, 3, 4])
+        self.assertEquals(self.db.get_tasks(created_before='2000-01-01 00:00:00'), [])
+        self.assertEquals(ids(self.db.iter_tasks(category='UX')), [4])
+
+        self.assertFalse(self.db.get_tasks(status=5))
+        self.assertFalse(self.db.get_tasks(category='docs'))
+        self.assertFalse(self.db.get_tasks(priority=[]))
+        self.assertFalse(self.db.get_tasks(created_after='yesterday'))
+        self.assertFalse(self.db.iter_tasks(status=0))
+
+    def test_get_tasks_sorted(self):
+        '''Get tasks sorted by priority, one page at a time in both directions'''
+        print '('+self.test_get_tasks_sorted.__name__+')',\
+        self.test_get_tasks_sorted.__doc__
+
+        self.db.add_task("Urgent", "bug", "Sorted", 4, 1)
+        self.db.add_task("Minor", "bug", "Sorted", 1, 1)
+        self.db.add_task("Major", "bug", "Sorted", 3, 1)
+        ids = lambda tasks: [t['task_id'] for t in tasks]
+
+        #Priorities: 1:2, 2:3, 3:4, 4:1, 5:3
+        self.assertEquals(ids(self.db.get_tasks(sort='priority')), [4, 1, 2, 5, 3])
+        self.assertEquals(ids(self.db.get_tasks(sort='-priority')), [3, 5, 2, 1, 4])
+        self.assertEquals(ids(self.db.get_tasks(sort='priority', limit=2, after_id=1)), [2, 5])
+        self.assertEquals(ids(self.db.get_tasks(sort='priority', limit=2, before_id=2)), [4, 1])
+        self.assertEquals(ids(self.db.get_tasks(sort='-priority', limit=2, after_id=5)), [2, 1])
+        self.assertEquals(ids(self.db.get_tasks(sort='-priority', category='bug')), [3, 5, 2, 4])
+        self.assertEquals(ids(self.db.iter_tasks(sort='-priority', after_id=2)), [1, 4])
+        self.assertFalse(self.db.get_tasks(sort='title'))
+
     def test_get_task(self):
         '''Get task with task_id 1'''
         print '('+self.test_get_task.__name__+')',\
         self.test_add_task.__doc__
         
-        new_task = db.get_task(task['task_id'])
+        new_task = self.db.get_task(task['task_id'])
         
         self.assertEquals(new_task['task_id'],task['task_id'])
         self.assertEquals(new_task['title'],task['title'])
@@ -152,7 +237,7 @@ class TasksDbAPITestCase(BaseTestCase):
         
         
         #Task that does not exist
-        new_task = db.get_task(13)
+        new_task = self.db.get_task(13)
         self.assertFalse(new_task)
         
         
@@ -161,10 +246,10 @@ class TasksDbAPITestCase(BaseTestCase):
         print '('+self.test_update_status.__name__+')',\
         self.test_update_status.__doc__
         
-        update = db.update_status(1,3)
+        update = self.db.update_status(1,3)
         self.assertTrue(update)
         
-        #update = db.update_status(1,15)
+        #update = self.db.update_status(1,15)
         #self.assertFalse(update)
         
     def test_update_priority(self):
@@ -172,10 +257,10 @@ class TasksDbAPITestCase(BaseTestCase):
         print '('+self.test_update_priority.__name__+')',\
         self.test_update_priority.__doc__
         
-        update = db.update_status(1,3)
+        update = self.db.update_status(1,3)
         self.assertTrue(update)
         
-        #update = db.update_status(1,15)
+        #update = self.db.update_status(1,15)
         #self.assertFalse(update)        
     
     
@@ -185,22 +270,90 @@ class TasksDbAPITestCase(BaseTestCase):
         self.test_add_task.__doc__
         
         #Succsessfully add task
-        task = db.add_task("New title", "bug", "Super cool", 1, 3)
+        task = self.db.add_task("New title", "bug", "Super cool", 1, 3)
         self.assertTrue(task)
         
+    def test_add_tasks(self):
+        '''Add many tasks at once. Test also that a wrong row adds nothing'''
+        print '('+self.test_add_tasks.__name__+')',\
+        self.test_add_tasks.__doc__
+
+        rows = [dict(title="Bulk %d" % i, category="UX", description="Bulk",
+                     priority=1, status=1) for i in range(3)]
+        ids = self.db.add_tasks(rows)
+        self.assertEquals(ids, [3, 4, 5])
+        self.assertEquals(self.db.get_task(5)['title'], "Bulk 2")
+
+        rows.append(dict(title="Wrong", category="nothere", description="",
+                         priority=1, status=1))
+        self.assertFalse(self.db.add_tasks(rows))
+        self.assertEquals(len(self.db.get_tasks()), 5)
+
+        self.assertEquals(self.db.add_tasks([]), [])
+
     def test_remove_task(self):
         '''Removet task'''
         print '('+self.test_add_task.__name__+')',\
         self.test_add_task.__doc__
         
-        db.add_task("New title", "bug", "Super cool", 1, 3)
+        self.db.add_task("New title", "bug", "Super cool", 1, 3)
         
-        remove = db.remove_task(3)
+        remove = self.db.remove_task(3)
         self.assertTrue(remove)
         
-        remove2 = db.remove_task(14)
+        remove2 = self.db.remove_task(14)
         self.assertFalse(remove2)
-        
+
+    def test_update_task(self):
+        '''Update several task fields at once. Test also wrong values and task that does not exist'''
+        print '('+self.test_update_task.__name__+')',\
+        self.test_update_task.__doc__
+
+        update = self.db.update_task(1, title="New title", status=2, priority=4)
+        self.assertTrue(update)
+        new_task = self.db.get_task(1)
+        self.assertEquals(new_task['title'], "New title")
+        self.assertEquals(new_task['status'], 2)
+        self.assertEquals(new_task['priority'], 4)
+        self.assertEquals(new_task['category'], task['category'])
+
+        #A wrong value must not write any of the other fields
+        update = self.db.update_task(2, title="Not written", category="thisdoesnotexist")
+        self.assertFalse(update)
+        self.assertEquals(self.db.get_task(2)['title'], task2['title'])
+
+        update = self.db.update_task(2, owner="Seppo")
+        self.assertFalse(update)
+
+        update = self.db.update_task(60, title="Can't do this")
+        self.assertFalse(update)
+
+
+class TaskIteratorDbAPITestCase(BaseTestCase):
+    '''
+    Uses the pooled connections of db
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        print "Testing ", cls.__name__
+
+    def test_iter_tasks(self):
+        '''Iterate tasks lazily from the cursor'''
+        print '('+self.test_iter_tasks.__name__+')',\
+        self.test_iter_tasks.__doc__
+
+        tasks = db.iter_tasks()
+        self.assertEquals(next(tasks)['task_id'], task['task_id'])
+        #Abandoning the generator gives the connection back to the pool
+        tasks.close()
+        self.assertEquals(db.pool._idle.qsize(), db.pool._opened)
+
+        tasks = list(db.iter_tasks(after_id=1))
+        self.assertEquals(len(tasks), 1)
+        self.assertEquals(tasks[0]['title'], task2['title'])
+
+
 if __name__ == '__main__':
     print 'Start running tests'
     unittest.main()
\ No newline at end of file
@@ -1,8 +1,8 @@
 import sqlite3, unittest
 
-from .database_api_tests_common import BaseTestCase, db, db_path
+from .database_api_tests_common import RollbackTestCase
 
-class UserDbAPITestCase(BaseTestCase):
+class UserDbAPITestCase(RollbackTestCase):
 
     user1_nickname = 'Seppo'
     user1_id = 1
@@ -31,7 +31,7 @@ class UserDbAPITestCase(BaseTestCase):
         '''
         print '('+self.test_get_users.__name__+')', \
               self.test_get_users.__doc__
-        users = db.get_users()
+        users = self.db.get_users()
         #Check that the size is correct
         self.assertEquals(len(users), self.initial_size)
         #Iterate throug users and check if the users with user1_id and
@@ -53,9 +53,9 @@ class UserDbAPITestCase(BaseTestCase):
         '''
         print '('+self.test_get_user.__name__+')', \
               self.test_get_user.__doc__
-        user = db.get_user(self.user1_id)
+        user = self.db.get_user(self.user1_id)
         self.assertEquals(user, self.user1_nickname)
-        user = db.get_user(self.user2_id)
+        user = self.db.get_user(self.user2_id)
         self.assertEquals(user, self.user2_nickname)
 
     def test_get_role(self):
@@ -64,9 +64,9 @@ class UserDbAPITestCase(BaseTestCase):
         '''
         print '('+self.test_get_role.__name__+')', \
               self.test_get_role.__doc__
-        role = db.get_role(self.user1_id)
+        role = self.db.get_role(self.user1_id)
         self.assertEquals(role, self.user1_role)
-        role = db.get_role(self.user2_id)
+        role = self.db.get_role(self.user2_id)
         self.assertEquals(role, self.user2_role)
 
     def test_add_user(self):
@@ -75,7 +75,7 @@ class UserDbAPITestCase(BaseTestCase):
         '''
         print '('+self.test_add_user.__name__+')', \
               self.test_add_user.__doc__
-        returnvalue = db.add_user(self.user5_nickname, self.user5_email, self.user5_role, self.user5_boss)
+        returnvalue = self.db.add_user(self.user5_nickname, self.user5_email, self.user5_role, self.user5_boss)
         self.assertTrue(returnvalue, True)
 
     def test_delete_user(self):
@@ -84,7 +84,7 @@ class UserDbAPITestCase(BaseTestCase):
         '''
         print '('+self.test_delete_user.__name__+')', \
               self.test_delete_user.__doc__
-        returnvalue = db.delete_user(self.user5_id)
+        returnvalue = self.db.delete_user(self.user5_id)
         self.assertTrue(returnvalue, True)
 
     def test_get_team(self):
@@ -93,7 +93,7 @@ class UserDbAPITestCase(BaseTestCase):
         '''
         print '('+self.test_get_team.__name__+')', \
               self.test_get_team.__doc__
-        team = db.get_team(self.user1_id)
+        team = self.db.get_team(self.user1_id)
         #Iterate throug users and check if the users with user1_id and
         #user2_id are correct:
         for member in team:
@@ -112,8 +112,8 @@ class UserDbAPITestCase(BaseTestCase):
         '''
         print '('+self.test_add_to_team.__name__+')', \
               self.test_add_to_team.__doc__
-        db.add_user(self.user5_nickname, self.user5_email, self.user5_role, self.user5_boss)
-        returnvalue = db.add_to_team(self.user5_id, self.user1_id)
+        self.db.add_user(self.user5_nickname, self.user5_email, self.user5_role, self.user5_boss)
+        returnvalue = self.db.add_to_team(self.user5_id, self.user1_id)
         self.assertTrue(returnvalue, True)
 
     def test_delete_from_team(self):
@@ -123,19 +123,80 @@ class UserDbAPITestCase(BaseTestCase):
         print '('+self.test_delete_from_team.__name__+')', \
               self.test_delete_from_team.__doc__
         #Add Ismo to database
-        db.add_user(self.user5_nickname, self.user5_email, self.user5_role, self.user5_boss)
+        self.db.add_user(self.user5_nickname, self.user5_email, self.user5_role, self.user5_boss)
         #Add Ismo to Seppo's team
-        db.add_to_team(self.user5_id, self.user1_id)
-        returnvalue = db.remove_from_team(self.user5_id, self.user1_id)
+        self.db.add_to_team(self.user5_id, self.user1_id)
+        returnvalue = self.db.remove_from_team(self.user5_id, self.user1_id)
         self.assertTrue(returnvalue, True)
 
+    def test_team_by_nickname(self):
+        '''
+        Test adding and removing team members by nickname
+        '''
+        print '('+self.test_team_by_nickname.__name__+')', \
+              self.test_team_by_nickname.__doc__
+        self.db.add_user(self.user5_nickname, self.user5_email, self.user5_role, None)
+        self.assertTrue(self.db.add_to_team_by_nickname(self.user5_nickname, self.user1_id))
+        self.assertIn({'nickname': self.user5_nickname}, self.db.get_team(self.user1_id))
+        self.assertIsNone(self.db.add_to_team_by_nickname('Nobody', self.user1_id))
+        self.assertTrue(self.db.remove_from_team_by_nickname(self.user5_nickname, self.user1_id))
+        self.assertNotIn({'nickname': self.user5_nickname}, self.db.get_team(self.user1_id))
+        #Not in the team anymore
+        self.assertFalse(self.db.remove_from_team_by_nickname(self.user5_nickname, self.user1_id))
+
+    def test_hierarchy(self):
+        '''
+        Test get_hierarchy and get_chain_of_command on a multi-level team
+        '''
+        print '('+self.test_hierarchy.__name__+')', \
+              self.test_hierarchy.__doc__
+        self.db.add_user(self.user5_nickname, self.user5_email, self.user5_role,
+                    self.user2_id)
+        self.db.add_user('Matti', 'matti@jippii.fi', 'member', self.user5_id)
+        team = self.db.get_hierarchy(self.user1_id)
+        self.assertEquals([(m['user_id'], m['depth']) for m in team],
+                          [(1, 0), (2, 1), (3, 1), (4, 1), (5, 2), (6, 3)])
+        self.assertEquals(team[5]['boss'], self.user5_id)
+        self.assertEquals(len(self.db.get_hierarchy(self.user1_id, 2)), 5)
+        self.assertEquals(len(self.db.get_team(self.user1_id)), 4)
+        self.assertEquals(len(self.db.get_team(self.user1_id, None)), 6)
+        self.assertEquals([m['nickname'] for m in self.db.get_chain_of_command(6)],
+                          [self.user5_nickname, self.user2_nickname,
+                           self.user1_nickname])
+        self.assertEquals(self.db.get_chain_of_command(self.user1_id), [])
+        self.assertFalse(self.db.get_hierarchy(self.user1_id, -1))
+
+    def test_hierarchy_moves(self):
+        '''
+        Test that moving a member moves their team and that cycles are refused
+        '''
+        print '('+self.test_hierarchy_moves.__name__+')', \
+              self.test_hierarchy_moves.__doc__
+        self.db.add_user(self.user5_nickname, self.user5_email, self.user5_role,
+                    self.user2_id)
+        self.assertTrue(self.db.add_to_team(self.user2_id, 3))
+        self.assertEquals([m['nickname'] for m in self.db.get_chain_of_command(5)],
+                          [self.user2_nickname, self.user3_nickname,
+                           self.user1_nickname])
+        #Reijo is now above Teppo
+        self.assertFalse(self.db.add_to_team(3, self.user5_id))
+        self.assertIs(self.db.add_to_team_by_nickname(self.user3_nickname, self.user2_id), False)
+        self.assertFalse(self.db.add_to_team(self.user2_id, self.user2_id))
+        self.assertTrue(self.db.remove_from_team(self.user2_id, 3))
+        self.assertEquals([(m['user_id'], m['depth'])
+                           for m in self.db.get_hierarchy(self.user2_id)],
+                          [(2, 0), (5, 1)])
+        self.assertEquals(len(self.db.get_hierarchy(self.user1_id)), 3)
+        self.db.delete_user(self.user5_id)
+        self.assertEquals(len(self.db.get_hierarchy(self.user2_id)), 1)
+
     def test_get_user_id(self):
         '''
         Test get_user_id (return Seppos userid
         '''
         print '('+self.test_get_user_id.__name__+')', \
               self.test_get_user_id.__doc__
-        userid = db.get_user_id(self.user1_nickname)
+        userid = self.db.get_user_id(self.user1_nickname)
         self.assertEquals(userid, self.user1_id)
 
 
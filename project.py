@@ -1,11 +1,189 @@
-from werkzeug.serving import run_simple
+import argparse, os, signal, sys, threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from werkzeug.serving import run_simple, BaseWSGIServer
 from werkzeug.wsgi import DispatcherMiddleware
-from db_api.resources import app as project
+from db_api.resources import app as project, LONG_REQUEST_PATHS, NOTIFIER
+from db_api import database, feed
+from db_api.async_server import AsyncWSGIServer
 from project_admin.application import app as project_admin
 
+DEFAULT_WORKERS = 4
+DEFAULT_THREADS = 8
+
 application = DispatcherMiddleware(project, {
      '/project_admin': project_admin
 })
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    '''
+    WSGI server that handles the requests with a fixed number of threads.
+    The threads are started by serve_forever, so a server created before
+    fork() starts its threads in every worker process.
+    '''
+    multithread = True
+    multiprocess = True
+    #Listen backlog shared by all the workers, SocketServer uses only 5
+    request_queue_size = 128
+
+    def __init__(self, host, port, app, threads=DEFAULT_THREADS):
+        BaseWSGIServer.__init__(self, host, port, app)
+        self.threads = threads
+        self._requests = queue.Queue(threads * 4)
+
+    def serve_forever(self):
+        for _ in range(self.threads):
+            thread = threading.Thread(target=self._handle_requests)
+            thread.daemon = True
+            thread.start()
+        BaseWSGIServer.serve_forever(self)
+
+    def process_request(self, request, client_address):
+        #Blocks the accepting thread when all the threads are busy and the
+        #queue is full, the remaining clients wait in the listen backlog.
+        self._requests.put((request, client_address))
+
+    def _handle_requests(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def event_loop_server(host, port, app, threads=DEFAULT_THREADS):
+    '''
+    AsyncWSGIServer that runs the change feed requests off its executor
+    '''
+    return AsyncWSGIServer(host, port, app, threads, LONG_REQUEST_PATHS)
+
+
+def init_worker(threads, read_replica=False, read_your_writes=False,
+                max_watchers=feed.MAX_WATCHERS):
+    '''
+    Runs in every worker process after fork(). Opens a new database API
+    with its own connection pool, sized for the threads of the worker, so
+    no SQLite connection is shared between processes. With read_replica
+    each worker keeps its own in-memory copy (see db_api/replica.py).
+    max_watchers change feed requests may wait at the same time.
+    '''
+    NOTIFIER.max_watchers = max_watchers
+    db_path = project.config['DATABASE'].db_path
+    project.config['DATABASE'] = database.ProjectDatabase(
+        db_path, pool_size=threads, read_replica=read_replica,
+        read_your_writes=read_your_writes)
+
+def run_production(host, port, workers, threads,
+                   server_class=ThreadPoolWSGIServer, read_replica=False,
+                   read_your_writes=False, max_watchers=None):
+    '''
+    Serve application with workers pre-forked processes, each of them with
+    threads threads, all accepting on the same listening socket. Debug
+    mode and the reloader are disabled. server_class is
+    ThreadPoolWSGIServer or event_loop_server.
+
+    Each waiting change feed request holds a thread. By default a worker
+    lets them take half of its threads with ThreadPoolWSGIServer, and runs
+    feed.MAX_WATCHERS of them, on threads of their own, with the event
+    loop server; the next ones are answered with 503.
+    '''
+    if max_watchers is None:
+        max_watchers = feed.MAX_WATCHERS if server_class is event_loop_server \
+                       else max(1, threads // 2)
+    project.debug = False
+    project_admin.debug = False
+    if not hasattr(os, 'fork'):
+        workers = 1
+
+    #Migrate once in the parent and close its connections before forking
+    db = project.config['DATABASE']
+    db.migrate()
+    db.close()
+
+    server = server_class(host, port, application, threads)
+    if workers == 1:
+        init_worker(threads, read_replica, read_your_writes, max_watchers)
+        server.serve_forever()
+        return
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            init_worker(threads, read_replica, read_your_writes, max_watchers)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print ' * Serving on http://%s:%d/ with %d workers x %d threads' % \
+          (host, port, workers, threads)
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError:
+            continue
+        if pid in children:
+            children.remove(pid)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run the project API and the admin client.')
+    parser.add_argument('--production', action='store_true',
+                        help='pre-forked workers without debugger nor reloader')
+    parser.add_argument('--host', default='localhost',
+                        help='address to bind (default %(default)s)')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='port to bind (default %(default)s)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='worker processes in production mode '
+                             '(default %(default)s)')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help='threads per worker in production mode '
+                             '(default %(default)s)')
+    parser.add_argument('--event-loop', action='store_true',
+                        help='in production mode, read and write the requests '
+                             'in an event loop and run the handlers on the '
+                             'threads')
+    parser.add_argument('--read-replica', action='store_true',
+                        help='in production mode, serve the reads of every '
+                             'worker from an in-memory copy of the database')
+    parser.add_argument('--read-your-writes', action='store_true',
+                        help='with --read-replica, bring the copy up to date '
+                             'before every read instead of once per second')
+    parser.add_argument('--max-watchers', type=int, default=None,
+                        help='in production mode, change feed requests that '
+                             'may wait at the same time in a worker (default '
+                             'half the threads, %d with --event-loop)'
+                             % feed.MAX_WATCHERS)
+    args = parser.parse_args(argv)
+
+    if args.production:
+        run_production(args.host, args.port, args.workers, args.threads,
+                       event_loop_server if args.event_loop
+                       else ThreadPoolWSGIServer, args.read_replica,
+                       args.read_your_writes, args.max_watchers)
+    else:
+        run_simple(args.host, args.port, application,
+                   use_reloader=True, use_debugger=True, use_evalex=True)
+
 if __name__ == '__main__':
-    run_simple('localhost', 5000, application,
-               use_reloader=True, use_debugger=True, use_evalex=True)
\ No newline at end of file
+    main()